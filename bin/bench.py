@@ -0,0 +1,384 @@
+import argparse
+import concurrent.futures
+import datetime
+import json
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional, Callable, TYPE_CHECKING
+
+import numpy as np
+import PIL.Image
+
+from src import log
+
+if TYPE_CHECKING:
+    from src.imagedb import ImageDB
+
+
+BENCHMARKS = (
+    "image_to_numpy",
+    "add_directory",
+    "update_embeddings",
+    "write_embeddings",
+    "index_build",
+    "index_load",
+    "images_by_text",
+    "server_query",
+)
+
+STUB_MODEL = "stub-512@4.4"
+
+QUERY_TEXTS = (
+    "a dog with a hat", "a red car", "mountains at sunset", "portrait of an old man",
+    "a bowl of fruit", "a city at night", "an abstract painting", "a cat on a sofa",
+)
+
+
+def parse_args() -> dict:
+    parser = argparse.ArgumentParser(
+        description="Time the ingest, embedding, indexing and query paths on synthetic data"
+                    " and write the results as json",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, default=None,
+        help="json file for the results, defaults to stdout",
+    )
+    parser.add_argument(
+        "-b", "--benchmark", type=str, nargs="+", default=None, choices=BENCHMARKS, dest="benchmarks",
+        help="Only run these benchmarks, default is all",
+    )
+    parser.add_argument(
+        "--path", type=str, default=None,
+        help="Directory for the generated images and the database, defaults to a temporary directory",
+    )
+    parser.add_argument(
+        "-i", "--images", type=int, default=200,
+        help="Number of generated image files",
+    )
+    parser.add_argument(
+        "--image-size", type=int, default=256,
+        help="Width and height of the generated image files",
+    )
+    parser.add_argument(
+        "-e", "--embeddings", type=int, default=10_000,
+        help="Number of synthetic embeddings written to the database, 10k to 10M",
+    )
+    parser.add_argument(
+        "-q", "--queries", type=int, default=100,
+        help="Number of text queries",
+    )
+    parser.add_argument(
+        "-c", "--concurrency", type=int, default=4,
+        help="Number of concurrent requests to the server",
+    )
+    parser.add_argument(
+        "-m", "--model", type=str, default=STUB_MODEL,
+        help=f"Defines the CLIP model, default is '{STUB_MODEL}', a fake model"
+             f" with about the compute cost of ViT-B/32, which needs no download (see src/clip/stub.py)",
+    )
+    parser.add_argument(
+        "-d", "--device", type=str, default="cpu",
+        help="The device to run CLIP on, can be 'auto', 'cpu', 'cuda', 'cuda:1', etc..",
+    )
+    parser.add_argument(
+        "-bs", "--batch-size", type=int, default=10,
+        help="Number of images to batch together for CLIP processing",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=23,
+        help="Seed of the synthetic data",
+    )
+
+    return vars(parser.parse_args())
+
+
+class Benchmark:
+    """
+    Collects the timings of all benchmarks
+    """
+
+    def __init__(self, verbose: bool = False):
+        self.verbose = verbose
+        self.results: List[dict] = []
+
+    def measure(self, name: str, count: int, function: Callable[[], Optional[dict]]):
+        """
+        Time `function`, which can return a dict of additional values
+
+        :param name: str, name of the benchmark
+        :param count: int, number of processed items (images, embeddings, queries)
+        """
+        if self.verbose:
+            log.log(f"bench: {name} ({count:,})")
+
+        start_time = time.perf_counter()
+        extra = function()
+        seconds = time.perf_counter() - start_time
+
+        result = {
+            "name": name,
+            "count": count,
+            "seconds": round(seconds, 4),
+            "per_second": round(count / seconds, 2) if seconds else None,
+            **(extra or {}),
+        }
+        self.results.append(result)
+        if self.verbose:
+            log.log(f"bench: {name} {seconds:.3f}s, {result['per_second']:,}/s")
+        return result
+
+
+def create_images(path: Path, count: int, size: int, rng: np.random.Generator) -> List[Path]:
+    """
+    Write `count` jpeg images of smooth random noise
+    """
+    path.mkdir(parents=True, exist_ok=True)
+    filenames = []
+    for i in range(count):
+        small = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+        image = PIL.Image.fromarray(small).resize((size, size), PIL.Image.BILINEAR)
+        filename = path / f"image-{i:07d}.jpg"
+        image.save(filename, quality=90)
+        filenames.append(filename)
+    return filenames
+
+
+def add_synthetic_images(db: "ImageDB", count: int, chunk_size: int = 50_000) -> np.ndarray:
+    """
+    Insert `count` image rows without files and return their ids
+    """
+    import sqlalchemy as sq
+    from src.imagedb import ImageEntry
+
+    with db.sql_session() as sql_session:
+        first_id = (sql_session.execute(sq.select(sq.func.max(ImageEntry.id))).scalar() or 0) + 1
+        for start in range(0, count, chunk_size):
+            db.backend.bulk_insert(
+                sql_session.connection(),
+                ImageEntry.__table__,
+                [
+                    {"id": first_id + i, "path": "/synthetic", "name": f"image-{i:08d}.jpg"}
+                    for i in range(start, min(count, start + chunk_size))
+                ],
+            )
+            sql_session.commit()
+
+    return np.arange(first_id, first_id + count, dtype=np.int64)
+
+
+def write_random_embeddings(
+        db: "ImageDB",
+        model: str,
+        image_ids: np.ndarray,
+        dims: int,
+        rng: np.random.Generator,
+        chunk_size: int = 100_000,
+) -> int:
+    """
+    Write normalized random embeddings in chunks, so that 10M embeddings fit into memory
+    """
+    count = 0
+    for start in range(0, image_ids.shape[0], chunk_size):
+        chunk_ids = image_ids[start: start + chunk_size]
+        embeddings = rng.standard_normal((chunk_ids.shape[0], dims), dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        count += db.write_embeddings(model, chunk_ids, embeddings, update_index=False)
+    return count
+
+
+def query_server(db: "ImageDB", model: str, device: str, texts: List[str], concurrency: int) -> dict:
+    """
+    Run the http server in a thread and post all texts to ``/query/``
+
+    :return: dict with latency percentiles in seconds
+    """
+    import asyncio
+    import tornado.httpserver
+    import tornado.ioloop
+    import tornado.testing
+    from src.hf.download import http_session
+    from src.imagedb.server import create_app
+
+    sock, port = tornado.testing.bind_unused_port()
+    started = threading.Event()
+    loop: Optional[tornado.ioloop.IOLoop] = None
+
+    def _serve():
+        nonlocal loop
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        loop = tornado.ioloop.IOLoop.current()
+        server = tornado.httpserver.HTTPServer(create_app(db, debug=False))
+        server.add_sockets([sock])
+        started.set()
+        loop.start()
+        server.stop()
+
+    thread = threading.Thread(target=_serve, daemon=True)
+    thread.start()
+    started.wait()
+
+    def _query(text: str) -> float:
+        start_time = time.perf_counter()
+        response = http_session().post(
+            f"http://127.0.0.1:{port}/query/",
+            json={"text": text, "model": model, "count": 10, "device": device},
+        )
+        response.raise_for_status()
+        return time.perf_counter() - start_time
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            latencies = np.array(list(executor.map(_query, texts)))
+    finally:
+        loop.add_callback(loop.stop)
+        thread.join()
+
+    return {
+        "concurrency": concurrency,
+        "latency_p50": round(float(np.percentile(latencies, 50)), 4),
+        "latency_p95": round(float(np.percentile(latencies, 95)), 4),
+    }
+
+
+def run_benchmarks(
+        path: Path,
+        benchmarks: List[str],
+        images: int,
+        image_size: int,
+        embeddings: int,
+        queries: int,
+        concurrency: int,
+        model: str,
+        device: str,
+        batch_size: int,
+        seed: int,
+        verbose: bool,
+) -> List[dict]:
+    from src.image import image_to_numpy
+    from src.imagedb import ImageDB, SimIndex
+
+    rng = np.random.default_rng(seed)
+    bench = Benchmark(verbose=verbose)
+    db = ImageDB(path / "db")
+    texts = [QUERY_TEXTS[i % len(QUERY_TEXTS)] + f" {i}" for i in range(queries)]
+
+    if verbose:
+        log.log(f"bench: creating {images:,} images in {path / 'images'}")
+    filenames = create_images(path / "images", images, image_size, rng)
+
+    if "image_to_numpy" in benchmarks:
+        pil_images = [PIL.Image.open(f).convert("RGB") for f in filenames[:100]]
+        bench.measure(
+            "image_to_numpy", len(pil_images),
+            lambda: {"shape": list(image_to_numpy(pil_images).shape)},
+        )
+
+    if "add_directory" in benchmarks:
+        bench.measure("add_directory", images, lambda: db.add_directory(path / "images"))
+    elif images:
+        db.add_directory(path / "images")
+
+    if "update_embeddings" in benchmarks:
+        from src.clip import ClipSingleton
+        # loading the model is not part of the benchmark
+        ClipSingleton.get(model, device)
+        bench.measure(
+            "update_embeddings", images,
+            lambda: db.update_embeddings(model=model, device=device, batch_size=batch_size),
+        )
+
+    if "write_embeddings" in benchmarks or embeddings:
+        from src.clip import ClipSingleton
+        dims = db.embedding_dimensions(model) or ClipSingleton.dimensions(model)
+        image_ids = add_synthetic_images(db, embeddings)
+        if "write_embeddings" in benchmarks:
+            bench.measure(
+                "write_embeddings", embeddings,
+                lambda: {"dimensions": dims, "written": write_random_embeddings(db, model, image_ids, dims, rng)},
+            )
+        else:
+            write_random_embeddings(db, model, image_ids, dims, rng)
+
+    num_embeddings = db.status()["embeddings"]
+    num_embeddings = sum(e["count"] for e in num_embeddings if e["model"] == model)
+
+    if "index_build" in benchmarks:
+        bench.measure(
+            "index_build", num_embeddings,
+            lambda: {"size": SimIndex(db, model=model, persist=False).size},
+        )
+
+    index = db.sim_index(model)
+    if "index_load" in benchmarks:
+        bench.measure(
+            "index_load", num_embeddings,
+            lambda: {"size": SimIndex(db, model=model).size},
+        )
+
+    if "images_by_text" in benchmarks:
+        # the first query loads the model
+        index.images_by_text(texts[0], count=10, device=device)
+        bench.measure(
+            "images_by_text", len(texts),
+            lambda: {"results": sum(len(index.images_by_text(text, count=10, device=device)) for text in texts)},
+        )
+
+    if "server_query" in benchmarks:
+        # like `bin/imagedb.py server`
+        server_db = ImageDB(db.database_path, read_only=True, status_ttl=2.)
+        server_db.sim_index(model).images_by_text(texts[0], count=10, device=device)
+        bench.measure(
+            "server_query", len(texts),
+            lambda: query_server(server_db, model, device, texts, concurrency),
+        )
+
+    return bench.results
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=Path(__file__).resolve().parent, stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(
+        output: Optional[str],
+        benchmarks: Optional[List[str]],
+        path: Optional[str],
+        **kwargs
+):
+    benchmarks = benchmarks or list(BENCHMARKS)
+    meta = {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": kwargs,
+    }
+
+    if path is not None:
+        Path(path).mkdir(parents=True, exist_ok=True)
+        results = run_benchmarks(Path(path), benchmarks, **kwargs)
+    else:
+        with tempfile.TemporaryDirectory(prefix="magic-pen-bench-") as tmp_dir:
+            results = run_benchmarks(Path(tmp_dir), benchmarks, **kwargs)
+
+    text = json.dumps({"meta": meta, "results": results}, indent=2)
+    if output:
+        Path(output).write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main(**parse_args())
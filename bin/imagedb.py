@@ -1,19 +1,50 @@
 import argparse
+import contextlib
+import csv
+import json
+import sys
 from pathlib import Path
-from typing import List, Optional
-
-import sqlalchemy as sq
+from typing import List, Optional, Union, TYPE_CHECKING
 
+# heavy libraries (sqlalchemy, torch, CLIP, faiss) are only imported by the commands that need them
 from src import log
-from src.imagedb import *
+from src.imagedb.daemon import DaemonClient, ImageDBDaemon
 from src.config import DEFAULT_CLIP_MODEL
 
+if TYPE_CHECKING:
+    from src.imagedb import ImageDB
+
+# commands that are sent to the daemon, if it's running
+DAEMON_COMMANDS = ("query", "status", "update")
+
+QUERY_FORMATS = ("text", "jsonl", "csv", "npy")
+
+PROFILERS = ("cprofile", "trace")
+
 
 def parse_args() -> dict:
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-v", "--verbose", action="store_true",
     )
+    parser.add_argument(
+        "--no-daemon", action="store_true",
+        help="Do not use a running daemon for query, status and update",
+    )
+    parser.add_argument(
+        "--socket", type=str, default=None, dest="socket_path",
+        help="Unix socket of the daemon, defaults to daemon.sock in the database directory",
+    )
+    parser.add_argument(
+        "--profile", type=str, default=None, choices=PROFILERS,
+        help="Profile the command in this process (the daemon is not used), 'cprofile'"
+             " writes a pstats file, 'trace' writes the timed sections (see src/profiling.py)"
+             " as Chrome trace json",
+    )
+    parser.add_argument(
+        "--profile-output", type=str, default=None,
+        help="File of the profile, defaults to imagedb-<command>.prof or imagedb-<command>.trace.json",
+    )
     subparsers = parser.add_subparsers()
 
     parser_add = subparsers.add_parser("add", help="Add files to database")
@@ -43,13 +74,22 @@ def parse_args() -> dict:
         "-bs", "--batch-size", type=int, default=10,
         help="Number of images to batch together for CLIP processing",
     )
+    parser_update.add_argument(
+        "-b", "--backend", type=str, default="torch",
+        choices=["torch", "torchscript", "compile", "int8", "onnx"],
+        help="The inference backend, 'int8' and 'onnx' are cpu-only, 'compile' requires torch >= 2.0",
+    )
+    parser_update.add_argument(
+        "--threads", type=int, default=None,
+        help="Number of CPU threads for inference, defaults to number of cores",
+    )
 
     parser_query = subparsers.add_parser("query", help="Query images by text")
     parser_query.set_defaults(command="query")
 
     parser_query.add_argument(
         "-t", "--text", type=str, default=None,
-        help=f"The text query (use quotes around the text!)",
+        help=f"The text query (use quotes around the text!), '-' reads one query per line from stdin",
     )
     parser_query.add_argument(
         "-c", "--count", type=int, default=1,
@@ -63,10 +103,70 @@ def parse_args() -> dict:
         "-d", "--device", type=str, default="auto",
         help="The device to run CLIP on, can be 'auto', 'cpu', 'cuda', 'cuda:1', etc..",
     )
+    parser_query.add_argument(
+        "-f", "--format", type=str, default="text", choices=QUERY_FORMATS,
+        help="Output format, 'npy' writes a structured array (query, id, score) to stdout",
+    )
+
+    parser_export = subparsers.add_parser("export", help="Write all embeddings of a model to files")
+    parser_export.set_defaults(command="export")
+
+    parser_export.add_argument(
+        "output", type=str,
+        help="Directory for 'npy' format, file for 'parquet' format",
+    )
+    parser_export.add_argument(
+        "-m", "--model", type=str, default=DEFAULT_CLIP_MODEL,
+        help=f"Defines the CLIP model, default is '{DEFAULT_CLIP_MODEL}'",
+    )
+    parser_export.add_argument(
+        "-f", "--format", type=str, default="npy", choices=["npy", "parquet"],
+        help="'npy' writes embeddings.npy, image_ids.npy, filenames.txt and meta.json, 'parquet' needs pyarrow",
+    )
+    parser_export.add_argument(
+        "--chunk-size", type=int, default=10_000,
+        help="Number of embeddings to process at once",
+    )
+
+    parser_import = subparsers.add_parser("import", help="Load embeddings from files written by export")
+    parser_import.set_defaults(command="import")
+
+    parser_import.add_argument(
+        "input", type=str,
+        help="Directory ('npy' format) or parquet file",
+    )
+    parser_import.add_argument(
+        "-m", "--model", type=str, default=None,
+        help="Defines the CLIP model, defaults to the model stored in the input",
+    )
+    parser_import.add_argument(
+        "--chunk-size", type=int, default=10_000,
+        help="Number of embeddings to write in one transaction",
+    )
+    parser_import.add_argument(
+        "--no-add-images", action="store_true",
+        help="Skip embeddings of images that are not in the database",
+    )
 
     parser_status = subparsers.add_parser("status", help="Print status of files in database")
     parser_status.set_defaults(command="status")
 
+    parser_status.add_argument(
+        "--detailed", action="store_true",
+        help="Also print embedding dimensions, size of database and the state of the"
+             " similarity indices loaded by the daemon",
+    )
+
+    parser_daemon = subparsers.add_parser(
+        "daemon", help="Keep models and indices in memory and serve query, status and update on a unix socket",
+    )
+    parser_daemon.set_defaults(command="daemon")
+
+    parser_daemon.add_argument(
+        "--idle-timeout", type=float, default=600.,
+        help="Exit after this many seconds without requests, 0 runs forever",
+    )
+
     parser_server = subparsers.add_parser("server", help="Run database as http server")
     parser_server.set_defaults(command="server")
 
@@ -84,27 +184,89 @@ def parse_args() -> dict:
 
 def main(
         command: str,
+        no_daemon: bool,
+        socket_path: Optional[str],
+        profile: Optional[str],
+        profile_output: Optional[str],
         **kwargs
 ):
-    db = ImageDB(verbose=kwargs["verbose"])
-
     command_func = globals().get(f"command_{command}")
     if not callable(command_func):
         print(f"Invalid command '{command}")
         exit(1)
 
-    command_func(db, **kwargs)
+    # a profile of the client would not show the work of the daemon
+    if command in DAEMON_COMMANDS and not no_daemon and not profile:
+        client = DaemonClient.connect(socket_path)
+        if client is not None:
+            with client:
+                command_func(client, **kwargs)
+            return
+
+    if command == "daemon":
+        kwargs["socket_path"] = socket_path
+
+    with profiled(command, profile=profile, output=profile_output, verbose=kwargs["verbose"]):
+        from src.imagedb import ImageDB
+        db = ImageDB(verbose=kwargs["verbose"])
+
+        command_func(db, **kwargs)
+
+
+@contextlib.contextmanager
+def profiled(
+        command: str,
+        profile: Optional[str],
+        output: Optional[str],
+        verbose: bool,
+):
+    """
+    Run the enclosed code with the profiler and, if `verbose`,
+    log a summary of the timed sections afterwards
+    """
+    from src import profiling
+
+    recorder = None
+    if verbose or profile == "trace":
+        recorder = profiling.enable(trace=profile == "trace")
+
+    profiler = None
+    if profile == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        yield
+
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            output = output or f"imagedb-{command}.prof"
+            profiler.dump_stats(output)
+            if verbose:
+                log.log(f"wrote profile to {output}, view with: python -m pstats {output}")
+
+        if recorder is not None:
+            profiling.disable()
+            if profile == "trace":
+                output = output or f"imagedb-{command}.trace.json"
+                recorder.write_trace(output)
+                if verbose:
+                    log.log(f"wrote trace to {output}")
+            if verbose and recorder.stats:
+                log.log(recorder.format_summary())
 
 
 def command_add(
-        db: ImageDB,
+        db: "ImageDB",
         path: List[str],
         recursive: bool,
         verbose: bool,
 ):
     paths = path
     for path in paths:
-        path = ImageDB.normalize_path(path)
+        path = db.normalize_path(path)
 
         if path.is_dir():
             db.add_directory(path, recursive=recursive)
@@ -127,39 +289,142 @@ def command_add(
 
 
 def command_update(
-        db: ImageDB,
+        db: Union["ImageDB", DaemonClient],
         model: str,
         device: str,
         batch_size: int,
+        backend: str,
+        threads: Optional[int],
         verbose: bool,
 ):
+    if backend != "torch":
+        device = f"{device}+{backend}"
+
+    if isinstance(db, DaemonClient):
+        db.update_embeddings(model=model, device=device, batch_size=batch_size, threads=threads)
+        return
+
+    from src.clip import set_num_threads
+    set_num_threads(threads)
+
     db.update_embeddings(model=model, device=device, batch_size=batch_size)
 
 
+class QueryOutput:
+    """
+    Writes query results to stdout as they arrive
+    """
+    def __init__(self, format: str):
+        self.format = format
+        self._rows = []
+        self._csv = None
+        if format == "csv":
+            self._csv = csv.writer(sys.stdout)
+            self._csv.writerow(["query", "text", "rank", "id", "score", "filename"])
+
+    def write(self, query: int, text: str, rank: int, id: int, score: float, filename: str):
+        if self.format == "text":
+            if query and not rank:
+                print()
+            print(f"{score:3.3f} {filename}", flush=True)
+
+        elif self.format == "jsonl":
+            print(json.dumps({
+                "query": query, "text": text, "rank": rank, "id": id, "score": score, "filename": filename,
+            }), flush=True)
+
+        elif self.format == "csv":
+            self._csv.writerow([query, text, rank, id, score, filename])
+            sys.stdout.flush()
+
+        elif self.format == "npy":
+            self._rows.append((query, id, score))
+
+    def close(self):
+        if self.format == "npy":
+            import numpy as np
+            array = np.array(self._rows, dtype=[("query", np.int32), ("id", np.int64), ("score", np.float32)])
+            np.save(sys.stdout.buffer, array)
+            sys.stdout.buffer.flush()
+
+
 def command_query(
-        db: ImageDB,
+        db: Union["ImageDB", DaemonClient],
         text: Optional[str],
         count: int,
         model: str,
         device: str,
+        format: str,
         verbose: bool,
 ):
     if not text:
         print("Need to define text (-t/--text)")
         exit(1)
 
-    index = db.sim_index(model=model)
-    for image_entry, score in index.images_by_text(prompt=text, count=count, device=device):
-        print(f"{score:3.3f} {image_entry.filename()}")
+    if text == "-":
+        texts = (line.strip() for line in sys.stdin)
+        texts = (t for t in texts if t)
+    else:
+        texts = [text]
+
+    output = QueryOutput(format)
+    for i, text in enumerate(texts):
+
+        if isinstance(db, DaemonClient):
+            result = (
+                (r["id"], r["score"], r["filename"])
+                for r in db.query(text=text, count=count, model=model, device=device)
+            )
+        else:
+            index = db.sim_index(model=model)
+            result = (
+                (image_entry.id, score, str(image_entry.filename()))
+                for image_entry, score in index.iter_images_by_text(prompt=text, count=count, device=device)
+            )
+
+        for rank, (id, score, filename) in enumerate(result):
+            output.write(query=i, text=text, rank=rank, id=id, score=score, filename=filename)
+
+    output.close()
+
+
+def command_export(
+        db: "ImageDB",
+        output: str,
+        model: str,
+        format: str,
+        chunk_size: int,
+        verbose: bool,
+):
+    from src.imagedb import export_embeddings
+    count = export_embeddings(db, model=model, path=output, format=format, chunk_size=chunk_size)
+    if verbose:
+        log.log(f"exported {count:,} embeddings of model '{model}' to {output}")
+
+
+def command_import(
+        db: "ImageDB",
+        input: str,
+        model: Optional[str],
+        chunk_size: int,
+        no_add_images: bool,
+        verbose: bool,
+):
+    from src.imagedb import import_embeddings
+    stats = import_embeddings(db, path=input, model=model, chunk_size=chunk_size, add_images=not no_add_images)
+    if verbose:
+        log.log(f"imported {stats['imported']:,} embeddings, skipped {stats['skipped']:,}")
 
 
 def command_status(
-        db: ImageDB,
+        db: Union["ImageDB", DaemonClient],
+        detailed: bool,
         verbose: bool,
 ):
-    status = db.status()
+    status = db.status(detailed=detailed)
     embedding_str = "\n".join(
         f"  - {e['model']:11} {e['count']:,}"
+        + (f" ({e['dimensions']} dims)" if e.get("dimensions") else "")
         for e in status["embeddings"]
     )
     print(f"""
@@ -169,14 +434,35 @@ embeddings:
 {embedding_str}
     """.strip())
 
+    if status.get("bytes_on_disk") is not None:
+        print(f"size on disk:   {status['bytes_on_disk']:,} bytes")
+
+    if status.get("indices"):
+        print("loaded indices:")
+        for i in status["indices"]:
+            print(f"  - {i['model']:11} {i['size']:,} ({i['missing']:,} missing, synced {i['age']:.1f}s ago)")
+
+
+def command_daemon(
+        db: "ImageDB",
+        socket_path: Optional[str],
+        idle_timeout: float,
+        verbose: bool,
+):
+    daemon = ImageDBDaemon(db, socket_path=socket_path, idle_timeout=idle_timeout, verbose=verbose)
+    daemon.serve_forever()
+
 
 def command_server(
-        db: ImageDB,
+        db: "ImageDB",
         host: str,
         port: int,
         verbose: bool,
 ):
+    from src.imagedb import ImageDB
     from src.imagedb.server import run_server
+    # the server only reads, so it uses read-only connections which never block the writers
+    db = ImageDB(database_path=db.database_path, verbose=verbose, read_only=True, status_ttl=2.)
     run_server(db=db, host=host, port=port, verbose=verbose)
 
 
@@ -1,12 +1,16 @@
 import json
 import os
+import tempfile
 from functools import partial
 from pathlib import Path
 import threading
-from typing import Union, Set, Dict, Optional, Callable
+from typing import Union, Set, Dict, Optional, Callable, Tuple, List, TYPE_CHECKING
 
-from src.config import RESULTS_PATH
-from src.hf import HuggingfaceSpace, SpacePool
+from src.config import RESULTS_PATH, RESULTS_INGEST, RESULTS_REUSE
+from src.hf import HuggingfaceSpace, SpacePool, SpaceJob, Result
+
+if TYPE_CHECKING:
+    from src.imagedb import IngestSink
 
 
 class Client:
@@ -16,20 +20,61 @@ class Client:
     @classmethod
     def singleton(cls) -> "Client":
         if cls._singleton is None:
-            cls._singleton = Client()
+            ingest = None
+            if RESULTS_INGEST:
+                from src.imagedb import ImageDB, IngestSink
+                ingest = IngestSink(ImageDB(), tags=["generated"])
+            cls._singleton = Client(ingest=ingest, reuse_results=RESULTS_REUSE)
         return cls._singleton
 
-    def __init__(self, pool_size: int = 20):
-        self.pool = SpacePool(size=pool_size)
+    def __init__(
+            self,
+            pool_size: int = 0,
+            max_per_endpoint: int = 20,
+            rate_per_endpoint: float = 2.,
+            max_retries: int = 5,
+            ingest: Optional["IngestSink"] = None,
+            reuse_results: bool = False,
+    ):
+        """
+        :param pool_size: int, maximum number of spaces that run at the same time, 0 for no limit
+        :param max_per_endpoint: int, maximum number of spaces per websocket url that run at the same time
+        :param rate_per_endpoint: float, maximum number of new connections per second and websocket url
+        :param max_retries: int, number of retries of a space after an error or a full queue
+        :param ingest: IngestSink, if defined, the stored images are added to its ImageDB
+        :param reuse_results: bool, return the results of a running or earlier identical request
+            instead of running the space again, see `run_space`
+        """
+        self.pool = SpacePool(
+            size=pool_size,
+            max_per_endpoint=max_per_endpoint,
+            rate_per_endpoint=rate_per_endpoint,
+            max_retries=max_retries,
+        )
         self.pool.start()
+        self.ingest = ingest
+        if self.ingest is not None:
+            self.ingest.start()
         self.result_path = RESULTS_PATH
         self.num_digits = 4
+        self.reuse_results = reuse_results
+        self.cache_hits = {"coalesced": 0, "reused": 0}
         self._lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        # cache key -> (job, list of (path, slug, callback) of the attached requests)
+        self._inflight: Dict[str, Tuple[SpaceJob, List[Tuple[Path, str, Optional[Callable]]]]] = {}
+        # cache key -> stored files, loaded from `generations_file`
+        self._generations: Optional[Dict[str, List[dict]]] = None
+        self._generations_file: Optional[Path] = None
+        # (directory, slug) -> next file number
+        self._counters: Dict[Tuple[Path, str], int] = {}
         self._spaces: Set[HuggingfaceSpace] = set()
         self._space_ids: Dict[str, HuggingfaceSpace] = {}
 
     def stop(self):
         self.pool.stop()
+        if self.ingest is not None:
+            self.ingest.stop()
 
     def run_space(
             self,
@@ -37,16 +82,61 @@ class Client:
             path: Union[str, Path],
             slug: str,
             callback: Optional[Callable] = None,
-    ):
+            priority: int = 0,
+            timeout: Optional[float] = None,
+            reuse: Optional[bool] = None,
+    ) -> SpaceJob:
+        """
+        Run the space in the pool and store the results in `path`.
+
+        With `reuse`, requests with the same `HuggingfaceSpace.cache_key` are not
+        sent twice: while an identical space is running, the request is attached
+        to its job and the returned job is the running one. The results are stored
+        once per path and slug and the callbacks of all attached requests are called.
+        Otherwise every request runs, e.g. to get several images of one prompt.
+
+        The `callback` is always called in a worker thread, also for reused results,
+        so Qt widgets need to pass the results to the GUI thread, e.g. with a signal.
+
+        :param priority: int, spaces with higher priority are started first
+        :param timeout: float, seconds after which the space is cancelled
+        :param reuse: bool, if an identical request is running or its results are stored,
+            use them instead of running the space. Defaults to `reuse_results`
+        """
         if space in self._spaces:
             raise ValueError(f"Space {space} is already running")
 
-        space_id = self._get_new_space_id(slug)
-        self._spaces.add(space)
-        self._space_ids[space_id] = space
+        path = Path(path)
+        key = space.cache_key()
+        reuse = self.reuse_results if reuse is None else reuse
+
+        with self._cache_lock:
+            if reuse and key in self._inflight:
+                job, attached = self._inflight[key]
+                attached.append((path, slug, callback))
+                self.cache_hits["coalesced"] += 1
+                return job
+
+            files = self._get_generation(key) if reuse else None
+            if files:
+                self.cache_hits["reused"] += 1
+            else:
+                space_id = self._get_new_space_id(slug)
+                self._spaces.add(space)
+                self._space_ids[space_id] = space
+
+                space.finished = partial(self._on_finished, space, key, path, slug, space_id, callback)
+                job = self.pool.run(space, priority=priority, timeout=timeout)
+                self._inflight[key] = (job, [])
+                return job
 
-        space.finished = partial(self._on_finished, space, Path(path), slug, space_id, callback)
-        self.pool.run(space)
+        return self._reuse(space, files, path, slug, callback)
+
+    def generations_file(self) -> Path:
+        """
+        The file that lists the stored results of each request, one json object per line
+        """
+        return self.result_path / ".generations.jsonl"
 
     def status(self) -> dict:
         return {
@@ -54,6 +144,16 @@ class Client:
             for space_id, space in self._space_ids.items()
         }
 
+    def metrics(self) -> dict:
+        """
+        Queue depth and latencies of the pool, see `SpacePool.metrics`,
+        and the "cache" hits of `run_space`
+        """
+        metrics = self.pool.metrics()
+        with self._cache_lock:
+            metrics["cache"] = dict(self.cache_hits)
+        return metrics
+
     def _get_new_space_id(self, slug: str) -> str:
         space_id = slug
         count = 2
@@ -65,58 +165,177 @@ class Client:
     def _on_finished(
             self,
             space: HuggingfaceSpace,
+            key: str,
             path: Path,
             slug: str,
             space_id: str,
             callback: Optional[Callable],
     ):
-        results = space.result()
-        if results:
-            for result in results:
-                self._store_result(space, result, path, slug)
+        results = None
+        stored = {(path, slug)}
+        try:
+            results = space.result()
+            if results:
+                filenames = self._store_results(space, results, path, slug)
+                if space.state == "complete":
+                    self._add_generation(key, results, filenames)
 
-        if callback:
-            callback()
+        finally:
+            try:
+                if callback:
+                    callback()
 
-        try:
-            self._spaces.remove(space)
-        except KeyError:
-            pass
-        try:
-            self._space_ids.pop(space_id)
-        except KeyError:
-            pass
+            finally:
+                # requests attached after this point run the space again
+                with self._cache_lock:
+                    _, attached = self._inflight.pop(key, (None, []))
+
+                self._spaces.discard(space)
+                self._space_ids.pop(space_id, None)
+
+                for attached_path, attached_slug, attached_callback in attached:
+                    try:
+                        if results and (attached_path, attached_slug) not in stored:
+                            stored.add((attached_path, attached_slug))
+                            self._store_results(space, results, attached_path, attached_slug)
+                    finally:
+                        if attached_callback:
+                            attached_callback()
+
+    def _reuse(
+            self,
+            space: HuggingfaceSpace,
+            files: List[dict],
+            path: Path,
+            slug: str,
+            callback: Optional[Callable],
+    ) -> SpaceJob:
+        """
+        Finish the request with stored files, they are copied if `path` is a different directory
+        """
+        filenames = [self.result_path / file["name"] for file in files]
+        if any(filename.parent != self.result_path / path for filename in filenames):
+            self._store_results(space, [
+                Result(data=None, mime_type=file["mime_type"], filename=filename)
+                for file, filename in zip(files, filenames)
+            ], path, slug)
+
+        space.state = "cached"
+        return SpaceJob.completed(space, finished=callback)
+
+    def _get_generation(self, key: str) -> Optional[List[dict]]:
+        """
+        The stored files of an earlier request, if all of them still exist
+        """
+        if self._generations is None or self._generations_file != self.generations_file():
+            self._generations_file = self.generations_file()
+            self._generations = {}
+            if self._generations_file.exists():
+                with open(self._generations_file) as fp:
+                    for line in fp:
+                        try:
+                            entry = json.loads(line)
+                            self._generations[entry["key"]] = entry["files"]
+                        except (ValueError, KeyError):
+                            # a partially written line
+                            pass
+
+        files = self._generations.get(key)
+        if files and all((self.result_path / file["name"]).exists() for file in files):
+            return files
+
+    def _add_generation(self, key: str, results: List[Result], filenames: List[Path]):
+        files = [
+            {"name": str(filename.relative_to(self.result_path)), "mime_type": result.mime_type}
+            for result, filename in zip(results, filenames)
+        ]
+        with self._cache_lock:
+            self._get_generation(key)
+            self._generations[key] = files
+            os.makedirs(self.result_path, exist_ok=True)
+            with open(self._generations_file, "a") as fp:
+                fp.write(json.dumps({"key": key, "files": files}) + "\n")
+
+    def _store_results(self, space: HuggingfaceSpace, results: List[Result], path: Path, slug: str) -> List[Path]:
+        filenames = []
+        for result in results:
+            filename = self._store_result(space, result, path, slug)
+            filenames.append(filename)
+            if self.ingest is not None:
+                self.ingest.put(filename, meta={
+                    "space": space.__class__.__name__,
+                    "slug": slug,
+                    "parameters": space.parameters(),
+                })
+        return filenames
 
     def _store_result(self, space: HuggingfaceSpace, result, path: Path, filename: str) -> Path:
-        with self._lock:
-            full_path = self.result_path / path
-            os.makedirs(full_path, exist_ok=True)
+        full_path = self.result_path / path
+        os.makedirs(full_path, exist_ok=True)
 
-            def _get_full_name(count: int, ext: Optional[str] = None):
-                return full_path / f"{filename}-{count:0{self.num_digits}d}.{ext or result.extension}"
+        def _get_full_name(count: int, ext: Optional[str] = None):
+            return full_path / f"{filename}-{count:0{self.num_digits}d}.{ext or result.extension}"
 
-            count = 0
+        # the counter can be behind if other processes write to the same directory,
+        # exclusive creation makes sure no file is overwritten
+        while True:
+            count = self._next_count(full_path, filename)
             full_name = _get_full_name(count)
-            if full_name.exists():
-                all_files = full_path.glob(f"{filename}-*.{result.extension}")
-                numbers = []
-                for f in all_files:
-                    try:
-                        numbers.append(int(f.name.split("-")[-1].split(".", 1)[0]))
-                    except ValueError:
-                        pass
-                if numbers:
-                    count = sorted(numbers)[-1]
+            try:
+                os.close(os.open(full_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+                break
+            except FileExistsError:
+                pass
 
-            full_name = _get_full_name(count)
-            while full_name.exists():  # some fallback
-                count += 1
-                full_name = _get_full_name(count)
+        # the empty placeholder is replaced at once, so the file list never shows a partial image
+        temp_name = full_name.with_name(f".{full_name.name}.tmp")
+        try:
+            result.save(temp_name)
+            os.replace(temp_name, full_name)
+        except BaseException:
+            if temp_name.exists():
+                os.remove(temp_name)
+            raise
+        if result.filename == temp_name:
+            # a temporary download was moved, the next `save` copies it from here
+            result.filename = full_name
+
+        _write_atomic(_get_full_name(count, "json"), json.dumps(space.parameters()))
+
+        return full_name
+
+    def _next_count(self, full_path: Path, filename: str) -> int:
+        """
+        Return the next free number for files `<filename>-<number>.*` in `full_path`.
+
+        The directory is scanned only the first time, then a counter is incremented.
+        """
+        key = (full_path, filename)
+        with self._lock:
+            count = self._counters.get(key)
+            if count is None:
+                count = 0
+                prefix = f"{filename}-"
+                with os.scandir(full_path) as entries:
+                    for entry in entries:
+                        if entry.name.startswith(prefix):
+                            number = entry.name[len(prefix):].split(".", 1)[0]
+                            if number.isdigit():
+                                count = max(count, int(number) + 1)
 
-            print(f"SAVING {full_name}")
-            result.save(full_name)
+            self._counters[key] = count + 1
+            return count
 
-            data_name = _get_full_name(count, "json")
-            data_name.write_text(json.dumps(space.parameters()))
 
-            return full_name
+def _write_atomic(filename: Path, text: str):
+    """
+    Write to a temporary file and rename it, so readers never see a partial file
+    """
+    fd, temp_name = tempfile.mkstemp(dir=filename.parent, prefix=f".{filename.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write(text)
+        os.replace(temp_name, filename)
+    except BaseException:
+        os.remove(temp_name)
+        raise
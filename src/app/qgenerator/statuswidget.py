@@ -25,9 +25,12 @@ class StatusWidget(QWidget):
         l = QHBoxLayout()
         self.setLayout(l)
 
+        self.metrics_label = QLabel(self)
+        l.addWidget(self.metrics_label)
+
         self.status_label = QLabel(self)
         self.status_label.setWordWrap(True)
-        l.addWidget(self.status_label)
+        l.addWidget(self.status_label, 2)
 
     def slot_update(self):
         client = Client.singleton()
@@ -38,3 +41,25 @@ class StatusWidget(QWidget):
             for key in sorted(status)
         )
         self.status_label.setText(msg)
+
+        metrics = client.metrics()
+        msg = (
+            f"queued: {metrics['queued']} running: {metrics['running']} retry: {metrics['retry']}"
+            f" | done: {metrics['completed']} failed: {metrics['failed']}"
+        )
+        if metrics["latency"] is not None:
+            msg += f" | latency: {metrics['latency']:.1f}s"
+        cache_hits = metrics["cache"]["coalesced"] + metrics["cache"]["reused"]
+        if cache_hits:
+            msg += f" | cache hits: {cache_hits}"
+        self.metrics_label.setText(msg)
+        self.metrics_label.setToolTip("\n".join(
+            [
+                f"{url}: {e['queued']} queued, {e['running']} running, {e['retries']} retries"
+                + (f", {e['latency']:.1f}s latency" if e["latency"] is not None else "")
+                for url, e in sorted(metrics["endpoints"].items())
+            ] + [
+                f"cache: {metrics['cache']['coalesced']} attached to running requests,"
+                f" {metrics['cache']['reused']} reused results"
+            ]
+        ))
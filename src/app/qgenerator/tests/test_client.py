@@ -1,26 +1,39 @@
+import asyncio
+import concurrent.futures
+import json
 import unittest
 import tempfile
-import time
+import threading
+from functools import partial
 from pathlib import Path
 
-from src.hf import HuggingfaceSpace, ImageResult
+from src.hf import HuggingfaceSpace, ImageResult, Result
 from src.app.qgenerator.client import Client
 
 
 class FakeSpace(HuggingfaceSpace):
 
-    def __init__(self):
-        super().__init__("ws://")
+    def __init__(self, prompt: str = "", delay: float = 0.):
+        super().__init__("ws://", parameters=[prompt])
+        self.delay = delay
+        self.num_runs = 0
 
-    def run(self):
+    async def run_async(self):
         # print(f"running {self}")
-        if self.finished is not None:
-            self.finished()
+        self.num_runs += 1
+        await asyncio.sleep(self.delay)
+        self.state = "complete"
 
     def result(self):
         return [ImageResult(data=b"123", mime_type="image/fake")]
 
 
+class FailingSpace(FakeSpace):
+
+    def result(self):
+        raise RuntimeError("broken result")
+
+
 class TestClient(unittest.TestCase):
 
     def test_client(self):
@@ -32,15 +45,176 @@ class TestClient(unittest.TestCase):
                 full_path = client.result_path / "unit-tests"
                 self.assertFalse(full_path.exists())
 
-                client.run_space(FakeSpace(), path="unit-tests", slug="sluggy")
-                client.run_space(FakeSpace(), path="unit-tests", slug="sluggy")
-                client.run_space(FakeSpace(), path="unit-tests", slug="sluggy")
-                time.sleep(.5)
+                jobs = [
+                    client.run_space(FakeSpace(), path="unit-tests", slug="sluggy")
+                    for _ in range(3)
+                ]
+                # identical requests run in parallel, unless results are reused
+                self.assertEqual(3, len(set(jobs)))
+                for job in jobs:
+                    job.wait(5)
 
                 self.assertEqual(
                     ["sluggy-0000.fake", "sluggy-0001.fake", "sluggy-0002.fake"],
-                    sorted(p.name for p in full_path.glob("*"))
+                    sorted(p.name for p in full_path.glob("*.fake"))
+                )
+
+            finally:
+                client.stop()
+
+    def test_result_names(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            client = Client()
+            try:
+                client.result_path = Path(temp_dir)
+                full_path = client.result_path / "names"
+                full_path.mkdir()
+                for name in ("sluggy-0003.png", "sluggy-0010.json", "sluggy-x-0020.png", "other-0030.png"):
+                    (full_path / name).write_text("")
+
+                space = FakeSpace()
+                result = space.result()[0]
+                self.assertEqual(
+                    full_path / "sluggy-0011.fake",
+                    client._store_result(space, result, Path("names"), "sluggy"),
+                )
+                self.assertEqual(b"123", (full_path / "sluggy-0011.fake").read_bytes())
+                self.assertEqual({"0": ""}, json.loads((full_path / "sluggy-0011.json").read_text()))
+
+                # created by another process, the name is skipped
+                (full_path / "sluggy-0012.fake").write_text("")
+                self.assertEqual(
+                    full_path / "sluggy-0013.fake",
+                    client._store_result(space, result, Path("names"), "sluggy"),
+                )
+
+                # concurrent saves
+                with concurrent.futures.ThreadPoolExecutor(8) as executor:
+                    names = list(executor.map(
+                        lambda i: client._store_result(space, result, Path("names"), "sluggy").name,
+                        range(40),
+                    ))
+                self.assertEqual(
+                    [f"sluggy-{i:04d}.fake" for i in range(14, 54)],
+                    sorted(names),
+                )
+                # no temporary files are left
+                self.assertEqual([], list(full_path.glob(".*")))
+
+                # a streamed download is moved by the first save and copied by the next
+                download = Path(temp_dir) / "download.tmp"
+                download.write_bytes(b"456")
+                result = Result.from_temporary_file(download, "image/fake")
+                first = client._store_result(space, result, Path("names"), "moved")
+                second = client._store_result(space, result, Path("names"), "moved")
+                self.assertFalse(download.exists())
+                self.assertEqual(b"456", first.read_bytes())
+                self.assertEqual(b"456", second.read_bytes())
+                self.assertEqual([], list(full_path.glob(".*")))
+
+            finally:
+                client.stop()
+
+    def test_dedup(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            client = Client(rate_per_endpoint=0)
+            try:
+                client.result_path = Path(temp_dir)
+                calls = []
+
+                # identical requests attach to the running job
+                spaces = [FakeSpace("a", delay=.3) for _ in range(3)]
+                jobs = [
+                    client.run_space(space, path=path, slug="dup", reuse=True, callback=partial(calls.append, i))
+                    for i, (space, path) in enumerate(zip(spaces, ["one", "one", "two"]))
+                ]
+                other_job = client.run_space(FakeSpace("b"), path="one", slug="other")
+                self.assertIs(jobs[0], jobs[1])
+                self.assertIs(jobs[0], jobs[2])
+                self.assertIsNot(jobs[0], other_job)
+                for job in (jobs[0], other_job):
+                    job.wait(5)
+
+                self.assertEqual(1, spaces[0].num_runs)
+                self.assertEqual(0, spaces[1].num_runs)
+                self.assertEqual([0, 1, 2], sorted(calls))
+                # the results are stored once per directory
+                self.assertEqual(
+                    ["dup-0000.fake", "other-0000.fake"],
+                    sorted(p.name for p in (Path(temp_dir) / "one").glob("*.fake")),
+                )
+                self.assertEqual(["dup-0000.fake"], [p.name for p in (Path(temp_dir) / "two").glob("*.fake")])
+                self.assertEqual({"coalesced": 2, "reused": 0}, client.metrics()["cache"])
+
+                # finished requests run again, unless results are reused
+                space = FakeSpace("a")
+                client.run_space(space, path="one", slug="dup").wait(5)
+                self.assertEqual(1, space.num_runs)
+                self.assertEqual(2, len(list((Path(temp_dir) / "one").glob("dup-*.fake"))))
+
+                space = FakeSpace("a")
+                callback_threads = []
+                job = client.run_space(
+                    space, path="one", slug="dup", reuse=True,
+                    callback=lambda: callback_threads.append(threading.current_thread()),
                 )
+                self.assertTrue(job.wait(5))
+                self.assertEqual("done", job.phase)
+                self.assertEqual("cached", space.state)
+                self.assertEqual(0, space.num_runs)
+                # like the callbacks of spaces that run in the pool
+                self.assertEqual(1, len(callback_threads))
+                self.assertIsNot(threading.main_thread(), callback_threads[0])
+                self.assertEqual(2, len(list((Path(temp_dir) / "one").glob("dup-*.fake"))))
+                self.assertEqual({"coalesced": 2, "reused": 1}, client.metrics()["cache"])
+
+                # reused results are copied to another directory
+                client.run_space(FakeSpace("a"), path="three", slug="copy", reuse=True)
+                self.assertEqual(b"123", (Path(temp_dir) / "three" / "copy-0000.fake").read_bytes())
+
+            finally:
+                client.stop()
+
+            # the stored generations are read by a new client
+            client = Client(reuse_results=True)
+            try:
+                client.result_path = Path(temp_dir)
+                space = FakeSpace("b")
+                client.run_space(space, path="one", slug="other").wait(5)
+                self.assertEqual(0, space.num_runs)
+
+                # unless the files were deleted
+                (Path(temp_dir) / "one" / "other-0000.fake").unlink()
+                space = FakeSpace("b")
+                client.run_space(space, path="one", slug="other").wait(5)
+                self.assertEqual(1, space.num_runs)
+
+            finally:
+                client.stop()
+
+    def test_failed_result(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            client = Client(rate_per_endpoint=0)
+            try:
+                client.result_path = Path(temp_dir)
+                calls = []
+
+                spaces = [FailingSpace("a", delay=.3) for _ in range(2)]
+                jobs = [
+                    client.run_space(space, path="fail", slug="fail", reuse=True, callback=partial(calls.append, i))
+                    for i, space in enumerate(spaces)
+                ]
+                self.assertIs(jobs[0], jobs[1])
+                jobs[0].wait(5)
+
+                # all callbacks are called and the key is free again
+                self.assertEqual([0, 1], sorted(calls))
+                self.assertEqual({}, client._inflight)
+                self.assertEqual({}, client.status())
+
+                space = FailingSpace("a")
+                client.run_space(space, path="fail", slug="fail").wait(5)
+                self.assertEqual(1, space.num_runs)
 
             finally:
                 client.stop()
@@ -1,5 +1,15 @@
-from .clip_singleton import ClipSingleton, CLIP_MODELS, MODEL_DIMENSIONS
+from .clip_singleton import ClipSingleton, MODEL_DIMENSIONS
 from .features import get_text_features, get_image_features
+from .preprocess import preprocess_images, load_image, CLIP_MEAN, CLIP_STD
 
 
 
+from .backends import INFERENCE_BACKENDS, set_num_threads, check_parity, model_dimensions
+
+
+def __getattr__(name: str):
+    # CLIP_MODELS needs the clip package, which is imported on first access
+    if name == "CLIP_MODELS":
+        from . import clip_singleton
+        return clip_singleton.CLIP_MODELS
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
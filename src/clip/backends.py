@@ -0,0 +1,297 @@
+"""
+Alternative inference backends for the CLIP image and text towers.
+
+A backend is selected by appending it to the device string, e.g.
+``"cpu+int8"`` or ``"cpu+onnx"``. Without a suffix the reference
+PyTorch model is used.
+"""
+import copy
+import hashlib
+import inspect
+import json
+import os
+from pathlib import Path
+from typing import Tuple, Optional, Iterable, Union, Dict
+
+import numpy as np
+import torch
+
+from src.config import MODEL_CACHE_PATH
+
+
+INFERENCE_BACKENDS = (
+    "torch",        # the reference model
+    "torchscript",  # traced, frozen and optimized for inference
+    "compile",      # torch.compile
+    "int8",         # dynamic int8 quantization of all linear layers
+    "onnx",         # onnxruntime with all graph optimizations
+)
+
+_num_threads: Optional[int] = None
+
+
+def parse_device(device: str) -> Tuple[str, str]:
+    """
+    Split "<torch device>[+<backend>]" into (torch device, backend)
+    """
+    if "+" in device:
+        device, backend = device.split("+", 1)
+    else:
+        backend = "torch"
+
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}', expected one of {', '.join(INFERENCE_BACKENDS)}")
+
+    return device, backend
+
+
+def set_num_threads(num_threads: Optional[int]):
+    """
+    Set the number of CPU threads for torch and for onnxruntime sessions created afterwards.
+    None keeps the default (number of cores).
+    """
+    global _num_threads
+    _num_threads = num_threads
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+
+def model_dimensions(model: torch.nn.Module) -> int:
+    """
+    The size of the embeddings of a CLIP model
+    """
+    return int(model.text_projection.shape[1])
+
+
+class InferenceModel:
+    """
+    Wraps the encoders of a CLIP model and provides the same interface
+    that `src.clip.features` uses: `encode_image`, `encode_text`,
+    `device`, `input_resolution` and `dimensions`.
+    """
+
+    def __init__(self, model: torch.nn.Module, backend: str):
+        self.backend = backend
+        self.device = model.device
+        self.input_resolution = model.input_resolution
+        self.dimensions = model_dimensions(model)
+        self.dtype = model.dtype
+
+    def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+        raise NotImplementedError
+
+    def encode_text(self, tokens: torch.Tensor) -> torch.Tensor:
+        raise NotImplementedError
+
+
+class _ImageEncoder(torch.nn.Module):
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        return self.model.encode_image(images)
+
+
+class _TextEncoder(torch.nn.Module):
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, tokens: torch.Tensor) -> torch.Tensor:
+        return self.model.encode_text(tokens)
+
+
+def _example_inputs(model: torch.nn.Module, batch_size: int = 2) -> Tuple[torch.Tensor, torch.Tensor]:
+    images = torch.randn(
+        batch_size, 3, model.input_resolution, model.input_resolution,
+        dtype=model.dtype, device=model.device,
+    )
+    tokens = torch.randint(1, 100, (batch_size, model.context_length), device=model.device)
+    # end of text token, which marks the output position
+    tokens[:, -1] = model.vocab_size - 1
+    return images, tokens
+
+
+class ModuleInferenceModel(InferenceModel):
+    """
+    Runs the encoders as (transformed) torch modules
+    """
+
+    def __init__(self, model: torch.nn.Module, backend: str):
+        super().__init__(model, backend)
+        image_encoder = _ImageEncoder(model).eval()
+        text_encoder = _TextEncoder(model).eval()
+
+        if backend == "int8":
+            if str(self.device) != "cpu":
+                raise ValueError("int8 backend is only supported on cpu")
+            model = torch.ao.quantization.quantize_dynamic(
+                copy.deepcopy(model).float(), {torch.nn.Linear}, dtype=torch.qint8,
+            )
+            image_encoder, text_encoder = _ImageEncoder(model).eval(), _TextEncoder(model).eval()
+
+        elif backend == "torchscript":
+            images, tokens = _example_inputs(model)
+            with torch.no_grad():
+                image_encoder = torch.jit.optimize_for_inference(torch.jit.trace(image_encoder, images))
+                text_encoder = torch.jit.optimize_for_inference(torch.jit.trace(text_encoder, tokens))
+
+        elif backend == "compile":
+            if not hasattr(torch, "compile"):
+                raise ValueError(f"compile backend requires torch >= 2.0, found {torch.__version__}")
+            image_encoder = torch.compile(image_encoder, dynamic=True)
+            text_encoder = torch.compile(text_encoder, dynamic=True)
+
+        elif backend != "torch":
+            raise ValueError(f"Invalid backend '{backend}' for {self.__class__.__name__}")
+
+        self._image_encoder = image_encoder
+        self._text_encoder = text_encoder
+
+    def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+        return self._image_encoder(images.to(self.dtype))
+
+    def encode_text(self, tokens: torch.Tensor) -> torch.Tensor:
+        return self._text_encoder(tokens)
+
+
+class OnnxInferenceModel(InferenceModel):
+    """
+    Runs the encoders in onnxruntime.
+
+    The exported ``.onnx`` files are cached in `cache_path`,
+    which defaults to `config.MODEL_CACHE_PATH`/onnx. The filename contains
+    a hash of the torch version and, for checkpoint files, their size and
+    modification time, so a changed checkpoint or exporter is exported again.
+    """
+
+    def __init__(self, model: torch.nn.Module, name: str, cache_path: Optional[Path] = None):
+        super().__init__(model, "onnx")
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnx backend needs `pip install onnxruntime onnx`")
+
+        if str(self.device) != "cpu":
+            raise ValueError("onnx backend is only supported on cpu")
+
+        slug = "".join(c if c.isalnum() else "-" for c in name)
+        digest = self._export_digest(name)
+        images, tokens = _example_inputs(model)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if _num_threads:
+            options.intra_op_num_threads = _num_threads
+
+        self._sessions: Dict[str, "onnxruntime.InferenceSession"] = {}
+        for key, encoder, example_input in (
+                ("image", _ImageEncoder(model).eval(), images.float()),
+                ("text", _TextEncoder(model).eval(), tokens.long()),
+        ):
+            filename = (cache_path or MODEL_CACHE_PATH / "onnx") / f"{slug}-{digest}-{key}.onnx"
+            if not filename.exists():
+                self._export(encoder, example_input, filename)
+
+            self._sessions[key] = onnxruntime.InferenceSession(
+                str(filename), sess_options=options, providers=["CPUExecutionProvider"],
+            )
+
+    @classmethod
+    def _export_digest(cls, name: str) -> str:
+        """
+        Hash of everything besides the name that changes the exported file
+        """
+        values = [name, torch.__version__]
+        if os.path.isfile(name):
+            stat = os.stat(name)
+            values += [stat.st_size, stat.st_mtime_ns]
+        return hashlib.sha1(json.dumps(values).encode()).hexdigest()[:12]
+
+    @classmethod
+    def _export(cls, module: torch.nn.Module, example_input: torch.Tensor, filename: Path):
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        temp_filename = filename.with_suffix(".tmp")
+        kwargs = {}
+        # newer torch versions default to the dynamo exporter, torch < 2.1 has no such argument
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            kwargs["dynamo"] = False
+        with torch.no_grad():
+            torch.onnx.export(
+                module, (example_input, ), str(temp_filename),
+                input_names=["input"], output_names=["output"],
+                dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}},
+                **kwargs,
+            )
+        temp_filename.replace(filename)
+
+    def _run(self, key: str, input: np.ndarray) -> torch.Tensor:
+        output, = self._sessions[key].run(["output"], {"input": input})
+        return torch.from_numpy(output)
+
+    def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+        return self._run("image", images.detach().cpu().float().numpy())
+
+    def encode_text(self, tokens: torch.Tensor) -> torch.Tensor:
+        return self._run("text", tokens.detach().cpu().long().numpy())
+
+
+def create_inference_model(
+        model: torch.nn.Module,
+        backend: str,
+        name: str,
+        cache_path: Optional[Path] = None,
+) -> Union[torch.nn.Module, InferenceModel]:
+    """
+    Wrap a loaded CLIP model for the given backend.
+
+    :param model: the CLIP model as returned by `clip.load`,
+        with the extra attributes `device` and `input_resolution`
+    :param backend: str, one of INFERENCE_BACKENDS
+    :param name: str, the name of the model, used for caching exports
+    :param cache_path: Path, directory for exported models
+    """
+    if backend == "torch":
+        return model
+    elif backend == "onnx":
+        return OnnxInferenceModel(model, name=name, cache_path=cache_path)
+    return ModuleInferenceModel(model, backend)
+
+
+def check_parity(
+        reference: Union[torch.nn.Module, InferenceModel],
+        model: Union[torch.nn.Module, InferenceModel],
+        images: Optional[torch.Tensor] = None,
+        tokens: Optional[torch.Tensor] = None,
+) -> dict:
+    """
+    Compare the embeddings of a backend against the reference model.
+
+    :param reference: the reference model
+    :param model: the model to check
+    :param images: preprocessed images, defaults to random images
+    :param tokens: tokenized texts, defaults to random tokens
+    :return: dict with the minimum and mean cosine similarity for "image" and "text"
+    """
+    example_images, example_tokens = _example_inputs(reference, batch_size=4)
+    if images is None:
+        images = example_images
+    if tokens is None:
+        tokens = example_tokens
+
+    result = {}
+    with torch.no_grad():
+        for key, func_name, input in (
+                ("image", "encode_image", images),
+                ("text", "encode_text", tokens),
+        ):
+            expected = getattr(reference, func_name)(input).float()
+            actual = getattr(model, func_name)(input).float().to(expected.device)
+            similarity = torch.nn.functional.cosine_similarity(expected, actual, dim=-1)
+            result[key] = {
+                "min_cosine": float(similarity.min()),
+                "mean_cosine": float(similarity.mean()),
+            }
+
+    return result
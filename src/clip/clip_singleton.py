@@ -1,37 +1,171 @@
-from typing import List, Tuple
+import os.path
+import threading
+from collections import OrderedDict
+from typing import List, Tuple, Optional
 
 import torch
-import clip
 
+from src.config import CLIP_CACHE_SIZE
 from .device import get_torch_device
+from .backends import parse_device, create_inference_model, model_dimensions
+from .stub import StubClip, parse_stub_name
 
 
-CLIP_MODELS: List[str] = clip.available_models()
+def __getattr__(name: str):
+    # the clip package (torchvision, tokenizer) is only imported when needed
+    if name == "CLIP_MODELS":
+        import clip
+        return clip.available_models()
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
 
+
+# embedding dimensions of the released models,
+# other models (e.g. checkpoint files) are added when loaded
 MODEL_DIMENSIONS = {
+    "RN50": 1024,
+    "RN101": 512,
+    "RN50x4": 640,
+    "RN50x16": 768,
+    "RN50x64": 1024,
     "ViT-B/32": 512,
+    "ViT-B/16": 512,
+    "ViT-L/14": 768,
+    "ViT-L/14@336px": 768,
+    # deterministic fake model, see `stub.py`
+    "stub-512": 512,
 }
 
+
 class ClipSingleton:
+    """
+    Cache of loaded CLIP models.
+
+    Models are loaded on first use and at most `max_models`
+    (model, device) pairs are kept, the least recently used is unloaded.
+    """
+
+    max_models: int = CLIP_CACHE_SIZE
 
-    _models = dict()
+    _models: "OrderedDict[str, Tuple[torch.nn.Module, torch.nn.Module]]" = OrderedDict()
+    _lock = threading.RLock()
 
     @classmethod
-    def get(cls, model: str, device: str) -> Tuple[torch.nn.Module, torch.nn.Module]:
+    def get(cls, model: str, device: str, warm_up: bool = True) -> Tuple[torch.nn.Module, torch.nn.Module]:
         """
         Return CLIP model and preprocessor.
 
-        :param model: str, name
-        :param device: str, a torch device or 'auto'
+        :param model: str, name or path of a checkpoint file
+        :param device: str, a torch device or 'auto', optionally followed by
+            an inference backend, e.g. 'cpu+onnx', see `src.clip.backends`
+        :param warm_up: bool, run a dummy inference after loading,
+            so the first real request does not pay for lazy initialization
         :return: tuple of (Module, Module)
         """
         device = get_torch_device(device)
 
         key = f"{model}/{device}"
 
-        if key not in cls._models:
-            model, preproc = clip.load(name=model, device=device)
-            model.device = device  # store for later use
+        with cls._lock:
+            if key in cls._models:
+                cls._models.move_to_end(key)
+                return cls._models[key]
+
+            torch_device, backend = parse_device(device)
+            if backend != "torch" and parse_stub_name(model) is not None:
+                raise ValueError(f"Stub model '{model}' only supports the 'torch' backend, got '{backend}'")
+            name = model
+            model, preproc = cls._load(name, torch_device)
+            # store for later use
+            model.device = torch_device
+            model.input_resolution = model.visual.input_resolution
+            model.dimensions = model_dimensions(model)
+            MODEL_DIMENSIONS.setdefault(name, model.dimensions)
+
+            model = create_inference_model(model, backend, name=name)
+            if warm_up:
+                cls._warm_up(model)
+
             cls._models[key] = (model, preproc)
+            while len(cls._models) > max(1, cls.max_models):
+                cls._unload(next(iter(cls._models)))
+
+            return cls._models[key]
+
+    @classmethod
+    def _load(cls, name: str, device: str) -> Tuple[torch.nn.Module, torch.nn.Module]:
+        import clip
+        from clip.model import build_model
+
+        if parse_stub_name(name) is not None:
+            model = StubClip.from_name(name).to(device)
+            return model, clip.clip._transform(model.visual.input_resolution)
+
+        if name in clip.available_models() or not os.path.isfile(name):
+            return clip.load(name=name, device=device)
+
+        # a state dict file, `clip.load` only reads it correctly if it's a jit archive
+        state_dict = torch.load(name, map_location="cpu")
+        model = build_model(state_dict).to(device)
+        if str(device) == "cpu":
+            model.float()
+        return model, clip.clip._transform(model.visual.input_resolution)
+
+    @classmethod
+    def dimensions(cls, model: str) -> int:
+        """
+        Return the embedding dimensions of the model.
+        Loads the model on cpu if it's not a known model.
+        """
+        if model not in MODEL_DIMENSIONS:
+            cls.get(model, "cpu", warm_up=False)
+        return MODEL_DIMENSIONS[model]
+
+    @classmethod
+    def loaded(cls) -> List[str]:
+        """
+        Return the "<model>/<device>" keys of the loaded models, least recently used first
+        """
+        with cls._lock:
+            return list(cls._models)
+
+    @classmethod
+    def unload(cls, model: Optional[str] = None, device: Optional[str] = None) -> int:
+        """
+        Remove models from the cache.
+
+        :param model: str, only unload this model, defaults to all models
+        :param device: str, only unload from this device, defaults to all devices
+        :return: int, number of unloaded models
+        """
+        if device is not None and device.startswith("auto"):
+            device = get_torch_device(device)
+
+        with cls._lock:
+            keys = [
+                key for key in cls._models
+                if (model is None or key.rsplit("/", 1)[0] == model)
+                    and (device is None or key.rsplit("/", 1)[1] == device)
+            ]
+            for key in keys:
+                cls._unload(key)
+            return len(keys)
+
+    @classmethod
+    def _unload(cls, key: str):
+        model, _ = cls._models.pop(key)
+        if str(model.device).startswith("cuda"):
+            del model
+            torch.cuda.empty_cache()
+
+    @classmethod
+    def _warm_up(cls, model: torch.nn.Module):
+        import clip
 
-        return cls._models[key]
+        images = torch.zeros(
+            1, 3, model.input_resolution, model.input_resolution,
+            dtype=model.dtype, device=model.device,
+        )
+        tokens = clip.tokenize([""]).to(model.device)
+        with torch.no_grad():
+            model.encode_image(images)
+            model.encode_text(tokens)
@@ -2,10 +2,22 @@ import torch
 
 
 def get_torch_device(device: str = "auto") -> str:
+    """
+    Resolve "auto" and check cuda availability.
+
+    An inference backend suffix (e.g. "cpu+onnx", see `src.clip.backends`) is kept.
+    """
+    backend = None
+    if "+" in device:
+        device, backend = device.split("+", 1)
+
     if device == "auto":
         device = "cuda" if torch.cuda.is_available() else "cpu"
     else:
         if device.startswith("cuda") and not torch.cuda.is_available():
             raise RuntimeError("Cuda device requested but not available")
 
+    if backend:
+        device = f"{device}+{backend}"
+
     return device
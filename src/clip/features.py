@@ -2,12 +2,12 @@ from typing import Union, List, Optional, Iterable
 
 import torch
 import numpy as np
-import clip
 
 from src.config import DEFAULT_CLIP_MODEL
-from src.image import ImageType, resize_crop
+from src.profiling import span
 from .clip_singleton import ClipSingleton
 from .device import get_torch_device
+from .preprocess import preprocess_images, ImageSource
 
 
 def get_text_features(
@@ -27,8 +27,11 @@ def get_text_features(
         if not isinstance(text, list):
             text = list(text)
 
-    tokens = clip.tokenize(text).to(device)
-    with torch.no_grad():
+    import clip
+    with span("clip.tokenize"):
+        tokens = clip.tokenize(text).to(model.device)
+    # .cpu() waits for the device, so the span covers the whole inference
+    with span("clip.inference"), torch.no_grad():
         features = model.encode_text(tokens).cpu().numpy()
 
     # features /= np.linalg.norm(features, axis=-1, keepdims=True)
@@ -40,24 +43,25 @@ def get_text_features(
 
 
 def get_image_features(
-        images: Iterable[ImageType],
+        images: Union[torch.Tensor, Iterable[ImageSource]],
         model: str = DEFAULT_CLIP_MODEL,
         device: str = "auto",
 ) -> np.ndarray:
+    """
+    :param images: filenames, PIL images, arrays or tensors, or a [N, C, H, W] tensor,
+        see `preprocess_images`. Passing filenames allows decoding at reduced size.
+    """
     device = get_torch_device(device)
 
-    if not isinstance(images, (list, tuple)):
-        images = list(images)
-
-    model, preprocess = ClipSingleton.get(model, device)
+    model, _ = ClipSingleton.get(model, device)
 
     with torch.no_grad():
-        resized_images = [
-            preprocess(resize_crop(i, [224, 224]))
-            for i in images
-        ]
-        torch_images = torch.stack(resized_images).to(model.device)
-        features = model.encode_image(torch_images).cpu().numpy()
+        with span("clip.preprocess"):
+            torch_images = preprocess_images(
+                images, resolution=model.input_resolution, device=model.device,
+            )
+        with span("clip.inference"):
+            features = model.encode_image(torch_images).cpu().numpy()
 
     # features /= np.linalg.norm(features, axis=-1, keepdims=True)
 
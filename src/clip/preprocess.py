@@ -0,0 +1,124 @@
+from pathlib import Path
+from typing import Union, Iterable
+
+import numpy as np
+import torch
+import PIL.Image
+
+from src.image import ImageType, resize_crop, image_to_torch
+from src.profiling import span
+
+
+# the normalization of the CLIP preprocessor
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+ImageSource = Union[str, Path, ImageType]
+
+
+def load_image(
+        filename: Union[str, Path],
+        resolution: int = 224,
+) -> PIL.Image.Image:
+    """
+    Open an image file, decoded at a reduced size where the format supports it
+    (JPEG decodes at 1/2, 1/4 or 1/8 scale), but never smaller than `resolution`.
+    """
+    image = PIL.Image.open(filename)
+    image.draft("RGB", (resolution, resolution))
+    return image
+
+
+def _pil_to_hwc(image: PIL.Image.Image, resolution: int) -> np.ndarray:
+    # grayscale is converted after resizing, which is cheaper
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    image = resize_crop(image, [resolution, resolution])
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.asarray(image)
+
+
+def preprocess_images(
+        images: Union[torch.Tensor, Iterable[ImageSource]],
+        resolution: int = 224,
+        device: Union[str, torch.device] = "cpu",
+) -> torch.Tensor:
+    """
+    Fused replacement for ``resize_crop`` + the per-image CLIP ``preprocess``.
+
+    Each image is decoded (at reduced size, see `load_image`), resized and
+    cropped once into one uint8 [N, H, W, 3] buffer, which is then converted
+    and normalized as a single tensor operation on the target device.
+
+    :param images: filenames, PIL images, [C, H, W] arrays or tensors
+        or a [N, C, H, W] tensor. Arrays and tensors follow the convention
+        of `src.image` (first row is the bottom row). uint8 data is expected
+        in the range [0, 255], float data in [0, 1].
+    :param resolution: int, width and height of the result
+    :param device: the device of the result
+    :return: float tensor of shape [N, 3, resolution, resolution]
+    """
+    if isinstance(images, torch.Tensor) and images.ndim == 4:
+        return _normalize(_prepare_tensor(images, resolution).to(device))
+
+    if not isinstance(images, (list, tuple)):
+        images = list(images)
+
+    batch = np.empty((len(images), resolution, resolution, 3), dtype=np.uint8)
+    for i, image in enumerate(images):
+        if isinstance(image, (str, Path)):
+            with span("clip.decode"):
+                image = load_image(image, resolution)
+                # PIL decodes lazily, load now so the time belongs to this span
+                image.load()
+
+        if isinstance(image, PIL.Image.Image):
+            batch[i] = _pil_to_hwc(image, resolution)
+
+        else:
+            if isinstance(image, np.ndarray):
+                image = image_to_torch(image)
+            tensor = _prepare_tensor(image[None, ...], resolution)[0]
+            if tensor.dtype != torch.uint8:
+                tensor = (tensor * 255).round().clamp(0, 255).to(torch.uint8)
+            batch[i] = tensor.permute(1, 2, 0).numpy()
+
+    tensor = torch.from_numpy(batch).to(device).permute(0, 3, 1, 2)
+    return _normalize(tensor)
+
+
+def _prepare_tensor(images: torch.Tensor, resolution: int) -> torch.Tensor:
+    """
+    [N, C, H, W] -> [N, 3, resolution, resolution], dtype is kept
+    """
+    if images.shape[1] == 1:
+        images = images.expand(-1, 3, -1, -1)
+    elif images.shape[1] == 4:
+        images = images[:, :3]
+    elif images.shape[1] != 3:
+        raise ValueError(f"Can't preprocess number of channels {images.shape[1]}")
+
+    # flip Y, see `src.image.image_to_numpy`
+    images = images.flip(-2)
+
+    if images.dtype == torch.uint8:
+        # bicubic resize of uint8 tensors is not supported everywhere
+        images = resize_crop(images.float(), [resolution, resolution])
+        return images.round().clamp(0, 255).to(torch.uint8)
+
+    return resize_crop(images, [resolution, resolution])
+
+
+def _normalize(images: torch.Tensor) -> torch.Tensor:
+    """
+    uint8 [0, 255] or float [0, 1] -> normalized float32
+    """
+    mean = torch.tensor(CLIP_MEAN, device=images.device).view(1, 3, 1, 1)
+    std = torch.tensor(CLIP_STD, device=images.device).view(1, 3, 1, 1)
+
+    if images.dtype == torch.uint8:
+        images = images.float().div_(255.)
+        return images.sub_(mean).div_(std)
+
+    return (images.float() - mean) / std
@@ -0,0 +1,130 @@
+"""
+A fake CLIP model that needs no weights.
+
+The model name ``stub-<dims>`` (e.g. ``stub-512``) can be used wherever a CLIP model
+is expected, e.g. to test or benchmark `ImageDB.update_embeddings`, `SimIndex`
+or the server without network access.
+
+The embeddings are normalized random vectors, seeded by a hash of the image
+pixels or the text tokens, so the same input always gives the same vector.
+They carry no meaning, similar images do not get similar vectors.
+
+Appending ``@<gflops>`` (e.g. ``stub-512@4.4``, about the cost of ViT-B/32)
+adds this many GFLOPs of matrix multiplications per image or text,
+to approximate the compute cost of a real model.
+"""
+import hashlib
+import re
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+
+
+_NAME_RE = re.compile(r"^stub-(\d+)(?:@(\d*\.?\d+))?$")
+
+
+def parse_stub_name(name: str) -> Optional[Tuple[int, float]]:
+    """
+    Return (dimensions, gflops) if `name` is a stub model name, else None
+    """
+    match = _NAME_RE.match(name)
+    if not match:
+        return None
+    return int(match.group(1)), float(match.group(2) or 0.)
+
+
+class _StubVisual(torch.nn.Module):
+
+    def __init__(self, input_resolution: int):
+        super().__init__()
+        self.input_resolution = input_resolution
+
+
+class StubClip(torch.nn.Module):
+    """
+    Has the attributes and the `encode_image`/`encode_text` methods of `clip.model.CLIP`
+    """
+
+    def __init__(
+            self,
+            dimensions: int = 512,
+            gflops: float = 0.,
+            input_resolution: int = 224,
+            context_length: int = 77,
+            vocab_size: int = 49408,
+            width: int = 768,
+            tokens: int = 50,
+    ):
+        """
+        :param dimensions: int, size of the embeddings
+        :param gflops: float, compute cost per image or text
+        :param input_resolution: int, width and height of the preprocessed images
+        :param context_length: int, number of text tokens
+        :param vocab_size: int, size of the token vocabulary
+        :param width: int, size of the matrices that make up the compute cost
+        :param tokens: int, number of rows per image or text in these multiplications,
+            like the sequence length of a transformer (50 for ViT-B/32)
+        """
+        super().__init__()
+        self.dimensions = dimensions
+        self.gflops = gflops
+        self.context_length = context_length
+        self.vocab_size = vocab_size
+        self.visual = _StubVisual(input_resolution)
+        self.tokens = tokens
+        self.num_layers = int(round(gflops * 1e9 / (2 * tokens * width * width)))
+
+        generator = torch.Generator().manual_seed(23)
+        self.weight = torch.nn.Parameter(
+            torch.randn(width, width, generator=generator) / width ** .5, requires_grad=False,
+        )
+        # `model_dimensions` reads the size of the embeddings from here
+        self.text_projection = torch.nn.Parameter(torch.zeros(width, dimensions), requires_grad=False)
+
+    @classmethod
+    def from_name(cls, name: str) -> "StubClip":
+        parsed = parse_stub_name(name)
+        if parsed is None:
+            raise ValueError(f"Invalid stub model name '{name}', expected 'stub-<dims>[@<gflops>]'")
+        return cls(dimensions=parsed[0], gflops=parsed[1])
+
+    @property
+    def dtype(self) -> torch.dtype:
+        return self.weight.dtype
+
+    def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+        """
+        :param images: float tensor of shape [N, 3, input_resolution, input_resolution]
+        :return: tensor of shape [N, dimensions]
+        """
+        # the quantized pixels make the hash independent of small float differences between devices
+        data = (images.detach().float().cpu() * 32).round().to(torch.int16).numpy()
+        return self._encode([row.tobytes() for row in data], images.shape[0])
+
+    def encode_text(self, tokens: torch.Tensor) -> torch.Tensor:
+        """
+        :param tokens: int tensor of shape [N, context_length]
+        :return: tensor of shape [N, dimensions]
+        """
+        data = tokens.detach().cpu().to(torch.int64).numpy()
+        return self._encode([b"text" + row.tobytes() for row in data], tokens.shape[0])
+
+    def _encode(self, keys, batch_size: int) -> torch.Tensor:
+        self._compute(batch_size)
+        vectors = np.empty((len(keys), self.dimensions), dtype=np.float32)
+        for i, key in enumerate(keys):
+            seed = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+            vectors[i] = np.random.default_rng(seed).standard_normal(self.dimensions, dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return torch.from_numpy(vectors).to(device=self.weight.device, dtype=self.dtype)
+
+    def _compute(self, batch_size: int):
+        if not self.num_layers:
+            return
+        x = torch.ones(batch_size * self.tokens, self.weight.shape[0], device=self.weight.device, dtype=self.dtype)
+        with torch.no_grad():
+            for _ in range(self.num_layers):
+                x = torch.tanh(x @ self.weight)
+        # wait for the device
+        x.sum().item()
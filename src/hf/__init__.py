@@ -1,5 +1,6 @@
 from .bark import BarkSpace
 from .results import Result, ImageResult, AudioResult
+from .scheduling import EndpointLimits
 from .space import HuggingfaceSpace
-from .spacepool import SpacePool
+from .spacepool import SpacePool, SpaceJob
 from .stablediffusion import StableDiffusionSpace
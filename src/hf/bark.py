@@ -1,11 +1,8 @@
-import urllib.request
-from io import BytesIO
 from typing import List
 
-import requests
-
 from .space import HuggingfaceSpace
 from .results import AudioResult
+from .download import fetch_all
 
 
 class BarkSpace(HuggingfaceSpace):
@@ -30,14 +27,11 @@ class BarkSpace(HuggingfaceSpace):
         if not (self._result and self._result.get("output") and self._result["output"].get("data")):
             return []
 
-        results = []
-        for result in self._result["output"]["data"]:
-            name = result["name"]
-            url = f"https://suno-bark--r8scr.hf.space/file={name}"
-            response = requests.get(url)
-
-            results.append(
-                AudioResult(mime_type="audio/wav", data=response.content)
-            )
-
-        return results
+        return fetch_all(
+            (
+                f"https://suno-bark--r8scr.hf.space/file={result['name']}"
+                for result in self._result["output"]["data"]
+            ),
+            result_class=AudioResult,
+            mime_type="audio/wav",
+        )
@@ -0,0 +1,122 @@
+"""
+Fetching the outputs of spaces.
+
+All downloads share one `requests.Session`, so connections to the same host
+are kept alive and reused, and the files of one result are fetched concurrently.
+Downloads are streamed into temporary files, ``data:`` uris are decoded directly.
+"""
+import base64
+import concurrent.futures
+import os
+import tempfile
+import threading
+import urllib.parse
+from typing import List, Optional, Type, Iterable
+
+import requests
+import requests.adapters
+
+from .results import Result
+
+
+# number of concurrent downloads, also the number of pooled connections per host
+MAX_DOWNLOADS = 8
+CHUNK_SIZE = 1 << 16
+
+_lock = threading.Lock()
+_session: Optional[requests.Session] = None
+_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+
+def http_session() -> requests.Session:
+    """
+    Return the shared session
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=MAX_DOWNLOADS)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def _get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(MAX_DOWNLOADS, thread_name_prefix="download")
+        return _executor
+
+
+def decode_data_uri(uri: str) -> Result:
+    """
+    Decode ``data:[<mime-type>][;base64],<data>``
+    """
+    header, _, data = uri.partition(",")
+    params = header[len("data:"):].split(";")
+    mime_type = params[0] or "text/plain"
+    if "base64" in params[1:]:
+        return Result(data=base64.b64decode(data), mime_type=mime_type)
+    return Result(data=urllib.parse.unquote_to_bytes(data), mime_type=mime_type)
+
+
+def fetch(
+        url: str,
+        result_class: Type[Result] = Result,
+        mime_type: Optional[str] = None,
+        timeout: float = 60.,
+) -> Result:
+    """
+    Download one output of a space.
+
+    :param url: str, http(s) or data uri
+    :param result_class: the class of the returned result
+    :param mime_type: str, defaults to the mime-type of the data uri or the Content-Type header
+    :param timeout: float, seconds to wait for the server, per read
+    """
+    if url.startswith("data:"):
+        result = decode_data_uri(url)
+        return result_class(data=result.data, mime_type=mime_type or result.mime_type)
+
+    with http_session().get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        mime_type = mime_type or response.headers.get("Content-Type", "application/octet-stream").split(";")[0]
+        fp = tempfile.NamedTemporaryFile(prefix="magic-pen-", delete=False)
+        try:
+            with fp:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    fp.write(chunk)
+        except BaseException:
+            os.remove(fp.name)
+            raise
+
+    return result_class.from_temporary_file(fp.name, mime_type)
+
+
+def fetch_all(
+        urls: Iterable[str],
+        result_class: Type[Result] = Result,
+        mime_type: Optional[str] = None,
+) -> List[Result]:
+    """
+    Download all urls concurrently, see `fetch`.
+
+    :return: list of results in the order of `urls`
+    """
+    urls = list(urls)
+    downloads = [url for url in urls if not url.startswith("data:")]
+    if len(downloads) <= 1:
+        return [fetch(url, result_class, mime_type) for url in urls]
+
+    # data uris are decoded right away
+    futures = [
+        _get_executor().submit(fetch, url, result_class, mime_type)
+        if not url.startswith("data:") else None
+        for url in urls
+    ]
+    return [
+        future.result() if future is not None else fetch(url, result_class, mime_type)
+        for url, future in zip(urls, futures)
+    ]
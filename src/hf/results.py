@@ -1,7 +1,10 @@
 import dataclasses
+import os
+import shutil
+import weakref
 from io import BytesIO
 from pathlib import Path
-from typing import Union
+from typing import Union, Optional, BinaryIO
 
 import PIL.Image
 
@@ -11,10 +14,40 @@ _MIME_EXT_MAPPING = {
 }
 
 
+def _get_umask() -> int:
+    # the umask can only be read by setting it, so this is done once on import
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+_UMASK = _get_umask()
+
+
 @dataclasses.dataclass
 class Result:
-    data: bytes
+    """
+    The output of a space.
+
+    Either `data` holds the bytes or `filename` points to a file
+    (e.g. a download that was streamed to disk, see `download.py`).
+    """
+    data: Optional[bytes]
     mime_type: str
+    filename: Optional[Path] = None
+
+    def __post_init__(self):
+        self._finalizer: Optional[weakref.finalize] = None
+
+    @classmethod
+    def from_temporary_file(cls, filename: Union[str, Path], mime_type: str) -> "Result":
+        """
+        Create a result from a temporary file, which is moved by `save`
+        or deleted with the result
+        """
+        result = cls(data=None, mime_type=mime_type, filename=Path(filename))
+        result._finalizer = weakref.finalize(result, _remove_file, str(filename))
+        return result
 
     @property
     def extension(self) -> str:
@@ -22,16 +55,54 @@ class Result:
         ext = _MIME_EXT_MAPPING.get(ext, ext)
         return ext
 
+    @property
+    def size(self) -> int:
+        if self.data is not None:
+            return len(self.data)
+        return self.filename.stat().st_size
+
+    def open(self) -> BinaryIO:
+        if self.data is not None:
+            return BytesIO(self.data)
+        return open(self.filename, "rb")
+
+    def read(self) -> bytes:
+        if self.data is not None:
+            return self.data
+        return self.filename.read_bytes()
+
     def save(self, filename: Union[str, Path]):
-        with open(filename, "wb") as fp:
-            fp.write(self.data)
+        """
+        Write the result to `filename`.
+        A temporary file is moved there, so the data is never loaded into memory.
+        """
+        if self.data is not None:
+            with open(filename, "wb") as fp:
+                fp.write(self.data)
+
+        elif self._finalizer is not None and self._finalizer.alive:
+            self._finalizer.detach()
+            shutil.move(self.filename, filename)
+            # temporary files are only readable by the owner,
+            # give the file the mode of a newly created one
+            os.chmod(filename, 0o666 & ~_UMASK)
+            self.filename = Path(filename)
+
+        else:
+            shutil.copyfile(self.filename, filename)
+
+
+def _remove_file(filename: str):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
 
 
 class ImageResult(Result):
 
     def to_pil(self) -> PIL.Image.Image:
-        fp = BytesIO(self.data)
-        return PIL.Image.open(fp)
+        return PIL.Image.open(self.open())
 
     def _ipython_display_(self):
         from IPython.display import display
@@ -42,4 +113,4 @@ class AudioResult(Result):
 
     def _ipython_display_(self):
         from IPython.display import Audio, display
-        display(Audio(self.data))
+        display(Audio(self.read()))
@@ -0,0 +1,117 @@
+"""
+asyncio building blocks of the `SpacePool` scheduler.
+
+They are not thread-safe and must be used from the pool's event loop.
+"""
+import asyncio
+import dataclasses
+import heapq
+import itertools
+import time
+from typing import List, Tuple
+
+
+@dataclasses.dataclass
+class EndpointLimits:
+    """
+    Limits for one websocket url
+
+    :param concurrency: int, maximum number of spaces that run at the same time, 0 for no limit
+    :param rate: float, maximum number of new connections per second, 0 for no limit
+    :param burst: int, number of connections that can be opened at once before `rate` applies
+    """
+    concurrency: int = 0
+    rate: float = 0.
+    burst: int = 1
+
+
+class PriorityLimiter:
+    """
+    Like `asyncio.Semaphore` but waiting tasks with a higher priority are served first,
+    tasks of the same priority in order of arrival.
+    """
+
+    def __init__(self, limit: int = 0):
+        """
+        :param limit: int, number of slots, 0 for no limit
+        """
+        self.limit = limit
+        self.active = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: int = 0):
+        if not self.limit or (self.active < self.limit and not self.waiting):
+            self.active += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (-priority, next(self._counter), future))
+        try:
+            # `release` hands the slot over
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # got the slot but nobody will use it
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def slot(self, priority: int = 0) -> "_Slot":
+        """
+        ``async with limiter.slot(priority):``
+        """
+        return _Slot(self, priority)
+
+
+class _Slot:
+
+    def __init__(self, limiter: PriorityLimiter, priority: int):
+        self.limiter = limiter
+        self.priority = priority
+
+    async def __aenter__(self):
+        await self.limiter.acquire(self.priority)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.limiter.release()
+
+
+class TokenBucket:
+    """
+    Allows `rate` acquisitions per second on average and up to `burst` at once
+    """
+
+    def __init__(self, rate: float = 0., burst: int = 1):
+        """
+        :param rate: float, tokens per second, 0 for no limit
+        :param burst: int, maximum number of stored tokens
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last_time = time.monotonic()
+
+    async def acquire(self):
+        if not self.rate:
+            return
+
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_time) * self.rate)
+            self._last_time = now
+            if self._tokens >= 1.:
+                self._tokens -= 1.
+                return
+            await asyncio.sleep((1. - self._tokens) / self.rate)
@@ -1,11 +1,27 @@
+import asyncio
+import hashlib
 import json
 import secrets
 from typing import Iterable, Any, Optional, Callable
 
-import websocket
+import websockets
+
+
+USER_AGENT = "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:106.0) Gecko/20100101 Firefox/106.0"
 
 
 class HuggingfaceSpace:
+    """
+    One request to the queue of a gradio app on huggingface spaces.
+
+    `run_async` talks the gradio queue protocol over a websocket and many
+    spaces can run concurrently in one event loop, see `SpacePool`.
+    `run` is the blocking version for a single request.
+    """
+
+    fn_index: int = 3
+    # the states in which the websocket is closed
+    final_states = ("complete", "queue_full", "error")
 
     def __init__(
             self,
@@ -17,7 +33,7 @@ class HuggingfaceSpace:
         self._result = None
         self.state = "pending"
         self.status = None
-        self._ws: Optional[websocket.WebSocketApp] = None
+        self.error: Optional[str] = None
         self._session_hash: Optional[str] = None
         self.finished: Optional[Callable] = None
 
@@ -30,21 +46,53 @@ class HuggingfaceSpace:
     def result(self):
         return self._result
 
-    def run(self):
-        self._ws = websocket.WebSocketApp(
-            url=self.websocket_url,
-            header={
-                "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:106.0) Gecko/20100101 Firefox/106.0",
-            },
-            on_open=self._on_open,
-            on_close=self._on_close,
-            on_message=self._on_message,
-            on_error=self._on_error,
+    def cache_key(self) -> str:
+        """
+        Hash of the space type, the endpoint and the parameters.
+        Spaces with the same key are expected to produce equivalent results.
+        """
+        data = json.dumps(
+            [self.__class__.__name__, self.websocket_url, self.parameters()],
+            sort_keys=True, default=str,
         )
-        self._ws.run_forever()
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def run(self):
+        asyncio.run(self.run_async())
         if self.finished is not None:
             self.finished()
 
+    async def run_async(self):
+        """
+        Join the queue and wait for the result.
+
+        The `finished` callback is not called here, the caller does that.
+        """
+        self._result = None
+        self.status = None
+        self.error = None
+        try:
+            async with websockets.connect(
+                    self.websocket_url,
+                    user_agent_header=USER_AGENT,
+                    # results are data-uris of several megabytes
+                    max_size=None,
+            ) as ws:
+                self.state = "open"
+                async for message in ws:
+                    reply = self._on_message(json.loads(message))
+                    if reply is not None:
+                        await ws.send(json.dumps(reply))
+                    if self.state in self.final_states:
+                        break
+
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+            self._on_error(f"{type(e).__name__}: {e}")
+            return
+
+        if self.state not in self.final_states:
+            self._on_error("connection closed")
+
     def status_str(self) -> str:
         status = self.state
         if self.state == "wait_queue":
@@ -52,18 +100,28 @@ class HuggingfaceSpace:
                 status = f"{status} {self.status['rank']}/{self.status['queue_size']}"
             except (KeyError, TypeError):
                 pass
+        elif self.state == "retry":
+            try:
+                status = f"{status} {self.status['attempt']} in {self.status['delay']:.0f}s ({self.status['reason']})"
+            except (KeyError, TypeError):
+                pass
         return status
 
-    def _on_message(self, ws, message):
+    def _on_message(self, message: dict) -> Optional[dict]:
+        """
+        Handle a message of the gradio queue and return the reply, if any
+        """
         # print("MSG:", message)
-        message = json.loads(message)
         if message.get("msg") == "send_hash":
             self.state = "connecting"
             self._session_hash = secrets.token_urlsafe(8)
-            self._ws.send(json.dumps({
-                "fn_index": 3,
+            return {
+                "fn_index": self.fn_index,
                 "session_hash": self._session_hash,
-            }))
+            }
+
+        elif message.get("msg") == "queue_full":
+            self.state = "queue_full"
 
         elif message.get("msg") == "estimation":
             # {"msg": "estimation",
@@ -81,11 +139,11 @@ class HuggingfaceSpace:
             }
 
         elif message.get("msg") == "send_data":
-            self._ws.send(json.dumps({
-                "fn_index": 3,
+            return {
+                "fn_index": self.fn_index,
                 "session_hash": self._session_hash,
                 "data": self._parameters,
-            }))
+            }
 
         elif message.get("msg") == "process_starts":
             self.state = "processing"
@@ -93,20 +151,14 @@ class HuggingfaceSpace:
         elif message.get("msg") == "process_completed":
             self.state = "complete"
             self._result = message
+            if message.get("success") is False:
+                self._on_error(str((message.get("output") or {}).get("error")))
             # print(json.dumps(message, indent=2))
 
         else:
             print("UNHANDLED MESSAGE:", message)
 
-    def _on_error(self, ws, error):
+    def _on_error(self, error: str):
         self.state = "error"
+        self.error = error
         # print("error:", error)
-
-    def _on_close(self, ws, close_status_code, close_msg):
-        pass
-        # self.state = "closed"
-        # print("### closed ###")
-
-    def _on_open(self, ws):
-        self.state = "open"
-        # print("Opened connection")
@@ -1,18 +1,175 @@
-import os
+import asyncio
+import collections
+import concurrent.futures
+import random
 import threading
-import queue
-from typing import List, Callable
+import time
+import traceback
+from typing import Callable, Deque, Dict, Optional, Set, Union
 
 from .space import HuggingfaceSpace
+from .scheduling import EndpointLimits, PriorityLimiter, TokenBucket
+
+
+class SpaceJob:
+    """
+    A space scheduled by `SpacePool.run`
+    """
+
+    def __init__(
+            self,
+            space: HuggingfaceSpace,
+            priority: int = 0,
+            timeout: Optional[float] = None,
+    ):
+        self.space = space
+        self.priority = priority
+        self.timeout = timeout
+        self.submitted_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.attempts = 0
+        # "queued", "running", "retry" or "done"
+        self.phase = "queued"
+        self.future: Optional[concurrent.futures.Future] = None
+        self._done = threading.Event()
+        # set by the pool
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._cancel_requested = False
+
+    @classmethod
+    def completed(cls, space: HuggingfaceSpace, finished: Optional[Callable] = None) -> "SpaceJob":
+        """
+        Return a finished job for a space that is not run, e.g. because its results are stored.
+
+        :param finished: callable, called in a new thread, like the `finished` callbacks
+            of the spaces in `SpacePool`. The job is done when it returned.
+        """
+        job = cls(space)
+        job.phase = "done"
+        job.finished_at = job.submitted_at
+        if finished is None:
+            job._done.set()
+        else:
+            def _finish():
+                try:
+                    finished()
+                finally:
+                    job._done.set()
+
+            threading.Thread(name=f"{cls.__name__}-finished", target=_finish, daemon=True).start()
+        return job
+
+    @property
+    def endpoint(self) -> str:
+        return self.space.websocket_url
+
+    def cancel(self):
+        """
+        Cancel the job, the websocket is closed if the space is running.
+        The `finished` callback of the space is still called.
+        """
+        if self._loop is not None and not self.done():
+            self._loop.call_soon_threadsafe(self._cancel)
+
+    def _cancel(self):
+        # the task might not have started yet
+        self._cancel_requested = True
+        if self._task is not None:
+            self._task.cancel()
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until the job and the `finished` callback are done
+
+        :return: bool, False on timeout
+        """
+        return self._done.wait(timeout)
+
+    def result(self, timeout: Optional[float] = None) -> HuggingfaceSpace:
+        """
+        Wait for the job and return the space
+
+        :raises TimeoutError: if the job is not done within `timeout`
+        """
+        if not self.wait(timeout):
+            raise TimeoutError(f"{self.space} not finished after {timeout} seconds")
+        return self.space
+
+
+class _EndpointStats:
+
+    def __init__(self):
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        # seconds from submission to the end of the last attempt of completed jobs
+        self.latencies: Deque[float] = collections.deque(maxlen=100)
+        # seconds from submission to the first connection
+        self.wait_times: Deque[float] = collections.deque(maxlen=100)
 
 
 class SpacePool:
+    """
+    Runs `HuggingfaceSpace`s concurrently in one asyncio event loop
+    in a background thread.
 
-    def __init__(self, size: int = 0):
-        self._threads: List[threading.Thread] = []
-        self._do_stop = None
-        self._queue = queue.Queue()
-        self._size = size or os.cpu_count()
+    Waiting in a gradio queue costs only an open websocket, so hundreds
+    of spaces can wait at the same time. The scheduler
+
+    - limits the number of concurrent spaces in total and per websocket url (endpoint)
+    - limits the rate of new connections per endpoint with a token bucket
+    - starts jobs with higher priority first
+    - retries spaces that failed or found the queue full, with exponential backoff
+    - cancels jobs after their timeout
+
+    The `finished` callbacks of the spaces are called in a thread pool,
+    once per job, whatever the outcome.
+    """
+
+    def __init__(
+            self,
+            size: int = 0,
+            max_per_endpoint: int = 0,
+            rate_per_endpoint: float = 0.,
+            endpoint_limits: Optional[Dict[str, Union[int, EndpointLimits]]] = None,
+            max_retries: int = 5,
+            backoff: float = 1.,
+            max_backoff: float = 60.,
+    ):
+        """
+        :param size: int, maximum number of spaces that run at the same time, 0 for no limit
+        :param max_per_endpoint: int, maximum number of spaces with the same websocket url
+            that run at the same time, 0 for no limit
+        :param rate_per_endpoint: float, maximum number of connections per second
+            to the same websocket url, 0 for no limit
+        :param endpoint_limits: dict of websocket url -> EndpointLimits (or int for the concurrency),
+            overrides the defaults above
+        :param max_retries: int, number of retries after an error or a full queue
+        :param backoff: float, seconds before the first retry, doubled for each further retry
+        :param max_backoff: float, maximum seconds between two attempts
+        """
+        self._size = size
+        self.default_limits = EndpointLimits(concurrency=max_per_endpoint, rate=rate_per_endpoint)
+        self.endpoint_limits = {
+            url: limits if isinstance(limits, EndpointLimits) else EndpointLimits(concurrency=limits)
+            for url, limits in (endpoint_limits or {}).items()
+        }
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._jobs: Set[SpaceJob] = set()
+        self._stats: Dict[str, _EndpointStats] = {}
+        # only accessed from the event loop
+        self._limiters: Dict[Optional[str], PriorityLimiter] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
 
     def __enter__(self):
         self.start()
@@ -26,53 +183,192 @@ class SpacePool:
         return self._size
 
     def running(self) -> bool:
-        return bool(self._threads)
+        return self._thread is not None
 
     def start(self):
         if self.running():
             return
 
-        self._do_stop = False
-        self._start()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            name=self.__class__.__name__, target=self._loop.run_forever, daemon=True,
+        )
+        self._thread.start()
 
     def stop(self, join_queue: bool = True):
-        if not self.running() or self._do_stop:
+        """
+        Stop the event loop.
+
+        :param join_queue: bool, wait for all spaces to finish, otherwise they are cancelled
+        """
+        if not self.running():
             return
 
-        self._queue.put({"stop": True})
+        with self._lock:
+            jobs = list(self._jobs)
+        for job in jobs:
+            if not join_queue:
+                job.cancel()
+            job.wait()
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        self._thread = None
+        self._limiters.clear()
+        self._buckets.clear()
 
-        if join_queue:
-            self._queue.join()
+    def run(
+            self,
+            space: HuggingfaceSpace,
+            priority: int = 0,
+            timeout: Optional[float] = None,
+    ) -> SpaceJob:
+        """
+        Schedule the space, this returns immediately.
 
-        self._do_stop = True
-        self._stop()
+        :param space: HuggingfaceSpace
+        :param priority: int, jobs with higher priority are started first
+        :param timeout: float, seconds after which the job is cancelled,
+            including the time waiting for the start and between retries
+        :return: SpaceJob
+        """
+        if not self.running():
+            raise RuntimeError(f"{self.__class__.__name__} is not started")
 
-    def run(self, space: HuggingfaceSpace):
-        self._queue.put_nowait({"space": space})
+        job = SpaceJob(space, priority=priority, timeout=timeout)
+        job._loop = self._loop
+        with self._lock:
+            self._jobs.add(job)
+            self._stats.setdefault(job.endpoint, _EndpointStats())
+        job.future = asyncio.run_coroutine_threadsafe(self._run(job), self._loop)
+        job.future.add_done_callback(self._on_done)
+        return job
 
-    def _start(self):
-        self._threads = [
-            threading.Thread(name=f"{self.__class__.__name__}-{i+1}/{self.size}", target=self._mainloop)
-            for i in range(self._size)
-        ]
-        for t in self._threads:
-            t.start()
+    def num_running(self) -> int:
+        """
+        Number of spaces that are scheduled and not finished
+        """
+        with self._lock:
+            return len(self._jobs)
 
-    def _stop(self):
-        for t in self._threads:
-            t.join()
+    def metrics(self) -> dict:
+        """
+        Return the queue depth and latencies, in total and per endpoint.
 
-    def _mainloop(self):
-        while not self._do_stop:
+        - "queued": jobs waiting for a free slot or the rate limit
+        - "running": jobs connected to the endpoint
+        - "retry": jobs waiting for the next attempt
+        - "completed", "failed", "retries": counts since start
+        - "latency": average seconds from submission to result of the last 100 completed jobs
+        - "wait": average seconds from submission to the first connection of the last 100 jobs
+        """
+        def _mean(values) -> Optional[float]:
+            return round(sum(values) / len(values), 3) if values else None
+
+        with self._lock:
+            endpoints = {}
+            for url, stats in self._stats.items():
+                jobs = [job for job in self._jobs if job.endpoint == url]
+                endpoints[url] = {
+                    "queued": sum(1 for job in jobs if job.phase == "queued"),
+                    "running": sum(1 for job in jobs if job.phase == "running"),
+                    "retry": sum(1 for job in jobs if job.phase == "retry"),
+                    "completed": stats.completed,
+                    "failed": stats.failed,
+                    "retries": stats.retries,
+                    "latency": _mean(stats.latencies),
+                    "wait": _mean(stats.wait_times),
+                }
+            latencies = [v for stats in self._stats.values() for v in stats.latencies]
+            wait_times = [v for stats in self._stats.values() for v in stats.wait_times]
+
+        metrics = {
+            key: sum(e[key] for e in endpoints.values())
+            for key in ("queued", "running", "retry", "completed", "failed", "retries")
+        }
+        metrics["latency"] = _mean(latencies)
+        metrics["wait"] = _mean(wait_times)
+        metrics["endpoints"] = endpoints
+        return metrics
+
+    async def _run(self, job: SpaceJob):
+        space = job.space
+        job._task = asyncio.current_task()
+        try:
             try:
-                action = self._queue.get(timeout=.5)
+                if job._cancel_requested:
+                    raise asyncio.CancelledError()
+                await asyncio.wait_for(self._attempts(job), job.timeout)
+            except asyncio.TimeoutError:
+                space.state = "timeout"
+            except asyncio.CancelledError:
+                space.state = "cancelled"
+
+            job.phase = "done"
+            job.finished_at = time.monotonic()
+            with self._lock:
+                stats = self._stats[job.endpoint]
+                if space.state == "complete":
+                    stats.completed += 1
+                    stats.latencies.append(job.finished_at - job.submitted_at)
+                else:
+                    stats.failed += 1
+
+            if space.finished is not None:
+                # the callbacks download results and write files
+                await asyncio.get_running_loop().run_in_executor(None, space.finished)
+
+        finally:
+            with self._lock:
+                self._jobs.discard(job)
+            job._done.set()
+
+    async def _attempts(self, job: SpaceJob):
+        space = job.space
+        limits = self.endpoint_limits.get(job.endpoint, self.default_limits)
+
+        while True:
+            job.phase = "queued"
+            job.attempts += 1
+            # the global slot is taken last, so that jobs waiting for a busy
+            # or rate-limited endpoint do not block the jobs of other endpoints
+            async with self._limiter(job.endpoint, limits.concurrency).slot(job.priority):
+                await self._bucket(job.endpoint, limits).acquire()
+
+                async with self._limiter(None, self._size).slot(job.priority):
+                    job.phase = "running"
+                    if job.started_at is None:
+                        job.started_at = time.monotonic()
+                        with self._lock:
+                            self._stats[job.endpoint].wait_times.append(job.started_at - job.submitted_at)
+
+                    await space.run_async()
+
+            if space.state not in ("error", "queue_full") or job.attempts > self.max_retries:
+                return
+
+            # jitter, so that jobs which failed together do not retry together
+            delay = min(self.max_backoff, self.backoff * 2 ** (job.attempts - 1))
+            delay *= .5 + random.random() / 2
+            job.phase = "retry"
+            space.state = "retry"
+            space.status = {"attempt": job.attempts, "reason": space.error or "queue full", "delay": delay}
+            with self._lock:
+                self._stats[job.endpoint].retries += 1
+            await asyncio.sleep(delay)
 
-                if action.get("space"):
-                    action["space"].run()
+    def _limiter(self, key: Optional[str], limit: int) -> PriorityLimiter:
+        if key not in self._limiters:
+            self._limiters[key] = PriorityLimiter(limit)
+        return self._limiters[key]
 
-                if action.get("stop"):
-                    self._do_stop = True
+    def _bucket(self, endpoint: str, limits: EndpointLimits) -> TokenBucket:
+        if endpoint not in self._buckets:
+            self._buckets[endpoint] = TokenBucket(rate=limits.rate, burst=limits.burst)
+        return self._buckets[endpoint]
 
-                self._queue.task_done()
-            except queue.Empty:
-                pass
+    def _on_done(self, future: concurrent.futures.Future):
+        if not future.cancelled() and future.exception() is not None:
+            traceback.print_exception(future.exception())
@@ -1,11 +1,8 @@
-import urllib.request
-from io import BytesIO
 from typing import List
 
-import PIL.Image
-
 from .space import HuggingfaceSpace
 from .results import ImageResult
+from .download import fetch_all
 
 
 class StableDiffusionSpace(HuggingfaceSpace):
@@ -32,16 +29,7 @@ class StableDiffusionSpace(HuggingfaceSpace):
         if not (self._result and self._result.get("output") and self._result["output"].get("data")):
             return []
 
-        images = []
-        for results in self._result["output"]["data"]:
-            for uri in results:
-                mime_type = uri.split(";", 1)[0].split(":")[-1]
-
-                response = urllib.request.urlopen(uri)
-                data = response.fp.read()
-
-                images.append(
-                    ImageResult(mime_type=mime_type, data=data)
-                )
-
-        return images
+        return fetch_all(
+            (uri for results in self._result["output"]["data"] for uri in results),
+            result_class=ImageResult,
+        )
@@ -1,31 +1,45 @@
 import os
+import sys
 from pathlib import Path
-from typing import Union, List, Type
+from typing import Union, List, Type, Optional, Sequence, TYPE_CHECKING
 
 import numpy as np
-import torch
-import torchvision.transforms.functional as VT
 import PIL.Image
 
+# torch is imported on first use, it takes seconds to load
+if TYPE_CHECKING:
+    import torch
 
-ImageType = Union[PIL.Image.Image, np.ndarray, torch.Tensor]
+
+ImageType = Union[PIL.Image.Image, np.ndarray, "torch.Tensor"]
 
 
 def is_image_filename(filename: Union[str, Path]):
     if isinstance(filename, Path):
         ext = filename.suffix
     else:
-        ext = os.path.splitext(filename)
+        _, ext = os.path.splitext(filename)
 
     return ext.lower() in PIL.Image.registered_extensions()
 
 
+def _is_tensor(obj) -> bool:
+    # if torch was never imported, obj can not be a tensor
+    torch = sys.modules.get("torch")
+    return torch is not None and isinstance(obj, torch.Tensor)
+
+
 def image_to_pil(image: ImageType) -> PIL.Image.Image:
+    """
+    Convert a [C, H, W] or [H, W] array or tensor to a PIL image.
+
+    Anything else than uint8 is clipped to [0, 255].
+    """
     if isinstance(image, PIL.Image.Image):
         return image
 
-    elif isinstance(image, torch.Tensor):
-        data = image.cpu().detach().numpy()
+    elif _is_tensor(image):
+        data = image.detach().cpu().numpy()
 
     elif isinstance(image, np.ndarray):
         data = image
@@ -33,25 +47,19 @@ def image_to_pil(image: ImageType) -> PIL.Image.Image:
     else:
         raise TypeError(f"Can't convert image of type '{type(image).__name__}'")
 
-    channels = data.shape[0]
     if data.ndim == 2:
-        mode = "L"
         data = data.reshape((1, *data.shape))
-        channels = 1
 
-    elif channels == 1:
-        mode = "L"
+    elif data.ndim != 3:
+        raise ValueError(f"Can't convert array of shape {data.shape}, use `batch_to_pil` for batches")
 
-    elif channels == 3:
-        mode = "RGB"
-
-    elif channels == 4:
-        mode = "RGBA"
-
-    else:
+    channels = data.shape[0]
+    if channels not in (1, 3, 4):
         raise ValueError(f"Can't convert number of channels {channels}")
 
-    data = np.clip(data, 0, 255).astype(np.int8)
+    if data.dtype != np.uint8:
+        data = np.clip(data, 0, 255).astype(np.uint8)
+
     # [C, H, W] -> [H, W, C]
     data = data.transpose(1, 2, 0)
 
@@ -59,79 +67,158 @@ def image_to_pil(image: ImageType) -> PIL.Image.Image:
     data = data[::-1, ...]
 
     if channels == 1:
-        data = data.squeeze()
+        data = data[..., 0]
 
-    return PIL.Image.fromarray(data, mode=mode)
+    return PIL.Image.fromarray(np.ascontiguousarray(data))
 
 
-def image_to_numpy(image: ImageType) -> np.ndarray:
-    if isinstance(image, PIL.Image.Image):
-        data = np.array(image.getdata())
+def batch_to_pil(images: Union[np.ndarray, "torch.Tensor", Sequence[ImageType]]) -> List[PIL.Image.Image]:
+    """
+    Convert a [N, C, H, W] array or tensor or a list of images to a list of PIL images.
+    """
+    return [image_to_pil(i) for i in images]
+
 
-        if image.mode == "L":
-            data = data.reshape(image.height, image.width, 1)
+def image_to_numpy(
+        image: Union[ImageType, Sequence[ImageType]],
+        dtype: Optional[Union[str, np.dtype]] = None,
+) -> np.ndarray:
+    """
+    Convert to a [C, H, W] array, or a list of images to a [N, C, H, W] array.
 
-        elif image.mode == "RGB":
-            data = data.reshape(image.height, image.width, 3)
+    PIL images are converted with a single copy of the pixel buffer,
+    flipping and transposing are views. Tensors on the CPU and arrays
+    share their memory with the result, unless `dtype` requires a conversion.
 
-        elif image.mode == "RGBA":
-            data = data.reshape(image.height, image.width, 4)
+    :param image: PIL image, [C, H, W] array or tensor or a list of those
+    :param dtype: the dtype of the result, defaults to the dtype of the source
+        (uint8 for PIL images). The value range is not changed.
+    """
+    if isinstance(image, (list, tuple)):
+        if not image:
+            raise ValueError("Can't convert empty list of images")
 
-        else:
+        first = image_to_numpy(image[0], dtype=dtype)
+        batch = np.empty((len(image), *first.shape), dtype=first.dtype)
+        batch[0] = first
+        for i, single_image in enumerate(image[1:]):
+            batch[i + 1] = image_to_numpy(single_image, dtype=dtype)
+        return batch
+
+    if isinstance(image, PIL.Image.Image):
+        if image.mode not in ("L", "RGB", "RGBA"):
             raise ValueError(f"Can't convert image of mode '{image.mode}'")
 
+        data = np.asarray(image)
+        if data.ndim == 2:
+            data = data[..., None]
+
         # flip Y
         data = data[::-1, ...]
         # [H, W, C] -> [C, H, W]
         data = data.transpose(2, 0, 1)
 
-        return data
-
-    elif isinstance(image, torch.Tensor):
-        return image.numpy()
+    elif _is_tensor(image):
+        data = image.detach().cpu().numpy()
 
     elif isinstance(image, np.ndarray):
-        return image
+        data = image
 
     else:
         raise TypeError(f"Can't convert image of type '{type(image).__name__}'")
 
+    if dtype is not None and data.dtype != dtype:
+        data = data.astype(dtype)
 
-def image_to_torch(image: ImageType) -> torch.Tensor:
-    array = image_to_numpy(image)
-    if array.strides:
-        array = array.copy()
-    return torch.Tensor(array)
+    return data
+
+
+def image_to_torch(
+        image: Union[ImageType, Sequence[ImageType]],
+        dtype: Optional["torch.dtype"] = None,
+) -> "torch.Tensor":
+    """
+    Convert to a [C, H, W] tensor, or a list of images to a [N, C, H, W] tensor.
+
+    Arrays are shared with the tensor if their memory layout allows it,
+    otherwise they are copied once.
+
+    :param image: PIL image, [C, H, W] array or tensor or a list of those
+    :param dtype: the dtype of the result, defaults to the dtype of the source
+        (uint8 for PIL images). The value range is not changed.
+    """
+    import torch
+
+    if isinstance(image, torch.Tensor):
+        tensor = image
+
+    else:
+        array = image_to_numpy(image)
+        # torch does not support negative strides or read-only memory
+        if any(s < 0 for s in array.strides) or not array.flags.writeable:
+            array = array.copy()
+        tensor = torch.from_numpy(array)
+
+    if dtype is not None:
+        tensor = tensor.to(dtype)
+
+    return tensor
 
 
 def resize_crop(
-        image: Union[torch.Tensor, PIL.Image.Image],
+        image: Union["torch.Tensor", PIL.Image.Image],
         resolution: List[int],
-) -> Union[torch.Tensor, PIL.Image.Image]:
+        reducing_gap: Optional[float] = None,
+) -> Union["torch.Tensor", PIL.Image.Image]:
+    """
+    Scale the shorter side to ``max(resolution)`` and crop the center to `resolution`.
+
+    PIL images are resampled once, with the crop box applied during resizing.
+    Tensors can be single images [C, H, W] or batches [N, C, H, W],
+    the crop is a view into the resized tensor.
+
+    :param image: PIL image or tensor
+    :param resolution: [width, height] of the result
+    :param reducing_gap: float, passed to `PIL.Image.resize` to speed up
+        large down-scaling at the cost of some quality
+    """
     if isinstance(image, PIL.Image.Image):
         width, height = image.width, image.height
     else:
         width, height = image.shape[-1], image.shape[-2]
 
-    if width != resolution[0] or height != resolution[1]:
+    if width == resolution[0] and height == resolution[1]:
+        return image
+
+    if width < height:
+        factor = max(resolution) / width
+    else:
+        factor = max(resolution) / height
+
+    scaled_width, scaled_height = int(round(width * factor)), int(round(height * factor))
+    left = int(round((scaled_width - resolution[0]) / 2.))
+    top = int(round((scaled_height - resolution[1]) / 2.))
 
-        if width < height:
-            factor = max(resolution) / width
-        else:
-            factor = max(resolution) / height
+    if isinstance(image, PIL.Image.Image):
+        return image.resize(
+            tuple(resolution),
+            resample=PIL.Image.BICUBIC,
+            box=(
+                left / factor,
+                top / factor,
+                (left + resolution[0]) / factor,
+                (top + resolution[1]) / factor,
+            ),
+            reducing_gap=reducing_gap,
+        )
 
+    if scaled_width != width or scaled_height != height:
+        import torchvision.transforms.functional as VT
         image = VT.resize(
             image,
-            [int(height * factor), int(width * factor)],
+            [scaled_height, scaled_width],
             interpolation=VT.InterpolationMode.BICUBIC,
+            antialias=True,
         )
 
-        if isinstance(image, PIL.Image.Image):
-            width, height = image.width, image.height
-        else:
-            width, height = image.shape[-1], image.shape[-2]
-
-        if width != resolution[0] or height != resolution[1]:
-            image = VT.center_crop(image, resolution)
-
-    return image
+    return image[..., top: top + resolution[1], left: left + resolution[0]]
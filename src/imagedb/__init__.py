@@ -1,3 +1,44 @@
-from .imagedb import ImageDB
-from .imagesql import ImageEntry, Embedding, ImageTag
-from .simindex import SimIndex
+"""
+The exported names are imported on first access, so that e.g.
+the daemon client does not need to load sqlalchemy, faiss or CLIP.
+"""
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .imagedb import ImageDB
+    from .imagesql import ImageEntry, Embedding, ImageTag
+    from .simindex import SimIndex
+    from .sqlengine import SqliteProfile
+    from .backends import DatabaseBackend, SqliteBackend, PostgresBackend
+    from .daemon import ImageDBDaemon, DaemonClient, DaemonError
+    from .export import export_embeddings, import_embeddings, EXPORT_FORMATS
+    from .ingest import IngestSink
+
+
+_EXPORTS = {
+    "ImageDB": ".imagedb",
+    "ImageEntry": ".imagesql",
+    "Embedding": ".imagesql",
+    "ImageTag": ".imagesql",
+    "SimIndex": ".simindex",
+    "SqliteProfile": ".sqlengine",
+    "DatabaseBackend": ".backends",
+    "SqliteBackend": ".backends",
+    "PostgresBackend": ".backends",
+    "ImageDBDaemon": ".daemon",
+    "DaemonClient": ".daemon",
+    "DaemonError": ".daemon",
+    "export_embeddings": ".export",
+    "import_embeddings": ".export",
+    "EXPORT_FORMATS": ".export",
+    "IngestSink": ".ingest",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str):
+    if name in _EXPORTS:
+        return getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
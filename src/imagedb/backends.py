@@ -0,0 +1,291 @@
+import csv
+import io
+import os
+from pathlib import Path
+from typing import Optional, List, Tuple, Sequence, Hashable
+
+import sqlalchemy as sq
+
+from .imagesql import Embedding, StatCounter
+from .migrations import upgrade_schema
+from .sqlengine import SqliteProfile
+
+
+class DatabaseBackend:
+    """
+    Creates the engine for an `ImageDB` and implements
+    the things that differ between database systems.
+    """
+
+    # name of the sqlalchemy dialect
+    name: str = None
+    # True if `vector_search` is implemented
+    supports_vector_search: bool = False
+
+    def __init__(self, thread_sessions: bool = True):
+        self.thread_sessions = thread_sessions
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "DatabaseBackend":
+        """
+        Create a backend from a sqlalchemy database url,
+        e.g. ``sqlite:////path/to/db.sqlite`` or ``postgresql+psycopg://user:pw@host/db``
+        """
+        url_obj = sq.engine.make_url(url)
+        if url_obj.get_backend_name() == "sqlite":
+            return SqliteBackend(filename=Path(url_obj.database), **kwargs)
+        elif url_obj.get_backend_name() == "postgresql":
+            return PostgresBackend(url=url, **kwargs)
+        raise ValueError(f"Unsupported database '{url_obj.get_backend_name()}' in url '{url}'")
+
+    def create_engine(self, read_only: bool = False) -> sq.Engine:
+        raise NotImplementedError
+
+    def create_schema(self, engine: sq.Engine, verbose: bool = False):
+        """
+        Create the tables or upgrade them to the current schema version
+        """
+        upgrade_schema(engine, verbose=verbose)
+
+    def database_size(self, connection: sq.Connection) -> Optional[int]:
+        """
+        Return the size of the database in bytes, if known
+        """
+        return None
+
+    def change_token(self, connection: sq.Connection) -> Hashable:
+        """
+        Return a value that changes when the content of the database changes.
+        The default is the snapshot of the row counters, which does not see
+        updates that keep the number of rows.
+        """
+        return tuple(
+            connection.execute(
+                sq.select(StatCounter.name, StatCounter.value).order_by(StatCounter.name)
+            ).all()
+        )
+
+    def begin_snapshot(self, connection: sq.Connection):
+        """
+        Start a transaction on the fresh `connection` in which all reads
+        see the same state of the database, e.g. for an export in chunks.
+        The default is the REPEATABLE READ isolation level.
+        """
+        connection.execution_options(isolation_level="REPEATABLE READ")
+
+    def bulk_insert(self, connection: sq.Connection, table: sq.Table, rows: List[dict]):
+        """
+        Insert many rows in one go, within the connection's transaction.
+        The default is a plain ``executemany``.
+        """
+        if rows:
+            connection.execute(table.insert(), rows)
+
+    def vector_search(
+            self,
+            connection: sq.Connection,
+            model: str,
+            vector: Sequence[float],
+            count: int,
+    ) -> List[Tuple[int, float]]:
+        """
+        Return the `count` most similar (image_id, score) tuples
+        by inner product, computed by the database server.
+        """
+        raise NotImplementedError(f"{self.__class__.__name__} does not support vector search")
+
+
+class SqliteBackend(DatabaseBackend):
+
+    name = "sqlite"
+
+    def __init__(
+            self,
+            filename: Path,
+            profile: Optional[SqliteProfile] = None,
+    ):
+        self.filename = Path(filename)
+        self.profile = profile if profile is not None else SqliteProfile()
+        super().__init__(thread_sessions=self.profile.thread_sessions)
+
+    def create_engine(self, read_only: bool = False) -> sq.Engine:
+        os.makedirs(self.filename.parent, exist_ok=True)
+        return self.profile.create_engine(self.filename, read_only=read_only)
+
+    def _files(self) -> List[Path]:
+        return [
+            filename
+            for filename in (
+                self.filename,
+                self.filename.with_name(self.filename.name + "-wal"),
+                self.filename.with_name(self.filename.name + "-shm"),
+            )
+            if filename.exists()
+        ]
+
+    def database_size(self, connection: sq.Connection) -> Optional[int]:
+        return sum(filename.stat().st_size for filename in self._files())
+
+    def begin_snapshot(self, connection: sq.Connection):
+        # pysqlite only begins transactions before writes,
+        # the snapshot of an explicit transaction starts with the first read
+        connection.exec_driver_sql("BEGIN")
+
+    def change_token(self, connection: sq.Connection) -> Hashable:
+        # every commit changes the database or its write-ahead log,
+        # the -shm file also changes on reads
+        return tuple(
+            (filename.name, filename.stat().st_mtime_ns, filename.stat().st_size)
+            for filename in self._files()
+            if not filename.name.endswith("-shm")
+        )
+
+
+class PostgresBackend(DatabaseBackend):
+    """
+    PostgreSQL with pooled connections.
+
+    If the `pgvector <https://github.com/pgvector/pgvector-python>`_ package
+    is installed (and ``use_pgvector`` is not False) the embeddings are stored
+    as ``vector`` and can be searched on the server, otherwise as ``REAL[]``.
+    """
+
+    name = "postgresql"
+
+    def __init__(
+            self,
+            url: str,
+            pool_size: int = 10,
+            max_overflow: int = 20,
+            use_pgvector: Optional[bool] = None,
+            thread_sessions: bool = True,
+    ):
+        super().__init__(thread_sessions=thread_sessions)
+        self.url = url
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        if use_pgvector is None:
+            try:
+                import pgvector.sqlalchemy
+                use_pgvector = True
+            except ImportError:
+                use_pgvector = False
+        self.use_pgvector = use_pgvector
+        self.supports_vector_search = use_pgvector
+
+    def create_engine(self, read_only: bool = False) -> sq.Engine:
+        engine = sq.create_engine(
+            self.url,
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_pre_ping=True,
+        )
+        if read_only:
+            @sq.event.listens_for(engine, "connect")
+            def _on_connect(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                cursor.execute("SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY")
+                cursor.close()
+                dbapi_connection.commit()
+
+        return engine
+
+    def create_schema(self, engine: sq.Engine, verbose: bool = False):
+        if self.use_pgvector:
+            with engine.begin() as conn:
+                conn.execute(sq.text("CREATE EXTENSION IF NOT EXISTS vector"))
+        super().create_schema(engine, verbose=verbose)
+
+    def database_size(self, connection: sq.Connection) -> Optional[int]:
+        return connection.execute(sq.text("SELECT pg_database_size(current_database())")).scalar()
+
+    def create_vector_index(self, engine: sq.Engine, model: str, dimensions: int):
+        """
+        Create an HNSW index for the embeddings of one model.
+
+        The `embedding.data` column holds vectors of different lengths
+        so the index is built on a cast expression, restricted to the model.
+        """
+        if not self.use_pgvector:
+            raise RuntimeError("Vector indices require pgvector")
+
+        name = "ix_embedding_hnsw_" + "".join(c if c.isalnum() else "_" for c in model.lower())
+        # index predicates can not be bound parameters
+        model_literal = model.replace("'", "''")
+        with engine.begin() as conn:
+            conn.execute(sq.text(
+                f"CREATE INDEX IF NOT EXISTS {name} ON embedding"
+                f" USING hnsw ((data::vector({int(dimensions)})) vector_ip_ops)"
+                f" WHERE model = '{model_literal}'"
+            ))
+
+    def bulk_insert(self, connection: sq.Connection, table: sq.Table, rows: List[dict]):
+        """
+        Stream the rows with ``COPY ... FROM STDIN``.
+        """
+        if not rows:
+            return
+
+        columns = list(rows[0].keys())
+
+        # COPY does not fire the client-side sequence defaults of sqlalchemy
+        for column in table.primary_key.columns:
+            if column.name not in columns and isinstance(column.default, sq.Sequence):
+                ids = connection.execute(
+                    sq.text(f"SELECT nextval('{column.default.name}') FROM generate_series(1, :n)"),
+                    {"n": len(rows)},
+                ).scalars().all()
+                rows = [{**row, column.name: id} for row, id in zip(rows, ids)]
+                columns.append(column.name)
+
+        sql = f"COPY {table.name} ({', '.join(columns)}) FROM STDIN"
+
+        def _value(column: str, value):
+            if value is None:
+                return None
+            if table.name == Embedding.__tablename__ and column == "data":
+                # the text representation of pgvector and postgres arrays
+                return f"[{value}]" if self.use_pgvector else f"{{{value}}}"
+            return value
+
+        dbapi_connection = connection.connection.dbapi_connection
+        cursor = dbapi_connection.cursor()
+        try:
+            if hasattr(cursor, "copy"):
+                # psycopg 3
+                with cursor.copy(sql) as copy:
+                    for row in rows:
+                        copy.write_row([_value(c, row[c]) for c in columns])
+            else:
+                # psycopg 2
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                for row in rows:
+                    writer.writerow([_value(c, row[c]) for c in columns])
+                buffer.seek(0)
+                cursor.copy_expert(f"{sql} WITH (FORMAT csv)", buffer)
+        finally:
+            cursor.close()
+
+    def vector_search(
+            self,
+            connection: sq.Connection,
+            model: str,
+            vector: Sequence[float],
+            count: int,
+    ) -> List[Tuple[int, float]]:
+        if not self.use_pgvector:
+            return super().vector_search(connection, model, vector, count)
+
+        dimensions = len(vector)
+        vector_str = "[" + ",".join(str(float(f)) for f in vector) + "]"
+        rows = connection.execute(
+            sq.text(
+                f"SELECT image_id, -(data::vector({dimensions}) <#> CAST(:vector AS vector({dimensions}))) AS score"
+                f" FROM embedding WHERE model = :model"
+                f" ORDER BY data::vector({dimensions}) <#> CAST(:vector AS vector({dimensions}))"
+                f" LIMIT :count"
+            ),
+            {"vector": vector_str, "model": model, "count": int(count)},
+        )
+        return [(row[0], float(row[1])) for row in rows]
@@ -0,0 +1,411 @@
+"""
+A long-running process that keeps CLIP models and similarity indices in memory
+and answers requests on a unix domain socket.
+
+The protocol is one JSON object per line in both directions. A request is
+``{"command": "<name>", "args": {...}}``, the response is ``{"result": ...}``
+or ``{"error": "<message>"}``. A connection can send any number of requests.
+
+This module only imports the standard library at load time,
+so clients (e.g. `bin/imagedb.py query`) start fast.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Union, List, TYPE_CHECKING
+
+from src import log
+from src.config import DATABASE_PATH, DAEMON_SOCKET
+
+if TYPE_CHECKING:
+    from .imagedb import ImageDB
+
+
+# maximum length of a unix socket path, minus some safety margin
+_MAX_SOCKET_PATH_LENGTH = 100
+
+
+def default_socket_path(database_path: Optional[Union[str, Path]] = None) -> Path:
+    """
+    Return `config.DAEMON_SOCKET` or ``daemon.sock`` in the database directory.
+
+    Paths that are too long for a unix socket are replaced by
+    a file in the temp directory which is unique per database directory.
+    """
+    if DAEMON_SOCKET:
+        return Path(DAEMON_SOCKET)
+
+    database_path = Path(database_path) if database_path is not None else DATABASE_PATH
+    path = database_path.resolve() / "daemon.sock"
+    if len(str(path)) > _MAX_SOCKET_PATH_LENGTH:
+        digest = hashlib.sha1(str(database_path.resolve()).encode()).hexdigest()[:16]
+        path = Path(tempfile.gettempdir()) / f"magic-pen-{digest}.sock"
+    return path
+
+
+class DaemonError(Exception):
+    """
+    An error reported by the daemon
+    """
+    pass
+
+
+class DaemonClient:
+    """
+    Connection to a running `ImageDBDaemon`.
+
+    Use `DaemonClient.connect()`, which returns None if no daemon is running.
+    """
+
+    def __init__(self, sock: socket.socket, socket_path: Path):
+        self.socket_path = socket_path
+        self._socket = sock
+        self._file = sock.makefile("rwb")
+
+    @classmethod
+    def connect(
+            cls,
+            socket_path: Optional[Union[str, Path]] = None,
+            timeout: Optional[float] = None,
+    ) -> Optional["DaemonClient"]:
+        """
+        :param socket_path: defaults to `default_socket_path()`
+        :param timeout: float, seconds to wait for each response, None waits forever
+        :return: DaemonClient or None if no daemon is listening
+        """
+        socket_path = Path(socket_path) if socket_path is not None else default_socket_path()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(str(socket_path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            return None
+        sock.settimeout(timeout)
+        return cls(sock, socket_path)
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def request(self, command: str, **args):
+        """
+        Send a request and return the result.
+
+        :raises DaemonError: if the daemon reports an error
+        """
+        self._file.write(json.dumps({"command": command, "args": args}).encode() + b"\n")
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise DaemonError("Daemon closed the connection")
+
+        response = json.loads(line)
+        if "error" in response:
+            raise DaemonError(response["error"])
+        return response["result"]
+
+    def ping(self) -> dict:
+        return self.request("ping")
+
+    def status(self, detailed: bool = False) -> dict:
+        return self.request("status", detailed=detailed)
+
+    def query(
+            self,
+            text: str,
+            count: int = 1,
+            model: Optional[str] = None,
+            device: str = "auto",
+    ) -> List[dict]:
+        """
+        :return: list of ``{"id": int, "filename": str, "score": float}``
+        """
+        return self.request("query", text=text, count=count, model=model, device=device)
+
+    def update_embeddings(
+            self,
+            model: Optional[str] = None,
+            device: str = "auto",
+            batch_size: int = 10,
+            threads: Optional[int] = None,
+    ):
+        return self.request("update", model=model, device=device, batch_size=batch_size, threads=threads)
+
+    def reload(self):
+        return self.request("reload")
+
+    def shutdown(self):
+        try:
+            return self.request("shutdown")
+        except DaemonError as e:
+            # the daemon might exit before the response is sent
+            if "closed the connection" not in str(e):
+                raise
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    server: "_UnixServer"
+
+    def handle(self):
+        daemon = self.server.daemon
+        with daemon._connection():
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    result = daemon.handle_request(request["command"], **(request.get("args") or {}))
+                    response = {"result": result}
+                except Exception as e:
+                    if daemon.verbose:
+                        log.log(f"Daemon: {type(e).__name__}: {e}")
+                    response = {"error": f"{type(e).__name__}: {e}"}
+
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+                self.wfile.flush()
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, daemon: "ImageDBDaemon"):
+        self.daemon = daemon
+        super().__init__(socket_path, _RequestHandler)
+
+
+class ImageDBDaemon:
+    """
+    Serves an `ImageDB` on a unix socket, see `DaemonClient`.
+
+    The similarity indices and CLIP models stay in memory between requests.
+    When the database is changed (by any process) the loaded indices are
+    rebuilt, while requests continue to use the previous ones.
+    """
+
+    COMMANDS = ("ping", "status", "query", "update", "reload", "shutdown")
+
+    def __init__(
+            self,
+            db: "ImageDB",
+            socket_path: Optional[Union[str, Path]] = None,
+            idle_timeout: Optional[float] = 600.,
+            reload_interval: float = 1.,
+            verbose: bool = False,
+    ):
+        """
+        :param db: ImageDB
+        :param socket_path: defaults to `default_socket_path(db.database_path)`
+        :param idle_timeout: float, seconds without any request or open connection
+            after which the daemon exits. None or 0 runs forever.
+        :param reload_interval: float, minimum seconds between two checks for database changes
+        :param verbose: bool, log requests to stderr
+        """
+        self.db = db
+        self.socket_path = Path(socket_path) if socket_path is not None else default_socket_path(db.database_path)
+        self.idle_timeout = idle_timeout
+        self.reload_interval = reload_interval
+        self.verbose = verbose
+        self.started_at = time.time()
+        self.num_requests = 0
+        self._server: Optional[_UnixServer] = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._num_connections = 0
+        self._last_activity = time.monotonic()
+        self._last_change_check = 0.
+        self._change_token = None
+        self._shutdown_requested = False
+        self._stopped = threading.Event()
+        # set while the socket accepts connections
+        self.listening = threading.Event()
+
+    def serve_forever(self):
+        """
+        Listen on the socket until `shutdown()` is called or the idle timeout is reached.
+
+        :raises RuntimeError: if another daemon is listening on the socket
+        """
+        self._remove_stale_socket()
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        self._change_token = self.db.change_token()
+        with self._lock:
+            # the socket is created by bind(), with this umask it is only
+            # accessible by the owner from the start (chmod afterwards leaves a gap)
+            umask = os.umask(0o177)
+            try:
+                self._server = _UnixServer(str(self.socket_path), self)
+            finally:
+                os.umask(umask)
+            shutdown_requested = self._shutdown_requested
+
+        if self.verbose:
+            log.log(f"Daemon: listening on {self.socket_path}")
+
+        watcher = threading.Thread(target=self._idle_watcher, name="imagedb-daemon-idle", daemon=True)
+        watcher.start()
+        try:
+            if not shutdown_requested:
+                self.listening.set()
+                self._server.serve_forever(poll_interval=.1)
+        finally:
+            self.listening.clear()
+            self._stopped.set()
+            self._server.server_close()
+            if self.socket_path.exists():
+                self.socket_path.unlink()
+            if self.verbose:
+                log.log(f"Daemon: stopped after {self.num_requests} requests")
+
+    def shutdown(self):
+        """
+        Stop serving, can be called from any thread, also before `serve_forever()`
+        """
+        with self._lock:
+            self._shutdown_requested = True
+            server = self._server
+
+        if server is not None and not self._stopped.is_set():
+            # BaseServer.shutdown() blocks until serve_forever() returns,
+            # which would dead-lock when called from a request thread
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+    def handle_request(self, command: str, **args):
+        if command not in self.COMMANDS:
+            raise ValueError(f"Unknown command '{command}', expected one of {', '.join(self.COMMANDS)}")
+
+        with self._lock:
+            self.num_requests += 1
+
+        if command in ("status", "query"):
+            self._check_changes(wait=False)
+
+        return getattr(self, f"_command_{command}")(**args)
+
+    def _command_ping(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "uptime": round(time.time() - self.started_at, 3),
+            "requests": self.num_requests,
+        }
+
+    def _command_status(self, detailed: bool = False) -> dict:
+        return self.db.status(detailed=detailed)
+
+    def _command_query(
+            self,
+            text: str,
+            count: int = 1,
+            model: Optional[str] = None,
+            device: str = "auto",
+    ) -> List[dict]:
+        index = self.db.sim_index(model=model)
+        with self.db.sql_session() as sql_session:
+            return [
+                # the full float, so the output is the same as without the daemon
+                {"id": entry.id, "filename": str(entry.filename()), "score": score}
+                for entry, score in index.images_by_text(
+                    prompt=text, count=count, device=device, sql_session=sql_session,
+                )
+            ]
+
+    def _command_update(
+            self,
+            model: Optional[str] = None,
+            device: str = "auto",
+            batch_size: int = 10,
+            threads: Optional[int] = None,
+    ) -> dict:
+        from src.clip import set_num_threads
+        if threads:
+            set_num_threads(threads)
+
+        self.db.update_embeddings(model=model, device=device, batch_size=batch_size)
+        self._check_changes(wait=True)
+        return self.db.status()
+
+    def _command_reload(self) -> dict:
+        self._change_token = self.db.change_token()
+        self._reload()
+        return self.db.status(detailed=True)
+
+    def _command_shutdown(self) -> dict:
+        self.shutdown()
+        return {}
+
+    def _check_changes(self, wait: bool):
+        """
+        Reload if the database has changed.
+
+        :param wait: bool, if False, the reload runs in the background
+            and the current request uses the previous indices
+        """
+        now = time.monotonic()
+        with self._lock:
+            if not wait and now - self._last_change_check < self.reload_interval:
+                return
+            self._last_change_check = now
+
+        token = self.db.change_token()
+        with self._lock:
+            if token == self._change_token:
+                return
+            self._change_token = token
+
+        if wait:
+            self._reload()
+        else:
+            threading.Thread(target=self._reload, name="imagedb-daemon-reload", daemon=True).start()
+
+    def _reload(self):
+        # reloads run one after another
+        with self._reload_lock:
+            if self.verbose:
+                log.log("Daemon: reloading")
+            self.db.reload()
+
+    @contextlib.contextmanager
+    def _connection(self):
+        with self._lock:
+            self._num_connections += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._num_connections -= 1
+                self._last_activity = time.monotonic()
+
+    def _idle_watcher(self):
+        while not self._stopped.wait(min(1., self.idle_timeout or 1.)):
+            if not self.idle_timeout:
+                continue
+            with self._lock:
+                idle = self._num_connections == 0 and time.monotonic() - self._last_activity > self.idle_timeout
+            if idle:
+                if self.verbose:
+                    log.log(f"Daemon: idle for {self.idle_timeout} seconds, stopping")
+                self.shutdown()
+                return
+
+    def _remove_stale_socket(self):
+        if not self.socket_path.exists():
+            return
+        client = DaemonClient.connect(self.socket_path)
+        if client is not None:
+            client.close()
+            raise RuntimeError(f"Another daemon is listening on {self.socket_path}")
+        # left over from a process that was killed
+        self.socket_path.unlink()
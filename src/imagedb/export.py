@@ -0,0 +1,374 @@
+"""
+Export and import of embeddings in bulk.
+
+Two formats are supported:
+
+- ``npy``: a directory with ``embeddings.npy`` (float32 [N, dims]),
+  ``image_ids.npy`` (int64 [N]), ``filenames.txt`` (one per line) and ``meta.json``.
+  The arrays are written through memory-maps and can be loaded with
+  ``numpy.load(..., mmap_mode="r")``.
+- ``parquet``: a single file with the columns ``image_id``, ``filename`` and
+  ``embedding`` and the model name in the schema metadata.
+  Needs ``pip install pyarrow``.
+
+Both are read and written in chunks, so memory use does not depend
+on the number of embeddings.
+"""
+import json
+from pathlib import Path
+from typing import Optional, Union, Iterable, List, Tuple, Generator, Dict, TYPE_CHECKING
+
+import numpy as np
+import sqlalchemy as sq
+from sqlalchemy.orm import Session
+
+from .imagesql import ImageEntry, Embedding
+
+if TYPE_CHECKING:
+    from .imagedb import ImageDB
+
+
+EXPORT_FORMATS = ("npy", "parquet")
+
+# (image ids, filenames, embeddings)
+Chunk = Tuple[np.ndarray, List[str], np.ndarray]
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The parquet format needs `pip install pyarrow`")
+    return pyarrow
+
+
+def embeddings_to_numpy(data: List[Union[str, Iterable[float]]], dims: int) -> np.ndarray:
+    """
+    Convert a list of `Embedding.data` values to a float32 [N, dims] array
+    """
+    if not data:
+        return np.zeros((0, dims), dtype=np.float32)
+
+    if isinstance(data[0], str):
+        # one conversion for the whole chunk
+        return np.array(",".join(data).split(","), dtype=np.float32).reshape(len(data), dims)
+
+    return np.stack([np.asarray(d, dtype=np.float32) for d in data])
+
+
+def iter_embedding_chunks(
+        db: "ImageDB",
+        model: str,
+        chunk_size: int = 10_000,
+        sql_session: Optional[Session] = None,
+) -> Generator[Chunk, None, None]:
+    """
+    Yield all embeddings of a model in chunks, ordered by embedding id
+    """
+    with db.sql_session(sql_session) as sql_session:
+        dims = db.embedding_dimensions(model, sql_session=sql_session)
+        last_id = None
+        while True:
+            query = (
+                sq.select(Embedding.id, Embedding.image_id, Embedding.data, ImageEntry.path, ImageEntry.name)
+                .join(ImageEntry, ImageEntry.id == Embedding.image_id)
+                .where(Embedding.model == model)
+                .order_by(Embedding.id)
+                .limit(chunk_size)
+            )
+            if last_id is not None:
+                query = query.where(Embedding.id > last_id)
+
+            rows = sql_session.execute(query).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            yield (
+                np.array([r[1] for r in rows], dtype=np.int64),
+                [str(Path(r[3]) / r[4]) for r in rows],
+                embeddings_to_numpy([r[2] for r in rows], dims),
+            )
+
+
+def export_embeddings(
+        db: "ImageDB",
+        model: str,
+        path: Union[str, Path],
+        format: str = "npy",
+        chunk_size: int = 10_000,
+) -> int:
+    """
+    Write all embeddings of a model to `path`.
+
+    :param db: ImageDB
+    :param model: str, name of the CLIP model
+    :param path: directory for the ``npy`` format, file for ``parquet``
+    :param format: str, one of EXPORT_FORMATS
+    :param chunk_size: int, number of embeddings read from the database at once
+    :return: int, number of exported embeddings
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown format '{format}', expected one of {', '.join(EXPORT_FORMATS)}")
+
+    path = Path(path)
+    # all reads see one snapshot, so the count matches the exported rows
+    # even if other processes write in the meantime
+    with db.sql_engine.connect() as connection:
+        db.backend.begin_snapshot(connection)
+        with Session(bind=connection) as sql_session:
+            # the same join as `iter_embedding_chunks`, which skips embeddings without image
+            total = sql_session.execute(
+                sq.select(sq.func.count(Embedding.id))
+                .join(ImageEntry, ImageEntry.id == Embedding.image_id)
+                .where(Embedding.model == model)
+            ).scalar()
+            dims = db.embedding_dimensions(model, sql_session=sql_session)
+            if not total:
+                raise ValueError(f"No embeddings for model '{model}'")
+
+            chunks = iter_embedding_chunks(db, model, chunk_size=chunk_size, sql_session=sql_session)
+            if format == "npy":
+                count = _write_npy(path, model, dims, total, chunks)
+            else:
+                count = _write_parquet(path, model, dims, chunks)
+
+    return count
+
+
+def _write_npy(path: Path, model: str, dims: int, total: int, chunks: Iterable[Chunk]) -> int:
+    path.mkdir(parents=True, exist_ok=True)
+    embeddings = np.lib.format.open_memmap(
+        path / "embeddings.npy", mode="w+", dtype=np.float32, shape=(total, dims),
+    )
+    image_ids = np.lib.format.open_memmap(
+        path / "image_ids.npy", mode="w+", dtype=np.int64, shape=(total, ),
+    )
+    count = 0
+    with (path / "filenames.txt").open("w") as fp:
+        for chunk_ids, chunk_filenames, chunk_embeddings in chunks:
+            if count + len(chunk_ids) > total:
+                raise RuntimeError(f"Expected {total} embeddings of model '{model}', got more")
+            embeddings[count: count + len(chunk_ids)] = chunk_embeddings
+            image_ids[count: count + len(chunk_ids)] = chunk_ids
+            fp.writelines(f"{filename}\n" for filename in chunk_filenames)
+            count += len(chunk_ids)
+
+    embeddings.flush()
+    image_ids.flush()
+    del embeddings, image_ids
+
+    if count < total:
+        for name in ("embeddings.npy", "image_ids.npy"):
+            _truncate_npy(path / name, count)
+
+    (path / "meta.json").write_text(json.dumps({
+        "format": "npy",
+        "model": model,
+        "dimensions": dims,
+        "count": count,
+    }, indent=2))
+    return count
+
+
+def _truncate_npy(filename: Path, count: int):
+    """
+    Rewrite the .npy file with only its first `count` rows
+    """
+    array = np.load(filename, mmap_mode="r")
+    temp_filename = filename.with_name(f".{filename.name}.tmp")
+    truncated = np.lib.format.open_memmap(
+        temp_filename, mode="w+", dtype=array.dtype, shape=(count, *array.shape[1:]),
+    )
+    truncated[:] = array[:count]
+    truncated.flush()
+    del array, truncated
+    temp_filename.replace(filename)
+
+
+def _parquet_schema(model: str, dims: int):
+    pa = _import_pyarrow()
+    return pa.schema(
+        [
+            ("image_id", pa.int64()),
+            ("filename", pa.string()),
+            ("embedding", pa.list_(pa.float32(), dims)),
+        ],
+        metadata={"model": model},
+    )
+
+
+def _write_parquet(path: Path, model: str, dims: int, chunks: Iterable[Chunk]) -> int:
+    pa = _import_pyarrow()
+    schema = _parquet_schema(model, dims)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    count = 0
+    with pa.parquet.ParquetWriter(str(path), schema) as writer:
+        for chunk_ids, chunk_filenames, chunk_embeddings in chunks:
+            writer.write_batch(pa.record_batch(
+                [
+                    pa.array(chunk_ids),
+                    pa.array(chunk_filenames),
+                    pa.FixedSizeListArray.from_arrays(pa.array(chunk_embeddings.reshape(-1)), dims),
+                ],
+                schema=schema,
+            ))
+            count += len(chunk_ids)
+    return count
+
+
+def read_embedding_chunks(
+        path: Union[str, Path],
+        chunk_size: int = 10_000,
+) -> Tuple[dict, Iterable[Chunk]]:
+    """
+    Read embeddings written by `export_embeddings` (or produced elsewhere in the same layout).
+
+    :param path: directory (``npy``) or file (``parquet``)
+    :return: tuple of (meta dict with "model" and "dimensions", iterable of chunks)
+        The filenames of a chunk are empty strings if the source has no filenames.
+    """
+    path = Path(path)
+    if path.is_dir():
+        meta = json.loads((path / "meta.json").read_text()) if (path / "meta.json").exists() else {}
+        return meta, _read_npy(path, chunk_size, count=meta.get("count"))
+
+    pa = _import_pyarrow()
+    file = pa.parquet.ParquetFile(str(path))
+    metadata = file.schema_arrow.metadata or {}
+    meta = {"format": "parquet", "count": file.metadata.num_rows}
+    if b"model" in metadata:
+        meta["model"] = metadata[b"model"].decode()
+    return meta, _read_parquet(file, chunk_size)
+
+
+def _read_npy(path: Path, chunk_size: int, count: Optional[int] = None) -> Generator[Chunk, None, None]:
+    """
+    :param count: int, read only the first rows, e.g. the "count" of meta.json
+    """
+    embeddings = np.load(path / "embeddings.npy", mmap_mode="r")
+    image_ids = np.load(path / "image_ids.npy", mmap_mode="r") if (path / "image_ids.npy").exists() else None
+    filenames = (path / "filenames.txt").open() if (path / "filenames.txt").exists() else None
+    if count is None:
+        count = embeddings.shape[0]
+    count = min(count, embeddings.shape[0])
+    try:
+        for start in range(0, count, chunk_size):
+            chunk_embeddings = np.asarray(embeddings[start: min(start + chunk_size, count)], dtype=np.float32)
+            size = chunk_embeddings.shape[0]
+            chunk_ids = (
+                np.asarray(image_ids[start: start + size], dtype=np.int64)
+                if image_ids is not None else np.full(size, -1, dtype=np.int64)
+            )
+            chunk_filenames = (
+                [filenames.readline().rstrip("\n") for _ in range(size)]
+                if filenames is not None else [""] * size
+            )
+            yield chunk_ids, chunk_filenames, chunk_embeddings
+    finally:
+        if filenames is not None:
+            filenames.close()
+
+
+def _read_parquet(file, chunk_size: int) -> Generator[Chunk, None, None]:
+    columns = file.schema_arrow.names
+    for batch in file.iter_batches(batch_size=chunk_size):
+        size = batch.num_rows
+        embedding = batch.column("embedding")
+        chunk_embeddings = np.asarray(embedding.flatten().to_numpy(zero_copy_only=False), dtype=np.float32)
+        chunk_embeddings = chunk_embeddings.reshape(size, -1)
+        chunk_ids = (
+            batch.column("image_id").to_numpy(zero_copy_only=False).astype(np.int64)
+            if "image_id" in columns else np.full(size, -1, dtype=np.int64)
+        )
+        chunk_filenames = (
+            batch.column("filename").to_pylist()
+            if "filename" in columns else [""] * size
+        )
+        yield chunk_ids, chunk_filenames, chunk_embeddings
+
+
+def import_embeddings(
+        db: "ImageDB",
+        path: Union[str, Path],
+        model: Optional[str] = None,
+        chunk_size: int = 10_000,
+        add_images: bool = True,
+) -> Dict[str, int]:
+    """
+    Bulk-load embeddings from `path`, see `read_embedding_chunks`.
+
+    Images are matched by filename, or by image id if there are no filenames.
+    Existing embeddings of the same model and image are replaced.
+
+    :param db: ImageDB
+    :param path: directory (``npy``) or file (``parquet``)
+    :param model: str, name of the CLIP model, defaults to the model stored in the file
+    :param chunk_size: int, number of embeddings written in one transaction
+    :param add_images: bool, add images that are not in the database yet, if the file exists
+    :return: dict with the number of "imported" and "skipped" embeddings
+    """
+    meta, chunks = read_embedding_chunks(path, chunk_size=chunk_size)
+    model = model or meta.get("model")
+    if not model:
+        raise ValueError(f"No model name stored in '{path}', it must be specified")
+
+    stats = {"imported": 0, "skipped": 0}
+    with db.sql_session() as sql_session:
+        for chunk_ids, chunk_filenames, chunk_embeddings in chunks:
+            if chunk_filenames and chunk_filenames[0]:
+                image_ids = _image_ids_by_filename(db, chunk_filenames, add_images, sql_session)
+            else:
+                image_ids = _existing_image_ids(chunk_ids, sql_session)
+
+            found = [i for i, image_id in enumerate(image_ids) if image_id is not None]
+            stats["skipped"] += len(image_ids) - len(found)
+
+            stats["imported"] += db.write_embeddings(
+                model=model,
+                image_ids=[image_ids[i] for i in found],
+                embeddings=chunk_embeddings[found],
+                chunk_size=chunk_size,
+                update_index=False,
+                sql_session=sql_session,
+            )
+
+    db._sync_index(model)
+    return stats
+
+
+def _image_ids_by_filename(
+        db: "ImageDB",
+        filenames: List[str],
+        add_images: bool,
+        sql_session: Session,
+) -> List[Optional[int]]:
+    paths = [Path(f) for f in filenames]
+    keys = [(str(p.parent), p.name) for p in paths]
+    existing = {
+        (path, name): id
+        for id, path, name in sql_session.execute(
+            sq.select(ImageEntry.id, ImageEntry.path, ImageEntry.name)
+            .where(sq.tuple_(ImageEntry.path, ImageEntry.name).in_(sorted(set(keys))))
+        )
+    }
+
+    image_ids = []
+    for path, key in zip(paths, keys):
+        if key not in existing and add_images and path.is_file():
+            image = ImageEntry(path=key[0], name=key[1])
+            sql_session.add(image)
+            sql_session.flush()
+            existing[key] = image.id
+        image_ids.append(existing.get(key))
+    return image_ids
+
+
+def _existing_image_ids(image_ids: np.ndarray, sql_session: Session) -> List[Optional[int]]:
+    ids = [int(i) for i in image_ids]
+    existing = set(sql_session.execute(
+        sq.select(ImageEntry.id).where(ImageEntry.id.in_(sorted(set(ids))))
+    ).scalars())
+    return [i if i in existing else None for i in ids]
@@ -1,20 +1,26 @@
+import copy
 import os
 import hashlib
+import time
 from pathlib import Path
-from typing import Union, Optional, Iterable, Dict, Callable, List
+from typing import Union, Optional, Iterable, Sequence, Dict, Callable, List, Tuple, Hashable, TYPE_CHECKING
 
 import sqlalchemy as sq
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
 
-from tqdm import tqdm
-import PIL.Image
-
 from src import log
-from src.config import DATABASE_PATH
-from src.image import is_image_filename
-from .imagesql import ImageDBBase, ImageEntry, Embedding, ImageTag
-from .simindex import SimIndex
+from src.profiling import span
+from src.config import DATABASE_PATH, DATABASE_URL
+from .imagesql import ImageDBBase, ImageEntry, Embedding, ImageTag, StatCounter
+from .sqlengine import SqliteProfile, ThreadSessionPool
+from .backends import DatabaseBackend, SqliteBackend
+
+# faiss, CLIP, PIL and tqdm are imported where they are needed,
+# so that e.g. `bin/imagedb.py status` starts fast
+if TYPE_CHECKING:
+    import numpy as np
+    from .simindex import SimIndex
 
 
 class ImageDB:
@@ -23,16 +29,51 @@ class ImageDB:
             self,
             database_path: Optional[Union[str, Path]] = None,
             verbose: bool = False,
+            read_only: bool = False,
+            sql_profile: Optional[SqliteProfile] = None,
+            backend: Optional[Union[str, DatabaseBackend]] = None,
+            status_ttl: float = 0.,
     ):
+        """
+        :param database_path: directory of the database, defaults to `config.DATABASE_PATH`
+        :param verbose: bool, log progress to stderr
+        :param read_only: bool, if True, the connections refuse any writes
+            (e.g. for the server, which only reads)
+        :param sql_profile: SqliteProfile, connection settings, defaults to `SqliteProfile()`
+        :param backend: DatabaseBackend or a sqlalchemy url, defaults to `config.DATABASE_URL`
+            or, if that is empty, to SQLite in `database_path`
+        :param status_ttl: float, number of seconds that `status()` returns a cached snapshot
+        """
         self._database_path = Path(database_path) if database_path is not None else DATABASE_PATH
         self.verbose = verbose
+        self.read_only = read_only
+        self.sql_profile = sql_profile if sql_profile is not None else SqliteProfile()
+
+        if backend is None and DATABASE_URL:
+            backend = DATABASE_URL
+        if backend is None:
+            backend = SqliteBackend(self._database_path / "db.sqlite", profile=self.sql_profile)
+        elif isinstance(backend, str):
+            backend = DatabaseBackend.from_url(backend)
+        self.backend: DatabaseBackend = backend
+
+        self.status_ttl = status_ttl
+        self._status_cache: Dict[bool, Tuple[float, dict]] = {}
         self._sql_engine: Optional[sq.Engine] = None
-        self._model_indices: Dict[str, SimIndex] = {}
+        self._session_pool: Optional[ThreadSessionPool] = None
+        self._model_indices: Dict[str, "SimIndex"] = {}
 
     @property
     def database_path(self) -> Path:
         return self._database_path
 
+    @property
+    def index_path(self) -> Path:
+        """
+        Directory of the persisted similarity indices
+        """
+        return self._database_path / "indices"
+
     @classmethod
     def normalize_path(cls, path: Union[str, Path]) -> Path:
         if not isinstance(path, Path):
@@ -51,6 +92,7 @@ class ImageDB:
             no_duplicates: bool = True,
             tags: Optional[Iterable[Union[int, str, ImageTag]]] = None,
             embeddings: Optional[Dict[str, Iterable[float]]] = None,
+            meta: Optional[dict] = None,
             sql_session: Optional[Session] = None,
     ) -> ImageEntry:
         path = self.normalize_path(path)
@@ -77,10 +119,15 @@ class ImageDB:
                 image = ImageEntry(
                     path=str(path.parent),
                     name=path.name,
+                    meta=meta,
                 )
                 sql_session.add(image)
                 do_commit = True
 
+            elif meta is not None:
+                image.meta = meta
+                do_commit = True
+
             if tags is not None:
                 tags = self.get_tags(tags, sql_session=sql_session)
                 for tag in tags:
@@ -110,9 +157,11 @@ class ImageDB:
             else:
                 image = image_or_id
 
+            data = list(data)
             embedding = Embedding(
                 model=model,
                 data=Embedding.to_internal_data(data),
+                dims=len(data),
                 image_id=image.id,
             )
             sql_session.add(embedding)
@@ -149,11 +198,14 @@ class ImageDB:
             no_duplicates: bool = True,
             sql_session: Optional[Session] = None,
     ):
+        from src.image import is_image_filename
+
         with self.sql_session(sql_session) as sql_session:
 
             path = self.normalize_path(path)
             files = path.rglob(glob_pattern) if recursive else path.glob(glob_pattern)
             if self.verbose:
+                from tqdm import tqdm
                 files = tqdm(files, desc=f"adding {'recursive ' if recursive else ''}directory {path}")
 
             if tags is not None:
@@ -177,11 +229,17 @@ class ImageDB:
     @property
     def sql_engine(self) -> sq.Engine:
         if self._sql_engine is None:
-            os.makedirs(self._database_path, exist_ok=True)
-            self._sql_engine = sq.create_engine(
-                f"sqlite:///{self._database_path / 'db.sqlite'}",
-            )
-            ImageDBBase.metadata.create_all(self._sql_engine)
+            if self.read_only:
+                # make sure the schema exists before opening the read-only connections
+                engine = self.backend.create_engine()
+                self.backend.create_schema(engine, verbose=self.verbose)
+                engine.dispose()
+                self._sql_engine = self.backend.create_engine(read_only=True)
+
+            else:
+                self._sql_engine = self.backend.create_engine()
+                self.backend.create_schema(self._sql_engine, verbose=self.verbose)
+
         return self._sql_engine
 
     def sql_session(self, override: Optional[Session] = None) -> Session:
@@ -198,6 +256,11 @@ class ImageDB:
 
             return _Session(override)
 
+        if self.backend.thread_sessions:
+            if self._session_pool is None:
+                self._session_pool = ThreadSessionPool(self.sql_engine)
+            return self._session_pool.session()
+
         return Session(self.sql_engine)
 
     def _log(self, *args, **kwargs):
@@ -256,37 +319,127 @@ class ImageDB:
 
             def _update_all(callback: Optional[Callable]):
                 while True:
-                    image_batch = images[:batch_size]
+                    with span("imagedb.select_batch"):
+                        image_batch = images[:batch_size]
                     if not image_batch:
                         break
 
-                    pil_images = []
-                    for image_entry in image_batch:
-                        image = PIL.Image.open(image_entry.filename())
-                        pil_images.append(image)
-
-                    features = get_image_features(pil_images, model=model, device=device)
-
-                    embedding_entries = [
-                        Embedding(
-                            model=model,
-                            data=Embedding.to_internal_data(feature),
-                            image_id=image_entry.id,
-                        )
-                        for image_entry, feature in zip(image_batch, features)
-                    ]
-                    sql_session.add_all(embedding_entries)
-                    sql_session.commit()
+                    # filenames are decoded by the CLIP preprocessing, at reduced size if possible
+                    filenames = [image_entry.filename() for image_entry in image_batch]
+
+                    with span("imagedb.image_features"):
+                        features = get_image_features(filenames, model=model, device=device)
+
+                    self.write_embeddings(
+                        model=model,
+                        image_ids=[image_entry.id for image_entry in image_batch],
+                        embeddings=features,
+                        update_index=False,
+                        sql_session=sql_session,
+                    )
 
                     if callback:
                         callback(len(image_batch))
 
             if self.verbose:
+                from tqdm import tqdm
                 with tqdm(f"update embeddings", total=total) as log:
                     _update_all(lambda n: log.update(n))
             else:
                 _update_all(None)
 
+        self._sync_index(model)
+
+    def write_embeddings(
+            self,
+            model: str,
+            image_ids: Union[Sequence[int], "np.ndarray"],
+            embeddings: "np.ndarray",
+            chunk_size: int = 50_000,
+            update_index: bool = True,
+            sql_session: Optional[Session] = None,
+    ) -> int:
+        """
+        Store many embeddings of one model at once.
+
+        Existing embeddings of the same model and image are replaced.
+        They are deleted and inserted as new rows, so that persisted
+        `SimIndex`es can pick up the change incrementally.
+
+        The rows are written with `DatabaseBackend.bulk_insert`
+        and each chunk is committed in one transaction.
+
+        :param model: str, name of the CLIP model
+        :param image_ids: sequence of int, the ids of existing images
+        :param embeddings: float array of shape [len(image_ids), dims]
+        :param chunk_size: int, number of embeddings per transaction
+        :param update_index: bool, add the embeddings to the loaded similarity index of the model.
+            Indices that are not loaded are updated the next time they are loaded.
+        :return: int, number of written embeddings
+        """
+        import numpy as np
+
+        image_ids = np.asarray(image_ids, dtype=np.int64).reshape(-1)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or embeddings.shape[0] != image_ids.shape[0]:
+            raise ValueError(
+                f"Expected embeddings of shape [{image_ids.shape[0]}, dims], got {list(embeddings.shape)}"
+            )
+        if not image_ids.shape[0]:
+            return 0
+
+        # if an image is listed more than once, the last embedding wins
+        _, last_indices = np.unique(image_ids[::-1], return_index=True)
+        if last_indices.shape[0] != image_ids.shape[0]:
+            keep = np.sort(image_ids.shape[0] - 1 - last_indices)
+            image_ids, embeddings = image_ids[keep], embeddings[keep]
+
+        dims = embeddings.shape[1]
+        with self.sql_session(sql_session) as sql_session:
+            stored_dims = self.embedding_dimensions(model, sql_session=sql_session)
+            if stored_dims is not None and stored_dims != dims:
+                raise ValueError(
+                    f"Embeddings of model '{model}' have {stored_dims} dimensions, got {dims}"
+                )
+
+            for start in range(0, image_ids.shape[0], chunk_size):
+                chunk_ids = [int(i) for i in image_ids[start: start + chunk_size]]
+                chunk_embeddings = embeddings[start: start + chunk_size]
+
+                # stay below the maximum number of sqlite parameters
+                with span("imagedb.delete_embeddings"):
+                    for id_start in range(0, len(chunk_ids), 10_000):
+                        sql_session.execute(sq.delete(Embedding).where(
+                            Embedding.model == model,
+                            Embedding.image_id.in_(chunk_ids[id_start: id_start + 10_000]),
+                        ))
+                with span("imagedb.insert_embeddings"):
+                    self.backend.bulk_insert(
+                        sql_session.connection(),
+                        Embedding.__table__,
+                        [
+                            {
+                                "model": model,
+                                "data": Embedding.to_internal_data(embedding),
+                                "dims": dims,
+                                "image_id": image_id,
+                            }
+                            for image_id, embedding in zip(chunk_ids, chunk_embeddings)
+                        ],
+                    )
+                with span("imagedb.commit"):
+                    sql_session.commit()
+
+        if update_index:
+            self._sync_index(model)
+
+        return image_ids.shape[0]
+
+    def _sync_index(self, model: str):
+        index = self._model_indices.get(model)
+        if index is not None:
+            index.sync()
+
     def get_embedding(
             self,
             image_or_id: Union[int, ImageEntry],
@@ -304,29 +457,118 @@ class ImageDB:
                 Embedding.model == model,
             ).first()
 
+    def embedding_dimensions(
+            self,
+            model: str,
+            sql_session: Optional[Session] = None,
+    ) -> Optional[int]:
+        """
+        Return the length of the stored embeddings of the model,
+        or None if there are no embeddings of that model
+        """
+        with self.sql_session(sql_session) as sql_session:
+            embedding = sql_session.query(Embedding).filter(Embedding.model == model).first()
+            if embedding is None:
+                return None
+            if embedding.dims is None:
+                return len(embedding.to_list())
+            return embedding.dims
+
     def sim_index(
             self,
             model: Optional[str] = None,
-    ) -> SimIndex:
+    ) -> "SimIndex":
+        """
+        Return the similarity index of the CLIP model.
+
+        Indices of several models can be used side by side,
+        each is created on first use.
+        """
+        from src.config import DEFAULT_CLIP_MODEL
+        from .simindex import SimIndex
+        model = model or DEFAULT_CLIP_MODEL
+
         if model not in self._model_indices:
             self._model_indices[model] = SimIndex(db=self, model=model)
 
         return self._model_indices[model]
 
-    def status(self, sql_session: Optional[Session] = None) -> dict:
+    def sim_indices(self) -> Dict[str, "SimIndex"]:
+        """
+        Return the similarity indices that are loaded, by model name
+        """
+        return dict(self._model_indices)
+
+    def change_token(self) -> Hashable:
+        """
+        Return a value that changes when the database is changed,
+        by this or any other process, see `DatabaseBackend.change_token`
+        """
+        with self.sql_engine.connect() as connection:
+            return self.backend.change_token(connection)
+
+    def reload(self):
+        """
+        Update the loaded similarity indices and drop the cached status.
+
+        Queries in other threads keep using an index while it's rebuilt,
+        see `SimIndex.sync`.
+        """
+        self._status_cache = {}
+        for index in list(self._model_indices.values()):
+            index.sync()
+
+    def status(
+            self,
+            detailed: bool = False,
+            sql_session: Optional[Session] = None,
+    ) -> dict:
+        """
+        Return the number of tags, images and embeddings per model.
+
+        The numbers are read from the `stat_counter` table and
+        a snapshot is cached for `status_ttl` seconds.
+
+        :param detailed: bool, also return the dimensions per model,
+            the size of the database and the state of the loaded similarity indices
+        """
+        cached = self._status_cache.get(detailed)
+        if cached is not None and time.monotonic() - cached[0] < self.status_ttl:
+            # a copy, so callers can not change the snapshot of other callers
+            return copy.deepcopy(cached[1])
+
         with self.sql_session(sql_session) as session:
-            num_tags = session.query(ImageTag).count()
-            num_images = session.query(ImageEntry).count()
-            num_embeddings = (
-                session
-                    .query(Embedding, sq.func.count(Embedding.model))
-                    .group_by(Embedding.model).all()
-            )
-            return {
-                "num_tags": num_tags,
-                "num_images": num_images,
+            counters = {
+                c.name: c.value
+                for c in session.query(StatCounter)
+            }
+            status = {
+                "num_tags": counters.get("tags", 0),
+                "num_images": counters.get("images", 0),
                 "embeddings": [
-                    {"model": e[0].model, "count": e[1]}
-                    for e in sorted(num_embeddings, key=lambda e: e[0].model)
+                    {"model": name[len("embeddings/"):], "count": value}
+                    for name, value in sorted(counters.items())
+                    if name.startswith("embeddings/") and value
                 ]
             }
+
+            if detailed:
+                for e in status["embeddings"]:
+                    e["dimensions"] = self.embedding_dimensions(e["model"], sql_session=session)
+
+                status["bytes_on_disk"] = self.backend.database_size(session.connection())
+
+                now = time.time()
+                status["indices"] = [
+                    {
+                        "model": model,
+                        "size": index.size,
+                        "missing": counters.get(f"embeddings/{model}", 0) - index.size,
+                        "age": round(now - index.created_at, 3),
+                    }
+                    for model, index in sorted(self._model_indices.items())
+                    if not index.server_side
+                ]
+
+        self._status_cache[detailed] = (time.monotonic(), status)
+        return copy.deepcopy(status)
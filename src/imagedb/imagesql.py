@@ -1,17 +1,45 @@
 import os.path
 from pathlib import Path
-from typing import List, Iterable, Optional
+from typing import List, Iterable, Optional, TYPE_CHECKING
 
-import PIL.Image
 import sqlalchemy as sq
 from sqlalchemy.orm import relationship, backref, sessionmaker, Session
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.exc import IntegrityError
 
+if TYPE_CHECKING:
+    import PIL.Image
+
 
 ImageDBBase = declarative_base()
 
 
+class EmbeddingData(sq.types.TypeDecorator):
+    """
+    The embedding vector.
+
+    On SQLite it's stored as the comma-separated string of `Embedding.to_internal_data`.
+    On PostgreSQL it's a native ``vector`` (if pgvector is installed) or ``REAL[]``
+    and the database returns a list or numpy array.
+    """
+    impl = sq.String
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            try:
+                from pgvector.sqlalchemy import Vector
+                return dialect.type_descriptor(Vector())
+            except ImportError:
+                return dialect.type_descriptor(sq.ARRAY(sq.REAL))
+        return dialect.type_descriptor(sq.String())
+
+    def process_bind_param(self, value, dialect):
+        if dialect.name == "postgresql" and isinstance(value, str):
+            return [float(f) for f in value.split(",")]
+        return value
+
+
 image_tags = sq.Table(
     "image_tags",
     ImageDBBase.metadata,
@@ -20,12 +48,39 @@ image_tags = sq.Table(
 )
 
 
+class SchemaVersion(ImageDBBase):
+    """
+    Single row holding the version of the database schema, see `migrations.py`
+    """
+    __tablename__ = 'schema_version'
+
+    version = sq.Column(sq.Integer, primary_key=True, autoincrement=False)
+
+
+class StatCounter(ImageDBBase):
+    """
+    Row counts maintained by database triggers, see `migrations.py`.
+
+    Names are "images", "tags" and "embeddings/<model>"
+    """
+    __tablename__ = 'stat_counter'
+
+    # long enough for "embeddings/" + `Embedding.model`
+    name = sq.Column(sq.String(300), primary_key=True)
+    value = sq.Column(sq.BigInteger, nullable=False, default=0)
+
+
 class ImageEntry(ImageDBBase):
     __tablename__ = 'image'
+    __table_args__ = (
+        sq.Index("ix_image_path_name", "path", "name", unique=True),
+    )
 
     id = sq.Column(sq.Integer, sq.Sequence("id_seq"), primary_key=True)
     path = sq.Column(sq.String, index=True)
     name = sq.Column(sq.String, index=True)
+    # free-form information, e.g. the parameters that generated the image
+    meta = sq.Column(sq.JSON)
 
     tags = relationship("ImageTag", secondary=image_tags, back_populates="images")
     embeddings = relationship("Embedding", back_populates="images")
@@ -43,7 +98,8 @@ class ImageEntry(ImageDBBase):
             ext = "jpeg"
         return f"image/{ext}"
 
-    def load_pil(self) -> PIL.Image.Image:
+    def load_pil(self) -> "PIL.Image.Image":
+        import PIL.Image
         return PIL.Image.open(self.filename())
 
     def _ipython_display_(self):
@@ -62,23 +118,32 @@ class ImageTag(ImageDBBase):
 
 class Embedding(ImageDBBase):
     __tablename__ = 'embedding'
+    __table_args__ = (
+        sq.Index("ix_embedding_model_image_id", "model", "image_id", unique=True),
+        # never reuse the id of a deleted row, `SimIndex.sync` relies on increasing ids
+        {"sqlite_autoincrement": True},
+    )
 
     id = sq.Column(sq.Integer, sq.Sequence("id_seq"), primary_key=True)
-    model = sq.Column(sq.String(16), index=True)
-    #data = sq.Column(sq.ARRAY(sq.Float))
-    data = sq.Column(sq.String)
+    # a CLIP model name or the path of a checkpoint
+    model = sq.Column(sq.String(255), index=True)
+    data = sq.Column(EmbeddingData)
+    # length of the vector, all embeddings of a model have the same length
+    dims = sq.Column(sq.Integer)
 
     image_id = sq.Column(sq.Integer, sq.ForeignKey("image.id", ondelete="RESTRICT"), index=True)
     images = relationship("ImageEntry", back_populates="embeddings")
 
-    sq.UniqueConstraint(model, image_id)
-
     def to_list(self) -> List[float]:
-        return [float(i) for i in self.data.split(",")]
+        if isinstance(self.data, str):
+            return [float(i) for i in self.data.split(",")]
+        return [float(i) for i in self.data]
 
     def to_numpy(self, dtype="float32"):
         import numpy as np
-        return np.array(self.to_list(), dtype=dtype)
+        if isinstance(self.data, str):
+            return np.array(self.to_list(), dtype=dtype)
+        return np.asarray(self.data, dtype=dtype)
 
     @classmethod
     def to_internal_data(cls, sequence: Iterable[float]) -> str:
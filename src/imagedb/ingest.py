@@ -0,0 +1,178 @@
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Union, Iterable, List, Tuple, TYPE_CHECKING
+
+from src import log
+
+if TYPE_CHECKING:
+    from .imagedb import ImageDB
+
+
+_STOP = object()
+
+
+class IngestSink:
+    """
+    Adds new image files (e.g. generated results) to an `ImageDB`
+    and computes their CLIP embeddings, in a background thread.
+
+    `put` only appends to a queue. The worker collects up to `batch_size` files
+    (or what arrived within `max_delay` seconds), adds them to the database
+    and embeds them in one batch. `ImageDB.write_embeddings` adds the embeddings
+    to the loaded similarity index of the model without rebuilding it.
+    """
+
+    def __init__(
+            self,
+            db: "ImageDB",
+            model: Optional[str] = None,
+            device: str = "auto",
+            batch_size: int = 16,
+            max_delay: float = 2.,
+            tags: Optional[Iterable[str]] = None,
+            embed: bool = True,
+    ):
+        """
+        :param db: ImageDB
+        :param model: str, name of the CLIP model, defaults to `config.DEFAULT_CLIP_MODEL`
+        :param device: str, device for the CLIP model
+        :param batch_size: int, maximum number of files per batch
+        :param max_delay: float, maximum seconds to wait for a batch to fill up
+        :param tags: names of tags that are added to each image
+        :param embed: bool, compute the embeddings, otherwise only add the images
+        """
+        from src.config import DEFAULT_CLIP_MODEL
+
+        self.db = db
+        self.model = model or DEFAULT_CLIP_MODEL
+        self.device = device
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.tags = list(tags) if tags else None
+        self.embed = embed
+        self.num_images = 0
+        self.num_embeddings = 0
+        self.num_errors = 0
+        self._queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        if self.running():
+            return
+        self._thread = threading.Thread(name=self.__class__.__name__, target=self._mainloop, daemon=True)
+        self._thread.start()
+
+    def stop(self, flush: bool = True):
+        """
+        Stop the worker.
+
+        :param flush: bool, process the queued files first, otherwise they are dropped
+        """
+        if not self.running():
+            return
+
+        if not flush:
+            try:
+                while True:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+            except queue.Empty:
+                pass
+
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def put(self, filename: Union[str, Path], meta: Optional[dict] = None):
+        """
+        Queue a file, this returns immediately. Files that are not images are ignored.
+
+        :param filename: str or Path
+        :param meta: dict, stored in `ImageEntry.meta`
+        """
+        self._queue.put((Path(filename), meta))
+
+    def flush(self):
+        """
+        Wait until all queued files are processed
+        """
+        self._queue.join()
+
+    def status(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "images": self.num_images,
+            "embeddings": self.num_embeddings,
+            "errors": self.num_errors,
+        }
+
+    def _mainloop(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0., deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._queue.task_done()
+                    stop = True
+                    break
+                batch.append(item)
+
+            try:
+                self._process(batch)
+            except Exception as e:
+                self.num_errors += len(batch)
+                log.log(f"{self.__class__.__name__}: {type(e).__name__}: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _process(self, batch: List[Tuple[Path, Optional[dict]]]):
+        from src.image import is_image_filename
+        from src.clip import get_image_features
+
+        batch = [(filename, meta) for filename, meta in batch if is_image_filename(filename)]
+        missing = [filename for filename, meta in batch if not filename.is_file()]
+        if missing:
+            self.num_errors += len(missing)
+            log.log(f"{self.__class__.__name__}: files do not exist: {', '.join(str(f) for f in missing)}")
+            batch = [(filename, meta) for filename, meta in batch if filename.is_file()]
+        if not batch:
+            return
+
+        with self.db.sql_session() as sql_session:
+            tags = self.db.get_tags(self.tags, sql_session=sql_session) if self.tags else None
+            image_ids = [
+                self.db.add_image(filename, tags=tags, meta=meta, sql_session=sql_session).id
+                for filename, meta in batch
+            ]
+            self.num_images += len(image_ids)
+
+            if self.embed:
+                features = get_image_features(
+                    [filename for filename, meta in batch], model=self.model, device=self.device,
+                )
+                self.num_embeddings += self.db.write_embeddings(
+                    self.model, image_ids, features, sql_session=sql_session,
+                )
@@ -0,0 +1,276 @@
+"""
+Versioned upgrades of the database schema.
+
+Missing tables are created from the current models, then every step after the
+stored version is run, each in its own transaction. New databases and databases
+created before the `schema_version` table existed count as version 0, so the steps
+must work on tables that are already up to date (e.g. ``CREATE INDEX IF NOT EXISTS``).
+
+To change the schema: change the models in `imagesql.py` and append an
+upgrade step that brings an existing database to the same state.
+"""
+from typing import Callable, List
+
+import sqlalchemy as sq
+
+from src import log
+from .imagesql import ImageDBBase, SchemaVersion, ImageEntry, Embedding, StatCounter
+
+
+def _create_index(connection: sq.Connection, table: sq.Table, name: str):
+    for index in table.indexes:
+        if index.name == name:
+            index.create(connection, checkfirst=True)
+            return
+    raise ValueError(f"Index '{name}' not defined on table '{table.name}'")
+
+
+def _upgrade_1_unique_image_path_name(connection: sq.Connection):
+    """
+    Merge duplicate (path, name) images into the oldest entry
+    and add a unique index for `ImageDB.get_image(path=...)`
+    """
+    duplicates = connection.execute(sq.text("""
+        SELECT image.id, keep.id FROM image
+        JOIN (
+            SELECT path, name, MIN(id) AS id FROM image GROUP BY path, name HAVING COUNT(*) > 1
+        ) AS keep ON image.path = keep.path AND image.name = keep.name
+        WHERE image.id != keep.id
+    """)).all()
+
+    for duplicate_id, keep_id in duplicates:
+        params = {"duplicate_id": duplicate_id, "keep_id": keep_id}
+        connection.execute(sq.text(
+            "UPDATE embedding SET image_id = :keep_id WHERE image_id = :duplicate_id"
+        ), params)
+        connection.execute(sq.text("""
+            INSERT INTO image_tags (image_id, tag_id)
+            SELECT :keep_id, tag_id FROM image_tags WHERE image_id = :duplicate_id
+            AND tag_id NOT IN (SELECT tag_id FROM image_tags WHERE image_id = :keep_id)
+        """), params)
+        connection.execute(sq.text("DELETE FROM image_tags WHERE image_id = :duplicate_id"), params)
+        connection.execute(sq.text("DELETE FROM image WHERE id = :duplicate_id"), params)
+
+    _create_index(connection, ImageEntry.__table__, "ix_image_path_name")
+
+
+def _upgrade_2_unique_embedding_model_image_id(connection: sq.Connection):
+    """
+    Keep only the newest embedding per (model, image_id)
+    and add the unique composite index
+    """
+    connection.execute(sq.text("""
+        DELETE FROM embedding WHERE id NOT IN (
+            SELECT MAX(id) FROM embedding GROUP BY model, image_id
+        )
+    """))
+
+    _create_index(connection, Embedding.__table__, "ix_embedding_model_image_id")
+
+
+# (table, SQL expression of the counter name, {row} is NEW or OLD)
+_COUNTED_TABLES = (
+    ("image", "'images'"),
+    ("tag", "'tags'"),
+    ("embedding", "'embeddings/' || {row}.model"),
+)
+
+
+def _upgrade_3_stat_counter_triggers(connection: sq.Connection):
+    """
+    Maintain the row counts in `stat_counter` with triggers,
+    so `ImageDB.status()` does not need to scan the tables
+    """
+    if connection.dialect.name == "sqlite":
+        for table, counter in _COUNTED_TABLES:
+            for event, row, delta in (("INSERT", "NEW", "+ 1"), ("DELETE", "OLD", "- 1")):
+                name = counter.format(row=row)
+                connection.execute(sq.text(f"""
+                    CREATE TRIGGER IF NOT EXISTS tr_{table}_count_{event.lower()}
+                    AFTER {event} ON {table} FOR EACH ROW BEGIN
+                        INSERT OR IGNORE INTO stat_counter (name, value) VALUES ({name}, 0);
+                        UPDATE stat_counter SET value = value {delta} WHERE name = {name};
+                    END
+                """))
+
+        connection.execute(sq.text("""
+            CREATE TRIGGER IF NOT EXISTS tr_embedding_count_update
+            AFTER UPDATE OF model ON embedding FOR EACH ROW WHEN OLD.model IS NOT NEW.model BEGIN
+                INSERT OR IGNORE INTO stat_counter (name, value) VALUES ('embeddings/' || NEW.model, 0);
+                UPDATE stat_counter SET value = value + 1 WHERE name = 'embeddings/' || NEW.model;
+                UPDATE stat_counter SET value = value - 1 WHERE name = 'embeddings/' || OLD.model;
+            END
+        """))
+
+    elif connection.dialect.name == "postgresql":
+        connection.execute(sq.text("""
+            CREATE OR REPLACE FUNCTION stat_counter_add(counter_name TEXT, delta BIGINT) RETURNS void AS $$
+            BEGIN
+                INSERT INTO stat_counter (name, value) VALUES (counter_name, delta)
+                ON CONFLICT (name) DO UPDATE SET value = stat_counter.value + delta;
+            END $$ LANGUAGE plpgsql
+        """))
+        for table, counter in _COUNTED_TABLES:
+            connection.execute(sq.text(f"""
+                CREATE OR REPLACE FUNCTION tr_{table}_count() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        PERFORM stat_counter_add({counter.format(row="NEW")}, 1);
+                    ELSIF TG_OP = 'DELETE' THEN
+                        PERFORM stat_counter_add({counter.format(row="OLD")}, -1);
+                    ELSIF {counter.format(row="OLD")} IS DISTINCT FROM {counter.format(row="NEW")} THEN
+                        PERFORM stat_counter_add({counter.format(row="OLD")}, -1);
+                        PERFORM stat_counter_add({counter.format(row="NEW")}, 1);
+                    END IF;
+                    RETURN NULL;
+                END $$ LANGUAGE plpgsql
+            """))
+            connection.execute(sq.text(f"DROP TRIGGER IF EXISTS tr_{table}_count ON {table}"))
+            connection.execute(sq.text(f"""
+                CREATE TRIGGER tr_{table}_count AFTER INSERT OR DELETE OR UPDATE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION tr_{table}_count()
+            """))
+
+    else:
+        raise NotImplementedError(f"stat_counter triggers for database '{connection.dialect.name}'")
+
+    # initialize counters from the current state
+    connection.execute(sq.delete(StatCounter))
+    connection.execute(sq.text("""
+        INSERT INTO stat_counter (name, value)
+        SELECT 'images', COUNT(*) FROM image
+        UNION ALL SELECT 'tags', COUNT(*) FROM tag
+        UNION ALL SELECT 'embeddings/' || model, COUNT(*) FROM embedding GROUP BY model
+    """))
+
+
+def _upgrade_4_embedding_dims(connection: sq.Connection):
+    """
+    Store the length of each embedding vector,
+    so the dimensions of a model are known without parsing the data
+    """
+    columns = {c["name"] for c in sq.inspect(connection).get_columns(Embedding.__tablename__)}
+    if "dims" not in columns:
+        connection.execute(sq.text("ALTER TABLE embedding ADD COLUMN dims INTEGER"))
+
+    if connection.dialect.name == "postgresql":
+        # works for pgvector and REAL[] columns
+        length = "cardinality(data::real[])"
+    else:
+        # number of commas in the comma-separated string + 1
+        length = "length(data) - length(replace(data, ',', '')) + 1"
+
+    connection.execute(sq.text(
+        f"UPDATE embedding SET dims = {length} WHERE dims IS NULL AND data IS NOT NULL"
+    ))
+
+
+def _upgrade_5_image_meta(connection: sq.Connection):
+    """
+    Add the `image.meta` column
+    """
+    columns = {c["name"] for c in sq.inspect(connection).get_columns(ImageEntry.__tablename__)}
+    if "meta" not in columns:
+        connection.execute(sq.text("ALTER TABLE image ADD COLUMN meta JSON"))
+
+
+def _upgrade_6_embedding_autoincrement(connection: sq.Connection):
+    """
+    Do not reuse the ids of deleted embeddings in sqlite.
+
+    A replaced embedding with the highest id would otherwise get the same id again
+    and persisted `SimIndex`es would not see the change.
+    PostgreSQL sequences never reuse ids.
+    """
+    if connection.dialect.name != "sqlite":
+        return
+
+    sql = connection.execute(sq.text(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'embedding'"
+    )).scalar()
+    if "AUTOINCREMENT" in sql.upper():
+        return
+
+    # sqlite can not alter the primary key, so the table is copied
+    # and the indices and triggers are created again
+    connection.execute(sq.text("ALTER TABLE embedding RENAME TO embedding_old"))
+    for type, name in connection.execute(sq.text("""
+        SELECT type, name FROM sqlite_master
+        WHERE tbl_name = 'embedding_old' AND type IN ('index', 'trigger') AND sql IS NOT NULL
+    """)).all():
+        connection.execute(sq.text(f"DROP {type.upper()} {name}"))
+
+    Embedding.__table__.create(connection)
+    connection.execute(sq.text("""
+        INSERT INTO embedding (id, model, data, dims, image_id)
+        SELECT id, model, data, dims, image_id FROM embedding_old
+    """))
+    connection.execute(sq.text("DROP TABLE embedding_old"))
+    _upgrade_3_stat_counter_triggers(connection)
+
+
+def _upgrade_7_long_model_names(connection: sq.Connection):
+    """
+    Widen `embedding.model` for checkpoint paths, and `stat_counter.name` accordingly.
+    sqlite does not enforce the length of VARCHAR columns.
+    """
+    if connection.dialect.name != "postgresql":
+        return
+
+    for table, column in ((Embedding.__table__, "model"), (StatCounter.__table__, "name")):
+        connection.execute(sq.text(
+            f"ALTER TABLE {table.name} ALTER COLUMN {column} TYPE VARCHAR({table.c[column].type.length})"
+        ))
+
+
+# step i upgrades version i to i + 1
+UPGRADE_STEPS: List[Callable[[sq.Connection], None]] = [
+    _upgrade_1_unique_image_path_name,
+    _upgrade_2_unique_embedding_model_image_id,
+    _upgrade_3_stat_counter_triggers,
+    _upgrade_4_embedding_dims,
+    _upgrade_5_image_meta,
+    _upgrade_6_embedding_autoincrement,
+    _upgrade_7_long_model_names,
+]
+
+SCHEMA_VERSION: int = len(UPGRADE_STEPS)
+
+
+def get_schema_version(connection: sq.Connection) -> int:
+    version = connection.execute(sq.select(sq.func.max(SchemaVersion.version))).scalar()
+    return version or 0
+
+
+def _set_schema_version(connection: sq.Connection, version: int):
+    connection.execute(sq.delete(SchemaVersion))
+    connection.execute(sq.insert(SchemaVersion).values(version=version))
+
+
+def upgrade_schema(engine: sq.Engine, verbose: bool = False):
+    """
+    Create the database schema or upgrade it to `SCHEMA_VERSION`
+    """
+    is_new = not sq.inspect(engine).has_table(ImageEntry.__tablename__)
+
+    # creates all missing tables, existing tables are not touched
+    ImageDBBase.metadata.create_all(engine)
+
+    # a new database runs all steps as well because some things
+    # (e.g. triggers) are not part of the table definitions
+    with engine.connect() as connection:
+        version = get_schema_version(connection)
+
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database schema version {version} is newer than supported version {SCHEMA_VERSION}"
+        )
+
+    for step_version in range(version, SCHEMA_VERSION):
+        step = UPGRADE_STEPS[step_version]
+        if verbose and not is_new:
+            log.log(f"ImageDB: upgrading schema to version {step_version + 1}: {step.__name__}")
+
+        with engine.begin() as connection:
+            step(connection)
+            _set_schema_version(connection, step_version + 1)
@@ -7,15 +7,11 @@ from .handlers import *
 from .staticresources import StaticResources
 
 
-def run_server(
+def create_app(
         db: ImageDB,
         host: str = "127.0.0.1",
-        port: int = 8000,
-        verbose: bool = False,
         debug: bool = True,
-):
-    # tornado.ioloop.IOLoop.current().start()
-
+) -> tornado.web.Application:
     handler_kwargs = {"resources": StaticResources(db=db)}
 
     app = tornado.web.Application(
@@ -23,6 +19,7 @@ def run_server(
             (r"/status/", StatusHandler, handler_kwargs),
             (r"/image/([0-9]+)/", ImageHandler, handler_kwargs),
             (r"/query/", QueryHandler, handler_kwargs),
+            (r"/metrics/", MetricsHandler, handler_kwargs),
         ],
         default_host=host,
         #static_path=str(config.STATIC_PATH),
@@ -31,6 +28,19 @@ def run_server(
         static_handler_class=handlers.NoCacheStaticFileHandler,
         #default_handler_class=IndexFallbackHandler,
     )
+    return app
+
+
+def run_server(
+        db: ImageDB,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        verbose: bool = False,
+        debug: bool = True,
+):
+    # tornado.ioloop.IOLoop.current().start()
+
+    app = create_app(db=db, host=host, debug=debug)
     app.listen(port)
 
     if verbose:
@@ -1,5 +1,6 @@
 import json
-from typing import Optional, Mapping, Any
+import time
+from typing import Optional, Mapping, Any, Dict
 
 import sqlalchemy as sq
 import tornado.web
@@ -30,6 +31,15 @@ class BaseHandler(tornado.web.RequestHandler):
         self.set_header("Access-Control-Allow-Origin", "*")
         super().write(*args, **kwargs)
 
+    def on_finish(self):
+        self.resources.metrics.observe_request(
+            handler=type(self).__name__,
+            method=self.request.method,
+            status=self.get_status(),
+            seconds=self.request.request_time(),
+        )
+
+
 class JsonBaseHandler(BaseHandler):
 
     def write(self, data: Mapping[str, Any]):
@@ -48,7 +58,8 @@ class JsonBaseHandler(BaseHandler):
 class StatusHandler(JsonBaseHandler):
 
     def get(self):
-        self.write(self.db.status())
+        detailed = self.get_argument("detailed", "") not in ("", "0", "false")
+        self.write(self.db.status(detailed=detailed))
 
 
 
@@ -76,10 +87,41 @@ class QueryHandler(JsonBaseHandler):
         response = {"images": []}
         if text:
             index = self.db.sim_index(model=model)
-            result = index.images_by_text(prompt=text, count=count, device=device)
-
-            for image_entry, score in result:
-                response["images"].append({"id": image_entry.id, "score": round(score, 3)})
+            timings: Dict[str, float] = {}
+
+            start_time = time.perf_counter()
+            feature = index.text_features(prompt=text, device=device)
+            timings["encode"] = time.perf_counter() - start_time
+
+            with self.db.sql_session() as sql_session:
+                start_time = time.perf_counter()
+                id_scores = index.search_features(feature=feature, count=count, sql_session=sql_session)
+                timings["search"] = time.perf_counter() - start_time
+
+                # one query for all images, ids of deleted images are dropped
+                start_time = time.perf_counter()
+                ids = [image_id for image_id, _ in id_scores]
+                entries = {
+                    e.id: e
+                    for e in sql_session.query(ImageEntry).filter(ImageEntry.id.in_(ids))
+                } if ids else {}
+                timings["hydrate"] = time.perf_counter() - start_time
+
+            for image_id, score in id_scores:
+                if image_id in entries:
+                    response["images"].append({"id": image_id, "score": round(score, 3)})
+
+            self.resources.metrics.observe_query_stages(timings)
+            self.set_header("Server-Timing", ", ".join(
+                f"{stage};dur={seconds * 1000:.3f}"
+                for stage, seconds in timings.items()
+            ))
 
         self.write(response)
 
+
+class MetricsHandler(BaseHandler):
+
+    def get(self):
+        self.set_header("Content-Type", self.resources.metrics.CONTENT_TYPE)
+        self.write(self.resources.metrics.render(self.db))
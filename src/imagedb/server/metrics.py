@@ -0,0 +1,228 @@
+"""
+Counters and histograms in the Prometheus text format,
+see https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+import math
+import threading
+from typing import Optional, Dict, List, Tuple, Sequence, Iterable, Union, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from src.imagedb import ImageDB
+
+# the default buckets of the prometheus client libraries, in seconds
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1., 2.5, 5., 7.5, 10.)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: Union[int, float]) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (
+        str(v).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+        for v in values
+    )
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class _Metric:
+    type: str = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"Metric '{self.name}' expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labels)
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type}",
+            *self._samples(),
+        ]
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1., **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._label_values(labels), 0.)
+
+    def _samples(self) -> Iterable[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            labels: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        """
+        :param buckets: upper bounds of the buckets in increasing order,
+            the +Inf bucket is added
+        """
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: [count per bucket (not cumulative) + the +Inf bucket, sum]
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._label_values(labels)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = ([0] * (len(self.buckets) + 1), [0.])
+            counts, total = self._values[key]
+            counts[index] += 1
+            total[0] += value
+
+    def count(self, **labels: str) -> int:
+        values = self._values.get(self._label_values(labels))
+        return sum(values[0]) if values else 0
+
+    def _samples(self) -> Iterable[str]:
+        with self._lock:
+            values = sorted((key, (list(counts), total[0])) for key, (counts, total) in self._values.items())
+
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf, ), counts):
+                cumulative += count
+                labels = _format_labels(self.labels + ("le", ), key + (_format_value(float(bound)), ))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labels, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class ServerMetrics:
+    """
+    The metrics of one server application
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.requests = Counter(
+            "imagedb_http_requests_total", "Number of handled requests",
+            ("handler", "method", "status"),
+        )
+        self.request_seconds = Histogram(
+            "imagedb_http_request_duration_seconds", "Time to handle a request",
+            ("handler", "method"), buckets=buckets,
+        )
+        self.query_stage_seconds = Histogram(
+            "imagedb_query_stage_duration_seconds",
+            "Time of the query stages: 'encode' (CLIP text features), 'search' (faiss"
+            " or database) and 'hydrate' (loading the images)",
+            ("stage", ), buckets=buckets,
+        )
+        self.index_size = Gauge(
+            "imagedb_index_size", "Number of embeddings in the loaded similarity indices", ("model", ),
+        )
+        self.clip_models = Gauge("imagedb_clip_models_loaded", "Number of CLIP models in the cache")
+        self.clip_models_max = Gauge("imagedb_clip_models_max", "Maximum number of cached CLIP models")
+        self.sql_pool = Gauge(
+            "imagedb_sql_pool_connections",
+            "Connections of the SQL pool, 'size', 'checked_out' and 'overflow'",
+            ("state", ),
+        )
+
+    def observe_request(self, handler: str, method: str, status: int, seconds: float):
+        self.requests.inc(handler=handler, method=method, status=str(status))
+        self.request_seconds.observe(seconds, handler=handler, method=method)
+
+    def observe_query_stages(self, timings: Dict[str, float]):
+        for stage, seconds in timings.items():
+            self.query_stage_seconds.observe(seconds, stage=stage)
+
+    def update_gauges(self, db: "ImageDB"):
+        """
+        Read the current size of the indices, the model cache and the SQL pool
+        """
+        from src.clip import ClipSingleton
+
+        self.index_size.clear()
+        for model, index in db.sim_indices().items():
+            if not index.server_side:
+                self.index_size.set(index.size, model=model)
+
+        self.clip_models.set(len(ClipSingleton.loaded()))
+        self.clip_models_max.set(ClipSingleton.max_models)
+
+        self.sql_pool.clear()
+        # pools without a fixed size (e.g. NullPool, StaticPool) have none of these
+        pool = db.sql_engine.pool
+        for state, attribute in (("size", "size"), ("checked_out", "checkedout"), ("overflow", "overflow")):
+            method = getattr(pool, attribute, None)
+            if method is not None:
+                self.sql_pool.set(method(), state=state)
+
+    def render(self, db: Optional["ImageDB"] = None) -> str:
+        """
+        Return all metrics in the Prometheus text format
+
+        :param db: ImageDB, update the gauges from this database first
+        """
+        if db is not None:
+            self.update_gauges(db)
+
+        lines = []
+        for metric in (
+                self.requests, self.request_seconds, self.query_stage_seconds,
+                self.index_size, self.clip_models, self.clip_models_max, self.sql_pool,
+        ):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
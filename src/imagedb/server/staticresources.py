@@ -1,9 +1,11 @@
 from typing import Optional, Dict
 
 from src.imagedb import ImageDB
+from .metrics import ServerMetrics
 
 
 class StaticResources:
 
-    def __init__(self, db: ImageDB):
+    def __init__(self, db: ImageDB, metrics: Optional[ServerMetrics] = None):
         self.db = db
+        self.metrics = metrics if metrics is not None else ServerMetrics()
@@ -1,58 +1,219 @@
-from typing import List, Iterable, Optional, Tuple
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import List, Iterable, Optional, Tuple, Generator
 
+import sqlalchemy as sq
 from sqlalchemy.orm import Session
 import numpy as np
 import faiss
 from tqdm import tqdm
 
+from src import log
+from src.profiling import span
 from src.config import DEFAULT_CLIP_MODEL
-from src.clip import MODEL_DIMENSIONS, get_text_features, get_image_features
+from src.clip import ClipSingleton, get_text_features, get_image_features
 from .imagesql import ImageEntry, Embedding
 
 
 class SimIndex:
+    """
+    Similarity search over the embeddings of one CLIP model.
+
+    The faiss index is stored in ``<database_path>/indices/`` together with the
+    id of the last embedding it contains. When loaded again, only the embeddings
+    written since then are added. `ImageDB.write_embeddings` replaces embeddings
+    by new rows, so those are picked up as well. If the number of embeddings
+    does not match afterwards (e.g. some were deleted) the index is rebuilt.
+    """
 
     def __init__(
             self,
             db: "ImageDB",
             model: Optional[str] = None,
-            verbose: bool = False
+            verbose: bool = False,
+            server_side: Optional[bool] = None,
+            persist: bool = True,
     ):
+        """
+        :param db: ImageDB
+        :param model: str, name of CLIP model, defaults to `config.DEFAULT_CLIP_MODEL`
+        :param verbose: bool, show progress of index creation
+        :param server_side: bool, if True, search in the database (e.g. PostgreSQL + pgvector)
+            instead of loading all embeddings into a faiss index.
+            Defaults to True if the database backend supports it.
+        :param persist: bool, load and store the faiss index in `ImageDB.index_path`
+        """
         from .imagedb import ImageDB
 
         self.db: ImageDB = db
         self.model = model or DEFAULT_CLIP_MODEL
         self.verbose = verbose
-        self.dimensions = MODEL_DIMENSIONS[self.model]
-        self._index_to_embedding_pk = []
-        self._index_to_image_pk = []
-        self._index = faiss.IndexFlatIP(self.dimensions)
-        self._create()
-
-    def _create(self, batch_size: int = 100):
-        with self.db.sql_session() as sql_session:
-            qset = (
-                sql_session
-                    .query(Embedding)
-                    .filter(Embedding.model == self.model)
-                    .order_by("id")
-            )
-            total = qset.count()
+        self.server_side = db.backend.supports_vector_search if server_side is None else server_side
+        self.persist = persist and not self.server_side
+        # the stored embeddings define the size, the model is only loaded
+        # to get the dimensions if there are no embeddings yet
+        self.dimensions = db.embedding_dimensions(self.model) or ClipSingleton.dimensions(self.model)
+        # id of the last embedding in the faiss index
+        self.max_embedding_id: Optional[int] = None
+        self._index = None
+        # guards the faiss index, which can not be searched while it's changed
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        if not self.server_side:
+            with span("simindex.load"):
+                loaded = self.persist and self._load()
+            if not loaded:
+                self._index = self._create_index()
+            self.sync()
+        self.created_at = time.time()
+
+    @property
+    def size(self) -> int:
+        """
+        Number of embeddings in the faiss index
+        """
+        return self._index.ntotal if self._index is not None else 0
+
+    @property
+    def filename(self) -> Path:
+        """
+        The file of the persisted faiss index, a ``.json`` file with the same name holds the state
+        """
+        slug = "".join(c if c.isalnum() else "-" for c in Path(self.model).name)[:32]
+        digest = hashlib.sha1(self.model.encode()).hexdigest()[:8]
+        return self.db.index_path / f"{slug}-{digest}.faiss"
+
+    def sync(self) -> int:
+        """
+        Add the embeddings that were written since the last sync
+        and store the index if it changed.
+
+        :return: int, number of added embeddings
+        """
+        if self.server_side:
+            return 0
+
+        with self._sync_lock, span("simindex.sync"):
+            with self.db.sql_session() as sql_session:
+                num_added = self._add_new_embeddings(sql_session)
+
+                count = sql_session.execute(
+                    sq.select(sq.func.count()).select_from(Embedding).where(Embedding.model == self.model)
+                ).scalar()
+
+                if count != self.size:
+                    self.db._log(f"rebuilding index of '{self.model}', {self.size} of {count} embeddings")
+                    index, self.max_embedding_id = self._create_index(), None
+                    num_added = self._add_new_embeddings(sql_session, index=index)
+                    with self._lock:
+                        self._index = index
+
+            if num_added and self.persist:
+                with span("simindex.save"):
+                    self._save()
+
+            self.created_at = time.time()
+            return num_added
+
+    def _create_index(self) -> faiss.Index:
+        # faiss ids are the image ids
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(self.dimensions))
+
+    def _add_new_embeddings(
+            self,
+            sql_session: Session,
+            index: Optional[faiss.Index] = None,
+            batch_size: int = 10_000,
+    ) -> int:
+        """
+        Add all embeddings with an id above `max_embedding_id`.
+        Images that are already in the index are replaced.
+        """
+        from .export import embeddings_to_numpy
+
+        query = sq.select(Embedding.id, Embedding.image_id, Embedding.data).where(Embedding.model == self.model)
+        if self.max_embedding_id is not None:
+            query = query.where(Embedding.id > self.max_embedding_id)
+
+        progress = None
+        if self.verbose:
+            total = sql_session.execute(sq.select(sq.func.count()).select_from(query.subquery())).scalar()
+            progress = tqdm(desc="building faiss index", total=total)
+
+        num_added = 0
+        while True:
+            rows = sql_session.execute(query.order_by(Embedding.id).limit(batch_size)).all()
+            if not rows:
+                break
+
+            image_ids = np.array([r[1] for r in rows], dtype=np.int64)
+            embeddings = embeddings_to_numpy([r[2] for r in rows], self.dimensions)
+
+            with self._lock:
+                target = index if index is not None else self._index
+                target.remove_ids(image_ids)
+                target.add_with_ids(embeddings, image_ids)
+                self.max_embedding_id = rows[-1][0]
+
+            query = query.where(Embedding.id > self.max_embedding_id)
+            num_added += len(rows)
+            if progress is not None:
+                progress.update(len(rows))
+
+        if progress is not None:
+            progress.close()
+        return num_added
+
+    def _load(self) -> bool:
+        filename = self.filename
+        state_filename = filename.with_suffix(".json")
+        try:
+            state = json.loads(state_filename.read_text())
+            stat = filename.stat()
+        except (OSError, ValueError):
+            return False
+
+        # the state belongs to exactly this file
+        if (
+                state.get("model") != self.model
+                or state.get("dimensions") != self.dimensions
+                or state.get("file") != [stat.st_size, stat.st_mtime_ns]
+        ):
+            return False
 
-            iterable = range((total + batch_size - 1) // batch_size)
-            if self.verbose:
-                iterable = tqdm(iterable, desc="building faiss index")
+        try:
+            index = faiss.read_index(str(filename))
+        except RuntimeError:
+            return False
 
-            for i in iterable:
-                embedding_entries = qset[i * batch_size: (i + 1) * batch_size]
-                embeddings = []
-                for e in embedding_entries:
-                    embeddings.append(e.to_numpy().reshape(1, -1))
-                    self._index_to_embedding_pk.append(e.id)
-                    self._index_to_image_pk.append(e.image_id)
+        self._index = index
+        self.max_embedding_id = state["max_embedding_id"]
+        return True
 
-                embeddings = np.concatenate(embeddings, axis=0)
-                self._index.add(embeddings)
+    def _save(self):
+        filename = self.filename
+        state_filename = filename.with_suffix(".json")
+        try:
+            filename.parent.mkdir(parents=True, exist_ok=True)
+            with self._lock:
+                faiss.write_index(self._index, f"{filename}.tmp")
+                state = {
+                    "model": self.model,
+                    "dimensions": self.dimensions,
+                    "max_embedding_id": self.max_embedding_id,
+                }
+            os.replace(f"{filename}.tmp", filename)
+            stat = filename.stat()
+            state["file"] = [stat.st_size, stat.st_mtime_ns]
+            Path(f"{state_filename}.tmp").write_text(json.dumps(state))
+            os.replace(f"{state_filename}.tmp", state_filename)
+        except OSError as e:
+            # e.g. a read-only database directory
+            log.log(f"SimIndex: can not store index of '{self.model}': {e}")
 
     def images_by_text(
             self,
@@ -62,23 +223,80 @@ class SimIndex:
             device: str = "auto",
             sql_session: Optional[Session] = None
     ) -> List[Tuple[ImageEntry, float]]:
+        with self.db.sql_session(sql_session) as sql_session:
+            return list(self.iter_images_by_text(
+                prompt=prompt, count=count, device=device, sql_session=sql_session,
+            ))
 
-        feature = get_text_features(text=[prompt], model=self.model, device=device)
+    def search_text(
+            self,
+            prompt: str,
+            count: int = 1,
+            device: str = "auto",
+            sql_session: Optional[Session] = None
+    ) -> List[Tuple[int, float]]:
+        """
+        Return the `count` most similar (image id, score) tuples, best first
+        """
+        feature = self.text_features(prompt=prompt, device=device)
+        return self.search_features(feature=feature, count=count, sql_session=sql_session)
 
-        distances, labels = self._index.search(feature, count)
+    def text_features(self, prompt: str, device: str = "auto") -> np.ndarray:
+        """
+        Return the CLIP features of the prompt as array of shape [1, dimensions]
+        """
+        with span("simindex.text_features"):
+            feature = get_text_features(text=[prompt], model=self.model, device=device)
+        if feature.shape[-1] != self.dimensions:
+            raise ValueError(
+                f"Model '{self.model}' returned {feature.shape[-1]} dimensions"
+                f" but the index has {self.dimensions}"
+            )
+        return feature
 
-        #combined = [
-        #    (d, l)
-        #    for d, l in zip(distances[0], labels[0])
-        #]
-        #combined = sorted(combined, key=lambda d, l: d, reverse=True)
+    def search_features(
+            self,
+            feature: np.ndarray,
+            count: int = 1,
+            sql_session: Optional[Session] = None
+    ) -> List[Tuple[int, float]]:
+        """
+        Return the `count` (image id, score) tuples most similar to the features, best first
 
-        with self.db.sql_session(sql_session) as sql_session:
-            return [
-                (
-                    self.db.get_image(id=self._index_to_image_pk[l], sql_session=sql_session),
-                    float(d),
+        :param feature: array of shape [1, dimensions], see `text_features`
+        """
+        if self.server_side:
+            with self.db.sql_session(sql_session) as sql_session, span("simindex.search"):
+                return self.db.backend.vector_search(
+                    sql_session.connection(), model=self.model, vector=feature[0], count=count,
                 )
-                for d, l in zip(distances[0], labels[0])
-                if l >= 0
-            ]
+
+        with self._lock, span("simindex.search"):
+            distances, labels = self._index.search(feature, count)
+
+        return [
+            (int(l), float(d))
+            for d, l in zip(distances[0], labels[0])
+            if l >= 0
+        ]
+
+    def iter_images_by_text(
+            self,
+            prompt: str,
+            count: int = 1,
+            device: str = "auto",
+            sql_session: Optional[Session] = None
+    ) -> Generator[Tuple[ImageEntry, float], None, None]:
+        """
+        Yield the `count` most similar (ImageEntry, score) tuples, best first.
+
+        Each image is loaded from the database when it's yielded,
+        so the first result is available before all are loaded.
+        """
+        id_scores = self.search_text(prompt=prompt, count=count, device=device, sql_session=sql_session)
+
+        with self.db.sql_session(sql_session) as sql_session:
+            for image_id, score in id_scores:
+                with span("simindex.hydrate"):
+                    entry = self.db.get_image(id=image_id, sql_session=sql_session)
+                yield entry, score
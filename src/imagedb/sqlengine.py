@@ -0,0 +1,116 @@
+import dataclasses
+import threading
+from pathlib import Path
+from typing import Optional, List
+
+import sqlalchemy as sq
+from sqlalchemy.orm import Session
+
+
+@dataclasses.dataclass
+class SqliteProfile:
+    """
+    Settings applied to each new SQLite connection.
+
+    Any pragma set to ``None`` is left at the SQLite default,
+    see https://www.sqlite.org/pragma.html
+    """
+    # "wal" lets readers continue while a writer commits
+    journal_mode: Optional[str] = "wal"
+    # "normal" is safe in WAL mode and avoids a fsync per commit
+    synchronous: Optional[str] = "normal"
+    # bytes of the database file to memory-map
+    mmap_size: Optional[int] = 256 * 1024 * 1024
+    # positive: number of pages, negative: size in KiB
+    cache_size: Optional[int] = -64 * 1024
+    # milliseconds to wait for a lock before raising "database is locked"
+    busy_timeout: Optional[int] = 10_000
+    # reuse one Session per thread for (nested) `ImageDB.sql_session()` calls
+    thread_sessions: bool = True
+
+    @classmethod
+    def legacy(cls) -> "SqliteProfile":
+        """
+        The untuned SQLite defaults, a fresh Session per call.
+        """
+        return cls(
+            journal_mode=None,
+            synchronous=None,
+            mmap_size=None,
+            cache_size=None,
+            busy_timeout=None,
+            thread_sessions=False,
+        )
+
+    def pragmas(self, read_only: bool = False) -> List[str]:
+        statements = []
+        # journal mode is stored in the database file and can only be changed by a writer
+        if self.journal_mode is not None and not read_only:
+            statements.append(f"PRAGMA journal_mode = {self.journal_mode}")
+        if self.synchronous is not None:
+            statements.append(f"PRAGMA synchronous = {self.synchronous}")
+        if self.mmap_size is not None:
+            statements.append(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        if self.cache_size is not None:
+            statements.append(f"PRAGMA cache_size = {int(self.cache_size)}")
+        if self.busy_timeout is not None:
+            statements.append(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        if read_only:
+            statements.append("PRAGMA query_only = 1")
+        return statements
+
+    def create_engine(self, filename: Path, read_only: bool = False) -> sq.Engine:
+        engine = sq.create_engine(f"sqlite:///{filename}")
+
+        pragmas = self.pragmas(read_only=read_only)
+        if pragmas:
+            @sq.event.listens_for(engine, "connect")
+            def _on_connect(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for statement in pragmas:
+                    cursor.execute(statement)
+                cursor.close()
+
+        return engine
+
+
+class ThreadSessionPool:
+    """
+    Hands out one Session per thread.
+
+    Nested `session()` blocks in the same thread share the Session
+    and only the outermost block closes it (which returns the
+    connection to the engine's pool).
+    """
+
+    def __init__(self, engine: sq.Engine):
+        self.engine = engine
+        self._local = threading.local()
+
+    def session(self) -> "_PooledSession":
+        return _PooledSession(self)
+
+    def _acquire(self) -> Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = Session(self.engine)
+            self._local.depth = 0
+        self._local.depth += 1
+        return session
+
+    def _release(self):
+        self._local.depth -= 1
+        if self._local.depth <= 0:
+            self._local.session.close()
+
+
+class _PooledSession:
+
+    def __init__(self, pool: ThreadSessionPool):
+        self.pool = pool
+
+    def __enter__(self) -> Session:
+        return self.pool._acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.pool._release()
@@ -0,0 +1,325 @@
+"""
+Streaming execution of `Stage`s.
+
+Each stage runs in its own thread and reads batches from a bounded queue,
+so a slow stage blocks the stages before it instead of piling up images in memory.
+Stages with an `executor` spread their batches over a thread or process pool,
+model stages process one batch at a time on their device.
+"""
+import collections
+import concurrent.futures
+import dataclasses
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Sequence, Union, Tuple, TYPE_CHECKING
+
+from .image import ImageType, is_image_filename
+from .stage import Stage, StageItem
+
+if TYPE_CHECKING:
+    from .imagedb import ImageDB
+
+
+_END = object()
+
+
+class _Stopped(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class StageStats:
+    name: str
+    batch_size: int
+    device: str
+    executor: Optional[str]
+    items_in: int = 0
+    items_out: int = 0
+    batches: int = 0
+    # seconds spent in `Stage.step_batch`, summed over all workers
+    busy_seconds: float = 0.
+    # seconds waiting for the next stage to accept results
+    blocked_seconds: float = 0.
+    # `time.monotonic()` at the start of the first and the end of the last batch
+    first_start: Optional[float] = None
+    last_end: Optional[float] = None
+
+    @property
+    def active_seconds(self) -> float:
+        """
+        Wall-clock seconds from the start of the first to the end of the last batch
+        """
+        if self.first_start is None:
+            return 0.
+        return self.last_end - self.first_start
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """
+        Input items per wall-clock second while the stage was active,
+        which, unlike `busy_seconds`, accounts for workers running in parallel
+        """
+        if not self.active_seconds:
+            return None
+        return self.items_in / self.active_seconds
+
+    def to_dict(self) -> dict:
+        data = dataclasses.asdict(self)
+        del data["first_start"], data["last_end"]
+        return {
+            **data,
+            "active_seconds": self.active_seconds,
+            "throughput": self.throughput,
+        }
+
+
+class Pipeline:
+    """
+    Chains stages over a stream of images.
+
+        pipeline = Pipeline([LoadImageStage(), FunctionStage(image_to_numpy, executor="process")])
+        for item in pipeline.run(items_from_folder("results/")):
+            print(item.meta["filename"], item.image.shape)
+    """
+
+    def __init__(
+            self,
+            stages: Sequence[Stage],
+            queue_size: int = 4,
+    ):
+        """
+        :param stages: list of Stage
+        :param queue_size: int, maximum number of batches waiting in front of each stage
+        """
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+        self.stages = list(stages)
+        self.queue_size = queue_size
+        self._stats: List[StageStats] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def stats(self) -> List[dict]:
+        """
+        Counters and timings of each stage of the current or last run
+        """
+        with self._lock:
+            return [s.to_dict() for s in self._stats]
+
+    def process(self, items: Iterable[Union[StageItem, ImageType]]) -> List[StageItem]:
+        return list(self.run(items))
+
+    def run(self, items: Iterable[Union[StageItem, ImageType]]) -> Iterator[StageItem]:
+        """
+        Stream the items through all stages.
+
+        The stages start on the first `next()` and are stopped when the iterator
+        is exhausted or closed. An exception in a stage is raised here.
+
+        :param items: iterable of StageItem or images
+        :return: iterator of StageItem
+        """
+        self._stop.clear()
+        self._error = None
+        with self._lock:
+            self._stats = [
+                StageStats(name=s.name, batch_size=s.batch_size, device=s.device, executor=s.executor)
+                for s in self.stages
+            ]
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [
+            threading.Thread(
+                name=f"{self.__class__.__name__}-source", target=self._guarded,
+                args=(self._feed, items, queues[0]), daemon=True,
+            )
+        ]
+        for i, stage in enumerate(self.stages):
+            threads.append(threading.Thread(
+                name=f"{self.__class__.__name__}-{stage.name}", target=self._guarded,
+                args=(self._stage_loop, i, queues[i], queues[i + 1]), daemon=True,
+            ))
+
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                batch = self._get(queues[-1])
+                if batch is _END:
+                    break
+                yield from batch
+
+        except _Stopped:
+            pass
+
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+    def _guarded(self, target, *args):
+        try:
+            target(*args)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            if self._error is None:
+                self._error = e
+            self._stop.set()
+
+    def _put(self, q: queue.Queue, item) -> float:
+        """
+        Put into the queue, return the seconds spent blocking
+        """
+        start_time = time.monotonic()
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                q.put(item, timeout=.1)
+                return time.monotonic() - start_time
+            except queue.Full:
+                pass
+
+    def _get(self, q: queue.Queue):
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                return q.get(timeout=.1)
+            except queue.Empty:
+                pass
+
+    def _feed(self, items: Iterable[Union[StageItem, ImageType]], out_queue: queue.Queue):
+        batch_size = self.stages[0].batch_size
+        batch = []
+        for item in items:
+            if not isinstance(item, StageItem):
+                item = StageItem(image=item)
+            batch.append(item)
+            if len(batch) >= batch_size:
+                self._put(out_queue, batch)
+                batch = []
+        if batch:
+            self._put(out_queue, batch)
+        self._put(out_queue, _END)
+
+    def _stage_loop(self, index: int, in_queue: queue.Queue, out_queue: queue.Queue):
+        stage = self.stages[index]
+        stats = self._stats[index]
+
+        executor = None
+        if stage.executor == "thread":
+            executor = concurrent.futures.ThreadPoolExecutor(stage.workers, thread_name_prefix=stage.name)
+        elif stage.executor == "process":
+            executor = concurrent.futures.ProcessPoolExecutor(stage.workers)
+
+        # batches submitted to the executor, in order
+        pending = collections.deque()
+
+        def _emit(start_time: float, end_time: float, num_in: int, result: List[StageItem]):
+            with self._lock:
+                stats.items_in += num_in
+                stats.items_out += len(result)
+                stats.batches += 1
+                stats.busy_seconds += end_time - start_time
+                if stats.first_start is None or start_time < stats.first_start:
+                    stats.first_start = start_time
+                if stats.last_end is None or end_time > stats.last_end:
+                    stats.last_end = end_time
+            if result:
+                blocked = self._put(out_queue, result)
+                with self._lock:
+                    stats.blocked_seconds += blocked
+
+        def _submit(batch: List[StageItem]):
+            if executor is None:
+                _emit(*_timed_step_batch(stage, batch))
+            else:
+                pending.append(executor.submit(_timed_step_batch, stage, batch))
+                while len(pending) > stage.workers:
+                    _emit(*pending.popleft().result())
+
+        try:
+            buffer: List[StageItem] = []
+            while True:
+                batch = self._get(in_queue)
+                if batch is _END:
+                    break
+                buffer.extend(batch)
+                while len(buffer) >= stage.batch_size:
+                    _submit(buffer[:stage.batch_size])
+                    buffer = buffer[stage.batch_size:]
+
+            if buffer:
+                _submit(buffer)
+            while pending:
+                _emit(*pending.popleft().result())
+
+            self._put(out_queue, _END)
+
+        finally:
+            if executor is not None:
+                for future in pending:
+                    future.cancel()
+                executor.shutdown(wait=True)
+
+
+def _timed_step_batch(stage: Stage, batch: List[StageItem]) -> Tuple[float, float, int, List[StageItem]]:
+    # module-level, so it can be sent to a process pool,
+    # the monotonic clock is the same in all processes of the system
+    start_time = time.monotonic()
+    result = stage.step_batch(batch)
+    return start_time, time.monotonic(), len(batch), result
+
+
+def items_from_files(filenames: Iterable[Union[str, Path]]) -> Iterator[StageItem]:
+    """
+    Yield an item with the "filename" for each image file, see `LoadImageStage`
+    """
+    for filename in filenames:
+        filename = Path(filename)
+        if is_image_filename(filename):
+            yield StageItem(image=None, meta={"filename": filename})
+
+
+def items_from_folder(
+        path: Union[str, Path],
+        glob_pattern: str = "*",
+        recursive: bool = False,
+) -> Iterator[StageItem]:
+    """
+    Yield an item for each image file in the folder, e.g. a result folder of the generator
+    """
+    path = Path(path)
+    files = path.rglob(glob_pattern) if recursive else path.glob(glob_pattern)
+    yield from items_from_files(sorted(f for f in files if f.is_file()))
+
+
+def items_from_imagedb(
+        db: "ImageDB",
+        query=None,
+        chunk_size: int = 1000,
+) -> Iterator[StageItem]:
+    """
+    Yield an item with "filename" and "image_id" for each image in the database.
+
+    :param db: ImageDB
+    :param query: optional callable that receives the sqlalchemy query
+        of `ImageEntry`s and returns a filtered one
+    :param chunk_size: int, number of rows fetched at once
+    """
+    from .imagedb import ImageEntry
+
+    with db.sql_session() as sql_session:
+        q = sql_session.query(ImageEntry).order_by(ImageEntry.id)
+        if query is not None:
+            q = query(q)
+        for entry in q.yield_per(chunk_size):
+            yield StageItem(image=None, meta={"filename": entry.filename(), "image_id": entry.id})
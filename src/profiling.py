@@ -0,0 +1,181 @@
+"""
+Lightweight timing of code sections.
+
+    from src import profiling
+
+    with profiling.span("clip.inference"):
+        ...
+
+Spans are only recorded between `enable()` and `disable()`. Otherwise `span()`
+returns a shared no-op context manager, so the instrumented code does not
+pay for more than one function call.
+
+Spans can nest, e.g. ``clip.decode`` is part of ``clip.preprocess``,
+so the times in the summary do not add up to the total time.
+"""
+import contextlib
+import dataclasses
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Dict, List, Union
+
+
+@dataclasses.dataclass
+class SpanStats:
+    name: str
+    count: int = 0
+    seconds: float = 0.
+    min_seconds: float = float("inf")
+    max_seconds: float = 0.
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.seconds / self.count if self.count else 0.
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "count": self.count,
+            "seconds": self.seconds,
+            "mean_seconds": self.mean_seconds,
+            "min_seconds": self.min_seconds if self.count else 0.,
+            "max_seconds": self.max_seconds,
+        }
+
+
+class SpanRecorder:
+    """
+    Collects the times of all spans, from all threads
+    """
+
+    def __init__(self, trace: bool = False):
+        """
+        :param trace: bool, also keep each single span, for `write_trace`
+        """
+        self.trace = trace
+        self.start_time = time.perf_counter()
+        self.stats: Dict[str, SpanStats] = {}
+        self.events: List[dict] = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start_time: float, end_time: float):
+        seconds = end_time - start_time
+        with self._lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = SpanStats(name)
+            stats.count += 1
+            stats.seconds += seconds
+            stats.min_seconds = min(stats.min_seconds, seconds)
+            stats.max_seconds = max(stats.max_seconds, seconds)
+
+            if self.trace:
+                self.events.append({
+                    "name": name,
+                    "ph": "X",
+                    "ts": round((start_time - self.start_time) * 1_000_000, 3),
+                    "dur": round(seconds * 1_000_000, 3),
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                })
+
+    def summary(self) -> List[dict]:
+        """
+        Return the stats of each span name, longest total time first
+        """
+        with self._lock:
+            stats = [s.to_dict() for s in self.stats.values()]
+        return sorted(stats, key=lambda s: -s["seconds"])
+
+    def format_summary(self) -> str:
+        """
+        Return the summary as a text table
+        """
+        rows = [("span", "count", "total s", "mean ms", "min ms", "max ms")]
+        for s in self.summary():
+            rows.append((
+                s["name"],
+                f"{s['count']:,}",
+                f"{s['seconds']:.3f}",
+                f"{s['mean_seconds'] * 1000:.2f}",
+                f"{s['min_seconds'] * 1000:.2f}",
+                f"{s['max_seconds'] * 1000:.2f}",
+            ))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return "\n".join(
+            "  ".join(
+                cell.ljust(width) if i == 0 else cell.rjust(width)
+                for i, (cell, width) in enumerate(zip(row, widths))
+            )
+            for row in rows
+        )
+
+    def write_trace(self, filename: Union[str, Path]):
+        """
+        Write the spans in the Chrome trace event format,
+        which can be viewed in https://ui.perfetto.dev or chrome://tracing
+        """
+        with self._lock:
+            events = list(self.events)
+        Path(filename).write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+
+
+class _Span:
+    __slots__ = ("recorder", "name", "start_time")
+
+    def __init__(self, recorder: SpanRecorder, name: str):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.recorder.add(self.name, self.start_time, time.perf_counter())
+
+
+_NULL_SPAN = contextlib.nullcontext()
+
+_recorder: Optional[SpanRecorder] = None
+
+
+def span(name: str):
+    """
+    Return a context manager that records the time of the enclosed code as `name`,
+    if recording is enabled
+    """
+    recorder = _recorder
+    if recorder is None:
+        return _NULL_SPAN
+    return _Span(recorder, name)
+
+
+def enable(trace: bool = False) -> SpanRecorder:
+    """
+    Start recording spans with a new `SpanRecorder`
+
+    :param trace: bool, keep each single span, see `SpanRecorder.write_trace`
+    """
+    global _recorder
+    _recorder = SpanRecorder(trace=trace)
+    return _recorder
+
+
+def disable() -> Optional[SpanRecorder]:
+    """
+    Stop recording and return the recorder
+    """
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def recorder() -> Optional[SpanRecorder]:
+    """
+    Return the current recorder, or None if recording is disabled
+    """
+    return _recorder
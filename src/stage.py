@@ -1,11 +1,123 @@
+import dataclasses
+from pathlib import Path
+from typing import Optional, List, Callable
+
 from .image import ImageType
 
 
+@dataclasses.dataclass
+class StageItem:
+    """
+    One image flowing through a `Pipeline`.
+
+    `image` is None until it is loaded (see `LoadImageStage`),
+    `meta` holds e.g. the "filename", the "image_id" or scores added by stages.
+    """
+    image: Optional[ImageType]
+    meta: dict = dataclasses.field(default_factory=dict)
+
+
 class Stage:
+    """
+    Base of all processing stages.
+
+    Subclasses implement `step` for single images, or `step_batch`
+    if they profit from batching (e.g. one forward pass of a model)
+    or if they drop or add images.
+
+    The class attributes are the defaults for the `Pipeline`:
 
-    def __init__(self):
-        pass
+    - `batch_size`: number of items passed to `step_batch`
+    - `device`: the torch device of model stages, "cpu" otherwise
+    - `executor`: None to run in the stage's own thread,
+      "thread" or "process" to spread the batches over a pool of `workers`
+    """
+    batch_size: int = 1
+    device: str = "cpu"
+    executor: Optional[str] = None
+    workers: int = 1
+
+    def __init__(
+            self,
+            batch_size: Optional[int] = None,
+            device: Optional[str] = None,
+            executor: Optional[str] = None,
+            workers: Optional[int] = None,
+    ):
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if device is not None:
+            self.device = device
+        if executor is not None:
+            self.executor = executor
+        if workers is not None:
+            self.workers = workers
+
+        if self.executor not in (None, "thread", "process"):
+            raise ValueError(f"Invalid executor '{self.executor}', expected None, 'thread' or 'process'")
+
+    @property
+    def name(self) -> str:
+        return self.__class__.__name__
 
     def step(self, image: ImageType) -> ImageType:
-        raise NotImplemented
+        raise NotImplementedError
+
+    def step_batch(self, items: List[StageItem]) -> List[StageItem]:
+        """
+        Process a batch of at most `batch_size` items.
+
+        :return: list of items, which can be more or less than the input
+        """
+        return [
+            StageItem(image=self.step(item.image), meta=item.meta)
+            for item in items
+        ]
+
+
+class FunctionStage(Stage):
+    """
+    Applies a function to each image.
+    With the "process" executor, the function must be picklable.
+    """
+
+    def __init__(self, function: Callable[[ImageType], ImageType], **kwargs):
+        super().__init__(**kwargs)
+        self.function = function
+
+    @property
+    def name(self) -> str:
+        return getattr(self.function, "__name__", super().name)
+
+    def step(self, image: ImageType) -> ImageType:
+        return self.function(image)
+
+
+class LoadImageStage(Stage):
+    """
+    Loads the PIL image of items that have a "filename" but no image.
+    Decoding releases the GIL, so it runs in a thread pool by default.
+    """
+    batch_size = 8
+    executor = "thread"
+    workers = 4
+
+    def __init__(self, mode: Optional[str] = "RGB", **kwargs):
+        """
+        :param mode: str, the PIL mode of the loaded images, None to keep it
+        """
+        super().__init__(**kwargs)
+        self.mode = mode
+
+    def step_batch(self, items: List[StageItem]) -> List[StageItem]:
+        import PIL.Image
 
+        for item in items:
+            if item.image is None:
+                image = PIL.Image.open(Path(item.meta["filename"]))
+                if self.mode is not None and image.mode != self.mode:
+                    image = image.convert(self.mode)
+                else:
+                    image.load()
+                item.image = image
+        return items
@@ -1,14 +1,134 @@
+import functools
+import time
+from pathlib import Path
+from typing import Optional, List, Sequence, Union
 
-import clip
+import numpy as np
 
+from src.config import DEFAULT_CLIP_MODEL
+from src.clip import get_image_features, get_text_features
 from ..stage import *
 
 
+@functools.lru_cache(maxsize=64)
+def _text_features(prompt: str, model: str, device: str) -> np.ndarray:
+    features = get_text_features(prompt, model=model, device=device).astype(np.float32)
+    features /= np.linalg.norm(features)
+    features.flags.writeable = False
+    return features
+
+
 class ClipStage(Stage):
+    """
+    Scores images against a prompt by the cosine similarity of their CLIP features
+    and keeps the best `top_n` of each batch (best-of-N).
+
+    The score is stored in ``item.meta["score"]``. Each batch is one forward pass
+    of the image encoder, the prompt is encoded once per model and device.
+    Items without an image are read from ``item.meta["filename"]``,
+    which allows decoding at reduced size.
+    """
+    batch_size = 32
+    device = "auto"
+
+    def __init__(
+            self,
+            prompt: str,
+            top_n: Optional[int] = None,
+            min_score: Optional[float] = None,
+            model: str = DEFAULT_CLIP_MODEL,
+            **kwargs,
+    ):
+        """
+        :param prompt: str, the target text
+        :param top_n: int, number of images kept per batch, None to keep all
+        :param min_score: float, drop images with a lower cosine similarity
+        :param model: str, name of the CLIP model
+        """
+        super().__init__(**kwargs)
+        self.prompt = prompt
+        self.top_n = top_n
+        self.min_score = min_score
+        self.model = model
+        self.num_images = 0
+        self.seconds = 0.
 
-    def __init__(self):
-        super().__init__()
+    @property
+    def images_per_second(self) -> Optional[float]:
+        if not self.seconds:
+            return None
+        return self.num_images / self.seconds
+
+    def text_features(self) -> np.ndarray:
+        """
+        Normalized features of the prompt, cached
+        """
+        return _text_features(self.prompt, self.model, self.device)
+
+    def scores(self, images: Sequence[Union[str, Path, ImageType]]) -> np.ndarray:
+        """
+        Cosine similarity of each image to the prompt, in one forward pass
+
+        :param images: filenames, PIL images, arrays or tensors
+        :return: float array of shape [N]
+        """
+        start_time = time.monotonic()
+        features = get_image_features(images, model=self.model, device=self.device).astype(np.float32)
+        features /= np.maximum(np.linalg.norm(features, axis=-1, keepdims=True), 1e-12)
+        scores = features @ self.text_features()
+        self.num_images += len(images)
+        self.seconds += time.monotonic() - start_time
+        return scores
 
     def step(self, image: ImageType) -> ImageType:
-        # TODO
         return image
+
+    def step_batch(self, items: List[StageItem]) -> List[StageItem]:
+        if not items:
+            return []
+
+        scores = self.scores(_sources(items))
+        for item, score in zip(items, scores):
+            item.meta["score"] = float(score)
+
+        return [items[i] for i in self._select(scores)]
+
+    def select(self, images: Sequence[Union[str, Path, ImageType, StageItem]]) -> List[StageItem]:
+        """
+        Score all images in batches of `batch_size` and return the best `top_n`
+        of all, sorted by score.
+
+        :param images: filenames, images or StageItems
+        """
+        items = [
+            image if isinstance(image, StageItem)
+            else StageItem(image=None, meta={"filename": Path(image)}) if isinstance(image, (str, Path))
+            else StageItem(image=image)
+            for image in images
+        ]
+        scores = np.empty(len(items), dtype=np.float32)
+        for i in range(0, len(items), self.batch_size):
+            batch = items[i: i + self.batch_size]
+            scores[i: i + len(batch)] = self.scores(_sources(batch))
+        for item, score in zip(items, scores):
+            item.meta["score"] = float(score)
+
+        return [items[i] for i in self._select(scores)]
+
+    def _select(self, scores: np.ndarray) -> np.ndarray:
+        """
+        Indices of the kept scores, highest first
+        """
+        indices = np.arange(len(scores))
+        if self.min_score is not None:
+            indices = indices[scores >= self.min_score]
+        if self.top_n is not None and self.top_n < len(indices):
+            indices = indices[np.argpartition(-scores[indices], self.top_n - 1)[:self.top_n]]
+        return indices[np.argsort(-scores[indices], kind="stable")]
+
+
+def _sources(items: List[StageItem]) -> list:
+    return [
+        item.meta["filename"] if item.image is None else item.image
+        for item in items
+    ]
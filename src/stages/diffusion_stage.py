@@ -1,15 +1,315 @@
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Optional, List, Tuple, Deque, Union
 
+import PIL.Image
+import torch
 import diffusers
 
+from src.config import DEFAULT_DIFFUSION_MODEL, DIFFUSION_CACHE_SIZE
+from src.clip.device import get_torch_device
 from ..stage import *
 
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+
+class DiffusionPipelineCache:
+    """
+    Cache of loaded diffusers pipelines.
+
+    Pipelines are loaded on first use and at most `max_pipelines`
+    (model, device, dtype) combinations are kept, the least recently used is unloaded.
+    Each pipeline has a lock, the diffusers pipelines are not thread-safe.
+    """
+
+    max_pipelines: int = DIFFUSION_CACHE_SIZE
+
+    _pipelines: "OrderedDict[str, Tuple[diffusers.DiffusionPipeline, threading.Lock]]" = OrderedDict()
+    _lock = threading.RLock()
+
+    @classmethod
+    def get(
+            cls,
+            model: str,
+            device: str,
+            dtype: Optional[torch.dtype] = None,
+    ) -> Tuple[diffusers.DiffusionPipeline, threading.Lock]:
+        """
+        Return the pipeline and its lock.
+
+        :param model: str, huggingface id or local directory
+        :param device: str, a torch device or 'auto'
+        :param dtype: torch.dtype, defaults to float16 on cuda and float32 on cpu
+        """
+        device = get_torch_device(device)
+        if dtype is None:
+            dtype = torch.float16 if device.startswith("cuda") else torch.float32
+
+        key = f"{model}/{device}/{dtype}"
+
+        with cls._lock:
+            if key in cls._pipelines:
+                cls._pipelines.move_to_end(key)
+                return cls._pipelines[key]
+
+            pipeline = diffusers.StableDiffusionPipeline.from_pretrained(
+                model,
+                torch_dtype=dtype,
+                safety_checker=None,
+                requires_safety_checker=False,
+            ).to(device)
+            pipeline.set_progress_bar_config(disable=True)
+
+            cls._pipelines[key] = (pipeline, threading.Lock())
+            while len(cls._pipelines) > max(1, cls.max_pipelines):
+                cls._unload(next(iter(cls._pipelines)))
+
+            return cls._pipelines[key]
+
+    @classmethod
+    def loaded(cls) -> List[str]:
+        """
+        Return the "<model>/<device>/<dtype>" keys of the loaded pipelines, least recently used first
+        """
+        with cls._lock:
+            return list(cls._pipelines)
+
+    @classmethod
+    def unload(cls, model: Optional[str] = None) -> int:
+        """
+        Remove pipelines from the cache.
+
+        :param model: str, only unload this model, defaults to all models
+        :return: int, number of unloaded pipelines
+        """
+        with cls._lock:
+            keys = [
+                key for key in cls._pipelines
+                if model is None or key.rsplit("/", 2)[0] == model
+            ]
+            for key in keys:
+                cls._unload(key)
+            return len(keys)
+
+    @classmethod
+    def _unload(cls, key: str):
+        pipeline, _ = cls._pipelines.pop(key)
+        if pipeline.device.type == "cuda":
+            del pipeline
+            torch.cuda.empty_cache()
+
 
 class DiffusionStage(Stage):
+    """
+    Generates images with a local stable diffusion pipeline.
+
+    Each input item provides a prompt, either in ``meta["prompt"]``,
+    as a string instead of an image, or the `prompt` of the stage.
+    A batch is generated in one call of the pipeline. The encoded prompts
+    are cached, so repeated prompts only run the text encoder once.
+
+    The output items carry the image and ``meta["prompt"]``, ``meta["seed"]``
+    and ``meta["model"]``. The time of each batch is in `batch_stats`, together with
+    the peak cuda memory of the batch (``"memory"``, None on cpu) and the peak
+    resident memory of the whole process so far (``"process_peak_rss"``, None on windows).
+    """
+    batch_size = 4
+    device = "auto"
+
+    def __init__(
+            self,
+            prompt: Optional[str] = None,
+            negative_prompt: Optional[str] = None,
+            model: str = DEFAULT_DIFFUSION_MODEL,
+            num_inference_steps: int = 25,
+            guidance_scale: float = 7.5,
+            width: Optional[int] = None,
+            height: Optional[int] = None,
+            seed: int = 0,
+            attention_slicing: Optional[Union[str, int]] = None,
+            low_memory: bool = False,
+            dtype: Optional[torch.dtype] = None,
+            num_cached_prompts: int = 32,
+            **kwargs,
+    ):
+        """
+        :param prompt: str, default prompt for items without one
+        :param negative_prompt: str, default negative prompt
+        :param model: str, huggingface id or local directory of a StableDiffusionPipeline
+        :param num_inference_steps: int, number of denoising steps
+        :param guidance_scale: float, classifier-free guidance, 1 or lower disables it
+        :param width: int, width of the images, defaults to the model's resolution
+        :param height: int, height of the images, defaults to the model's resolution
+        :param seed: int, the seed of items without ``meta["seed"]``, increased for each image
+        :param attention_slicing: "auto", "max" or int, compute the attention in slices,
+            which lowers the peak memory at a small speed cost
+        :param low_memory: bool, maximum attention slicing and decoding the latents
+            one image at a time, for CPU runs with little RAM
+        :param dtype: torch.dtype, defaults to float16 on cuda and float32 on cpu
+        :param num_cached_prompts: int, number of encoded prompts kept
+        """
+        super().__init__(**kwargs)
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.model = model
+        self.num_inference_steps = num_inference_steps
+        self.guidance_scale = guidance_scale
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.attention_slicing = "max" if low_memory else attention_slicing
+        self.low_memory = low_memory
+        self.dtype = dtype
+        self.num_cached_prompts = num_cached_prompts
+        self.num_images = 0
+        self.seconds = 0.
+        self.batch_stats: Deque[dict] = deque(maxlen=100)
+        self._prompt_cache: "OrderedDict[tuple, Tuple[torch.Tensor, Optional[torch.Tensor]]]" = OrderedDict()
+        self._pipeline_id: Optional[int] = None
+
+    @property
+    def images_per_second(self) -> Optional[float]:
+        if not self.seconds:
+            return None
+        return self.num_images / self.seconds
+
+    def pipeline(self) -> Tuple[diffusers.DiffusionPipeline, threading.Lock]:
+        pipeline, lock = DiffusionPipelineCache.get(self.model, self.device, self.dtype)
+        # the encoded prompts belong to the text encoder of one loaded pipeline
+        if id(pipeline) != self._pipeline_id:
+            self._prompt_cache.clear()
+            self._pipeline_id = id(pipeline)
+        return pipeline, lock
+
+    def step_batch(self, items: List[StageItem]) -> List[StageItem]:
+        if not items:
+            return []
+
+        prompts = []
+        seeds = []
+        for item in items:
+            prompt = item.meta.get("prompt")
+            if prompt is None:
+                prompt = item.image if isinstance(item.image, str) else self.prompt
+            if prompt is None:
+                raise ValueError(f"No prompt for item {item.meta}")
+            prompts.append(prompt)
+
+            if "seed" in item.meta:
+                seeds.append(int(item.meta["seed"]))
+            else:
+                seeds.append(self.seed)
+                self.seed += 1
+
+        images = self.generate(prompts, seeds)
+        return [
+            StageItem(
+                image=image,
+                meta={**item.meta, "prompt": prompt, "seed": seed, "model": self.model},
+            )
+            for item, image, prompt, seed in zip(items, images, prompts, seeds)
+        ]
+
+    def generate(self, prompts: List[str], seeds: List[int]) -> List[PIL.Image.Image]:
+        """
+        Generate one image per prompt, in one call of the pipeline
+
+        :param prompts: list of str
+        :param seeds: list of int, the seed of each image
+        :return: list of PIL images
+        """
+        pipeline, lock = self.pipeline()
+        do_guidance = self.guidance_scale > 1.
+
+        with lock:
+            self._configure(pipeline)
+            is_cuda = pipeline.device.type == "cuda"
+            if is_cuda:
+                torch.cuda.reset_peak_memory_stats(pipeline.device)
+
+            start_time = time.monotonic()
+            with torch.inference_mode():
+                embeds = [self._encode_prompt(pipeline, prompt, do_guidance) for prompt in prompts]
+                prompt_embeds = torch.cat([e[0] for e in embeds])
+                negative_embeds = torch.cat([e[1] for e in embeds]) if do_guidance else None
+
+                # a generator per image, so an image does not depend on its position in the batch
+                generators = [torch.Generator("cpu").manual_seed(seed) for seed in seeds]
+
+                images = pipeline(
+                    prompt_embeds=prompt_embeds,
+                    negative_prompt_embeds=negative_embeds,
+                    num_inference_steps=self.num_inference_steps,
+                    guidance_scale=self.guidance_scale,
+                    width=self.width,
+                    height=self.height,
+                    generator=generators,
+                    output_type="pil",
+                ).images
+            seconds = time.monotonic() - start_time
+
+            memory = torch.cuda.max_memory_allocated(pipeline.device) if is_cuda else None
+
+        process_peak_rss = None
+        if resource is not None:
+            # the peak since the process started, kilobytes on linux, bytes on macos
+            process_peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform != "darwin":
+                process_peak_rss *= 1024
+
+        self.num_images += len(images)
+        self.seconds += seconds
+        self.batch_stats.append({
+            "images": len(images),
+            "seconds": round(seconds, 3),
+            "images_per_second": round(len(images) / seconds, 3) if seconds else None,
+            "memory": memory,
+            "process_peak_rss": process_peak_rss,
+        })
+        return images
+
+    def _configure(self, pipeline: diffusers.DiffusionPipeline):
+        # the pipeline is shared by all stages of the same model, so the settings are applied each time
+        if self.attention_slicing is not None:
+            pipeline.enable_attention_slicing(self.attention_slicing)
+        else:
+            pipeline.disable_attention_slicing()
+
+        if self.low_memory:
+            pipeline.vae.enable_slicing()
+        else:
+            pipeline.vae.disable_slicing()
 
-    def __init__(self):
-        super().__init__()
+    def _encode_prompt(
+            self,
+            pipeline: diffusers.DiffusionPipeline,
+            prompt: str,
+            do_guidance: bool,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        key = (prompt, self.negative_prompt, do_guidance)
+        if key in self._prompt_cache:
+            self._prompt_cache.move_to_end(key)
+            return self._prompt_cache[key]
 
-    def step(self, image: ImageType) -> ImageType:
-        # TODO
-        diffusers.StableDiffusionPipeline
-        return image
+        kwargs = dict(
+            device=pipeline.device,
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=do_guidance,
+            negative_prompt=self.negative_prompt,
+        )
+        if hasattr(pipeline, "encode_prompt"):
+            embeds = pipeline.encode_prompt(prompt, **kwargs)
+        else:
+            # diffusers < 0.22 returns one tensor of the negative and the positive embeddings
+            embeds = pipeline._encode_prompt(prompt, **kwargs)
+            embeds = tuple(reversed(embeds.chunk(2))) if do_guidance else (embeds, None)
+        self._prompt_cache[key] = embeds
+        while len(self._prompt_cache) > max(1, self.num_cached_prompts):
+            self._prompt_cache.popitem(last=False)
+        return embeds
@@ -0,0 +1,149 @@
+"""
+A local websocket server that behaves like the queue of a gradio app
+(``/queue/join``) so that `HuggingfaceSpace`s can be tested without network.
+"""
+import asyncio
+import base64
+import json
+import threading
+from typing import Callable, List, Optional
+
+import websockets
+
+
+def data_uri(data: bytes, mime_type: str = "image/fake") -> str:
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode()}"
+
+
+def default_output(data: list) -> dict:
+    """
+    Returns the first parameter as "image" in the format of the stable diffusion space
+    """
+    return {"data": [[data_uri(str(data[0]).encode())]]}
+
+
+class FakeGradioServer:
+    """
+    Runs in a background thread, use as context manager.
+
+    :param concurrency: int, number of requests that are processed at the same time
+    :param process_time: float, seconds per request
+    :param max_queue: int, if that many requests are waiting, new ones get "queue_full"
+    :param output: callable that turns the request data into the "output" of "process_completed"
+    """
+
+    def __init__(
+            self,
+            concurrency: int = 1,
+            process_time: float = 0.,
+            max_queue: Optional[int] = None,
+            output: Callable[[list], dict] = default_output,
+    ):
+        self.concurrency = concurrency
+        self.process_time = process_time
+        self.max_queue = max_queue
+        self.output = output
+        self.requests: List[list] = []
+        self.num_connections = 0
+        self.max_connections = 0
+        self.num_queue_full = 0
+        self._waiting: List[asyncio.Future] = []
+        self._num_processing = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._started = threading.Event()
+        self._stop: Optional[asyncio.Future] = None
+        self.port: Optional[int] = None
+
+    @property
+    def url(self) -> str:
+        return f"ws://127.0.0.1:{self.port}/queue/join"
+
+    def __enter__(self) -> "FakeGradioServer":
+        self._thread = threading.Thread(target=asyncio.run, args=(self._serve(), ), daemon=True)
+        self._thread.start()
+        self._started.wait(10)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._loop.call_soon_threadsafe(self._stop.set_result, None)
+        self._thread.join()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = self._loop.create_future()
+        async with websockets.serve(self._handle, "127.0.0.1", 0, max_size=None) as server:
+            self.port = server.sockets[0].getsockname()[1]
+            self._started.set()
+            await self._stop
+
+    async def _handle(self, ws):
+        self.num_connections += 1
+        self.max_connections = max(self.max_connections, self.num_connections)
+        try:
+            await ws.send(json.dumps({"msg": "send_hash"}))
+            await ws.recv()
+
+            if (
+                    self.max_queue is not None
+                    and self._num_processing >= self.concurrency
+                    and len(self._waiting) >= self.max_queue
+            ):
+                self.num_queue_full += 1
+                await ws.send(json.dumps({"msg": "queue_full"}))
+                return
+
+            await self._wait_for_turn(ws)
+            try:
+                await ws.send(json.dumps({"msg": "send_data"}))
+                data = json.loads(await ws.recv())["data"]
+                self.requests.append(data)
+                await ws.send(json.dumps({"msg": "process_starts"}))
+                # stop processing when the client goes away
+                closed = asyncio.ensure_future(ws.wait_closed())
+                await asyncio.wait([closed], timeout=self.process_time)
+                closed.cancel()
+                await ws.send(json.dumps({
+                    "msg": "process_completed",
+                    "output": self.output(data),
+                    "success": True,
+                }))
+            finally:
+                self._release()
+
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.num_connections -= 1
+
+    async def _wait_for_turn(self, ws):
+        if self._num_processing < self.concurrency and not self._waiting:
+            self._num_processing += 1
+            return
+
+        turn = self._loop.create_future()
+        self._waiting.append(turn)
+        try:
+            while not turn.done():
+                rank = self._waiting.index(turn)
+                await ws.send(json.dumps({
+                    "msg": "estimation",
+                    "rank": rank,
+                    "queue_size": len(self._waiting),
+                    "rank_eta": (rank + 1) * self.process_time,
+                }))
+                await asyncio.wait([turn], timeout=.1)
+        except BaseException:
+            if turn in self._waiting:
+                self._waiting.remove(turn)
+            else:
+                # the slot was handed over already, pass it on
+                self._release()
+            raise
+
+    def _release(self):
+        # a waiting request takes over the slot
+        if self._waiting:
+            self._waiting.pop(0).set_result(None)
+        else:
+            self._num_processing -= 1
@@ -0,0 +1,42 @@
+import json
+import os
+import subprocess
+import sys
+
+from tests.base import *
+from tests.test_clip_models import save_tiny_clip
+from tests.test_startup import PROJECT_PATH
+
+from bin.bench import BENCHMARKS
+
+
+class TestBench(TestBase):
+
+    def test_100_bench(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model = str(save_tiny_clip(Path(tmp_dir) / "tiny.pt"))
+            output = Path(tmp_dir) / "bench.json"
+            process = subprocess.run(
+                [
+                    sys.executable, "bin/bench.py",
+                    "--path", str(Path(tmp_dir) / "data"), "-o", str(output), "-m", model,
+                    "--images", "12", "--image-size", "32", "--embeddings", "1000", "--queries", "5",
+                ],
+                cwd=PROJECT_PATH, env={**os.environ, "PYTHONPATH": str(PROJECT_PATH), "MP_DATABASE_URL": ""},
+                capture_output=True, text=True,
+            )
+            if process.returncode:
+                raise AssertionError(process.stderr)
+
+            data = json.loads(output.read_text())
+            self.assertEqual(12, data["meta"]["parameters"]["images"])
+            results = {r["name"]: r for r in data["results"]}
+            self.assertEqual(set(BENCHMARKS), set(results))
+            for result in data["results"]:
+                self.assertGreater(result["seconds"], 0, result["name"])
+
+            self.assertEqual(1000, results["write_embeddings"]["written"])
+            self.assertEqual(1012, results["index_build"]["size"])
+            self.assertEqual(1012, results["index_load"]["size"])
+            self.assertEqual(50, results["images_by_text"]["results"])
+            self.assertEqual(5, results["server_query"]["count"])
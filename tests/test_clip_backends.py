@@ -0,0 +1,108 @@
+import os
+import time
+import unittest
+
+import torch
+from clip.model import CLIP
+
+from tests.base import *
+
+from src.clip.backends import create_inference_model, check_parity, parse_device
+
+
+def create_tiny_clip() -> CLIP:
+    """
+    A randomly initialized CLIP model of the ViT type, small enough for unittests
+    """
+    torch.manual_seed(23)
+    model = CLIP(
+        embed_dim=32,
+        image_resolution=32, vision_layers=2, vision_width=64, vision_patch_size=8,
+        context_length=77, vocab_size=49408,
+        transformer_width=64, transformer_heads=2, transformer_layers=2,
+    ).eval()
+    model.device = "cpu"
+    model.input_resolution = model.visual.input_resolution
+    return model
+
+
+class TestClipBackends(TestBase):
+
+    def test_100_parse_device(self):
+        self.assertEqual(("cpu", "torch"), parse_device("cpu"))
+        self.assertEqual(("cpu", "onnx"), parse_device("cpu+onnx"))
+        with self.assertRaises(ValueError):
+            parse_device("cpu+tensorflow")
+
+    def test_200_parity(self):
+        reference = create_tiny_clip()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for backend, min_cosine in (
+                    ("torch", .9999),
+                    ("torchscript", .999),
+                    ("compile", .999),
+                    ("int8", .95),
+                    ("onnx", .999),
+            ):
+                if backend == "onnx":
+                    try:
+                        import onnxruntime, onnx
+                    except ImportError:
+                        continue
+
+                if backend == "compile" and not hasattr(torch, "compile"):
+                    with self.assertRaises(ValueError):
+                        create_inference_model(reference, backend, name="tiny", cache_path=Path(tmp_dir))
+                    continue
+
+                model = create_inference_model(reference, backend, name="tiny", cache_path=Path(tmp_dir))
+                parity = check_parity(reference, model)
+                self.assertGreater(parity["image"]["min_cosine"], min_cosine, backend)
+                self.assertGreater(parity["text"]["min_cosine"], min_cosine, backend)
+
+                # other batch size than the traced/exported one
+                with torch.no_grad():
+                    self.assertEqual((5, 32), tuple(model.encode_image(torch.randn(5, 3, 32, 32)).shape))
+
+    def test_300_onnx_cache(self):
+        try:
+            import onnxruntime, onnx
+        except ImportError:
+            self.skipTest("onnx and onnxruntime are not installed")
+        from tests.test_clip_models import save_tiny_clip
+
+        reference = create_tiny_clip()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = Path(tmp_dir) / "cache"
+            checkpoint = save_tiny_clip(Path(tmp_dir) / "tiny.pt")
+
+            create_inference_model(reference, "onnx", name=str(checkpoint), cache_path=cache_path)
+            create_inference_model(reference, "onnx", name=str(checkpoint), cache_path=cache_path)
+            self.assertEqual(2, len(list(cache_path.glob("*.onnx"))))
+
+            # a changed checkpoint at the same path is exported again
+            os.utime(checkpoint, ns=(0, 0))
+            create_inference_model(reference, "onnx", name=str(checkpoint), cache_path=cache_path)
+            self.assertEqual(4, len(list(cache_path.glob("*.onnx"))))
+
+    def test_900_benchmark(self):
+        reference = create_tiny_clip()
+        images = torch.randn(32, 3, 32, 32)
+
+        print()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for backend in ("torch", "torchscript", "int8", "onnx"):
+                try:
+                    model = create_inference_model(reference, backend, name="tiny", cache_path=Path(tmp_dir))
+                except ImportError:
+                    continue
+
+                with torch.no_grad():
+                    model.encode_image(images)
+                    start_time = time.perf_counter()
+                    for i in range(10):
+                        model.encode_image(images)
+                    seconds = time.perf_counter() - start_time
+
+                print(f"{backend:12} {320 / seconds:10.1f} images/sec")
@@ -0,0 +1,101 @@
+import torch
+
+from tests.base import *
+from tests.test_clip_backends import create_tiny_clip
+
+from src.clip import ClipSingleton, MODEL_DIMENSIONS, get_text_features, get_image_features
+from src.imagedb import ImageDB, SimIndex
+
+
+def save_tiny_clip(filename: Path, embed_dim: int = 32) -> Path:
+    """
+    Store a random CLIP state dict which can be loaded by `clip.load(filename)`
+    """
+    model = create_tiny_clip()
+    if embed_dim != 32:
+        model.text_projection.data = model.text_projection.data[:, :embed_dim].clone()
+        model.visual.proj.data = model.visual.proj.data[:, :embed_dim].clone()
+    torch.save(model.state_dict(), filename)
+    return filename
+
+
+class TestClipModels(TestBase):
+
+    def setUp(self):
+        self._max_models = ClipSingleton.max_models
+        ClipSingleton.unload()
+
+    def tearDown(self):
+        ClipSingleton.max_models = self._max_models
+        ClipSingleton.unload()
+
+    def test_100_known_dimensions(self):
+        self.assertEqual(512, ClipSingleton.dimensions("ViT-B/32"))
+        self.assertEqual(768, ClipSingleton.dimensions("ViT-L/14"))
+        self.assertEqual([], ClipSingleton.loaded())
+
+    def test_200_detect_dimensions(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = str(save_tiny_clip(Path(tmp_dir) / "tiny.pt", embed_dim=24))
+
+            self.assertEqual(24, ClipSingleton.dimensions(filename))
+            self.assertEqual(24, MODEL_DIMENSIONS[filename])
+            self.assertEqual([f"{filename}/cpu"], ClipSingleton.loaded())
+
+            self.assertEqual((2, 24), get_text_features(["a", "b"], model=filename, device="cpu").shape)
+            self.assertEqual(
+                (1, 24),
+                get_image_features([DATA_PATH / "rgb48x32.png"], model=filename, device="cpu").shape,
+            )
+
+    def test_300_lru(self):
+        ClipSingleton.max_models = 2
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            names = [str(save_tiny_clip(Path(tmp_dir) / f"tiny{i}.pt")) for i in range(3)]
+
+            model0, _ = ClipSingleton.get(names[0], "cpu")
+            ClipSingleton.get(names[1], "cpu")
+            # use model 0 again so model 1 is the least recently used
+            self.assertIs(model0, ClipSingleton.get(names[0], "cpu")[0])
+            ClipSingleton.get(names[2], "cpu")
+
+            self.assertEqual([f"{names[0]}/cpu", f"{names[2]}/cpu"], ClipSingleton.loaded())
+
+            self.assertEqual(1, ClipSingleton.unload(names[0]))
+            self.assertEqual([f"{names[2]}/cpu"], ClipSingleton.loaded())
+            self.assertEqual(0, ClipSingleton.unload(names[2], device="cuda"))
+            self.assertEqual(1, ClipSingleton.unload(device="cpu"))
+            self.assertEqual([], ClipSingleton.loaded())
+
+    def test_400_sim_index_of_several_models(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            name_a = str(save_tiny_clip(Path(tmp_dir) / "a.pt", embed_dim=32))
+            name_b = str(save_tiny_clip(Path(tmp_dir) / "b.pt", embed_dim=16))
+
+            db = ImageDB(tmp_dir)
+            db.add_directory(DATA_PATH)
+            db.update_embeddings(model=name_a, device="cpu")
+            db.update_embeddings(model=name_b, device="cpu")
+
+            self.assertEqual(32, db.embedding_dimensions(name_a))
+            self.assertEqual(16, db.embedding_dimensions(name_b))
+            self.assertIsNone(db.embedding_dimensions("unknown"))
+
+            for name, dims in ((name_a, 32), (name_b, 16)):
+                index = db.sim_index(name)
+                self.assertEqual(dims, index.dimensions)
+                self.assertEqual(db.num_images(), index.size)
+                result = index.images_by_text("a dog", count=2, device="cpu")
+                self.assertEqual(2, len(result))
+
+    def test_500_dimensions_from_database(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+            db.add_directory(DATA_PATH)
+            db.add_embedding(db.get_image(path=DATA_PATH / "gray48x32.png"), "fake", [1, 2, 3])
+
+            # no model needs to be loaded
+            index = SimIndex(db, "fake")
+            self.assertEqual(3, index.dimensions)
+            self.assertEqual(1, index.size)
+            self.assertEqual([], ClipSingleton.loaded())
@@ -0,0 +1,72 @@
+import time
+
+import torch
+from clip.clip import _transform
+
+from tests.base import *
+
+from src.clip.preprocess import preprocess_images
+
+
+class TestClipPreprocess(TestBase):
+
+    def test_100_matches_reference(self):
+        reference = _transform(224)
+        filenames = sorted((DATA_PATH / "animals").glob("*.jpg")) + [DATA_PATH / "rgba48x32.png"]
+
+        expected = torch.stack([reference(PIL.Image.open(f)) for f in filenames])
+
+        for images in (
+                filenames,
+                [PIL.Image.open(f) for f in filenames],
+                [image_to_numpy(PIL.Image.open(f)) for f in filenames],
+                [image_to_torch(PIL.Image.open(f)) for f in filenames],
+        ):
+            result = preprocess_images(images, resolution=224)
+            self.assertEqual((len(filenames), 3, 224, 224), tuple(result.shape))
+            self.assertEqual(torch.float32, result.dtype)
+            # resampling differs a bit (one pass vs. two)
+            self.assertLess((result - expected).abs().mean(), .05)
+
+    def test_200_tensor_batch(self):
+        pil_images = [PIL.Image.open(DATA_PATH / "rgb48x32.png")] * 2
+        batch = image_to_torch(pil_images)
+
+        np.testing.assert_allclose(
+            preprocess_images(pil_images, resolution=32).numpy(),
+            preprocess_images(batch, resolution=32).numpy(),
+            atol=.05,
+        )
+        np.testing.assert_allclose(
+            preprocess_images(batch, resolution=32).numpy(),
+            preprocess_images(batch.float() / 255., resolution=32).numpy(),
+            atol=.05,
+        )
+
+    def test_900_benchmark(self):
+        reference = _transform(224)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filenames = []
+            for i in range(16):
+                filename = Path(tmp_dir) / f"{i}.jpg"
+                PIL.Image.open(DATA_PATH / "animals" / "dog-with-a-red-hat.jpg").resize((1920, 1080)).save(filename)
+                filenames.append(filename)
+
+            def _time(func) -> float:
+                # the fastest of a few runs is less affected by other load on the machine
+                seconds = []
+                for _ in range(2):
+                    start_time = time.perf_counter()
+                    func()
+                    seconds.append(time.perf_counter() - start_time)
+                return min(seconds)
+
+            time_legacy = _time(
+                lambda: torch.stack([reference(resize_crop(PIL.Image.open(f), [224, 224])) for f in filenames])
+            )
+            time_fused = _time(lambda: preprocess_images(filenames, resolution=224))
+
+            print(f"\n16 x 1920x1080 jpeg: legacy {time_legacy * 1000:.2f}ms, fused {time_fused * 1000:.2f}ms")
+            # usually 3 to 4 times faster, the bound only fails if it is clearly slower than legacy
+            self.assertLess(time_fused, time_legacy * 1.5)
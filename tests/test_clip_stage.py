@@ -0,0 +1,82 @@
+from unittest import mock
+
+import numpy as np
+
+from tests.base import *
+from tests.test_clip_models import save_tiny_clip
+
+from src.clip import ClipSingleton, get_image_features, get_text_features
+from src.stage import StageItem, LoadImageStage
+from src.pipeline import Pipeline, items_from_folder
+from src.stages import clip_stage
+from src.stages.clip_stage import ClipStage
+
+
+class TestClipStage(TestBase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.model = str(save_tiny_clip(Path(self.tmp_dir.name) / "tiny.pt"))
+        self.files = sorted((DATA_PATH / "animals").glob("*.jpg"))
+
+    def tearDown(self):
+        ClipSingleton.unload()
+        clip_stage._text_features.cache_clear()
+        self.tmp_dir.cleanup()
+
+    def expected_scores(self, prompt: str) -> np.ndarray:
+        image_features = get_image_features(self.files, model=self.model, device="cpu")
+        text_features = get_text_features(prompt, model=self.model, device="cpu")
+        image_features /= np.linalg.norm(image_features, axis=-1, keepdims=True)
+        text_features /= np.linalg.norm(text_features)
+        return image_features @ text_features
+
+    def test_100_best_of_n(self):
+        expected = self.expected_scores("a dog")
+        stage = ClipStage("a dog", top_n=2, model=self.model, device="cpu")
+
+        with mock.patch.object(clip_stage, "get_image_features", wraps=get_image_features) as image_mock, \
+                mock.patch.object(clip_stage, "get_text_features", wraps=get_text_features) as text_mock:
+            items = [StageItem(image=None, meta={"filename": f}) for f in self.files]
+            result = stage.step_batch(items)
+            result2 = stage.step_batch([StageItem(image=self.load_pil(f)) for f in self.files])
+
+            # one forward pass per batch, the prompt is encoded once
+            self.assertEqual(2, image_mock.call_count)
+            self.assertEqual(1, text_mock.call_count)
+
+        best = list(np.argsort(-expected)[:2])
+        self.assertEqual([self.files[i] for i in best], [item.meta["filename"] for item in result])
+        np.testing.assert_allclose(expected[best], [item.meta["score"] for item in result], atol=1e-5)
+        np.testing.assert_allclose(
+            [item.meta["score"] for item in result], [item.meta["score"] for item in result2], atol=1e-2,
+        )
+
+        self.assertEqual(8, stage.num_images)
+        self.assertGreater(stage.images_per_second, 0)
+
+    def test_200_min_score_and_select(self):
+        expected = self.expected_scores("a zebra")
+        threshold = float(np.median(expected))
+
+        stage = ClipStage("a zebra", min_score=threshold, model=self.model, device="cpu")
+        result = stage.step_batch([StageItem(image=None, meta={"filename": f}) for f in self.files])
+        self.assertEqual(int((expected >= threshold).sum()), len(result))
+        self.assertTrue(all(item.meta["score"] >= threshold for item in result))
+
+        stage = ClipStage("a zebra", top_n=3, batch_size=3, model=self.model, device="cpu")
+        result = stage.select(self.files)
+        self.assertEqual(
+            [self.files[i] for i in np.argsort(-expected)[:3]],
+            [item.meta["filename"] for item in result],
+        )
+
+    def test_300_pipeline(self):
+        stage = ClipStage("a dog", top_n=1, batch_size=2, model=self.model, device="cpu")
+        pipeline = Pipeline([LoadImageStage(), stage])
+        result = pipeline.process(items_from_folder(DATA_PATH / "animals"))
+
+        self.assertEqual(2, len(result))
+        self.assertEqual({"items_in": 4, "items_out": 2, "batches": 2}, {
+            key: pipeline.stats()[1][key] for key in ("items_in", "items_out", "batches")
+        })
@@ -0,0 +1,74 @@
+import numpy as np
+import torch
+
+from tests.base import *
+
+from src.clip import ClipSingleton, MODEL_DIMENSIONS, get_image_features, get_text_features
+from src.clip.stub import StubClip, parse_stub_name
+
+
+class TestClipStub(TestBase):
+
+    def tearDown(self):
+        ClipSingleton.unload()
+
+    def test_100_names(self):
+        self.assertEqual((512, 0.), parse_stub_name("stub-512"))
+        self.assertEqual((768, 4.4), parse_stub_name("stub-768@4.4"))
+        self.assertIsNone(parse_stub_name("ViT-B/32"))
+        self.assertIsNone(parse_stub_name("stub-"))
+        with self.assertRaises(ValueError):
+            StubClip.from_name("stub-x")
+
+        self.assertEqual(512, ClipSingleton.dimensions("stub-512"))
+        self.assertEqual([], ClipSingleton.loaded())
+        self.assertEqual(24, ClipSingleton.dimensions("stub-24"))
+        self.assertEqual(24, MODEL_DIMENSIONS["stub-24"])
+
+        model, _ = ClipSingleton.get("stub-512", "cpu")
+        self.assertEqual(224, model.input_resolution)
+        self.assertEqual(77, model.context_length)
+        self.assertEqual(49408, model.vocab_size)
+        self.assertEqual(torch.float32, model.dtype)
+        self.assertEqual(0, model.num_layers)
+        self.assertEqual(10, StubClip.from_name("stub-512@.59").num_layers)
+
+        with self.assertRaises(ValueError):
+            ClipSingleton.get("stub-512", "cpu+onnx")
+
+    def test_200_deterministic(self):
+        files = sorted((DATA_PATH / "animals").glob("*.jpg"))
+        features = get_image_features(files, model="stub-512", device="cpu")
+        self.assertEqual((4, 512), features.shape)
+        np.testing.assert_allclose(np.ones(4), np.linalg.norm(features, axis=-1), rtol=1e-5)
+        # all different
+        self.assertEqual(4, len({f.tobytes() for f in features}))
+
+        # same image, same vector, independent of the batch
+        ClipSingleton.unload()
+        np.testing.assert_array_equal(
+            features[2], get_image_features([self.load_pil(files[2])], model="stub-512", device="cpu")[0],
+        )
+
+        texts = get_text_features(["a dog", "a cat", "a dog"], model="stub-512", device="cpu")
+        np.testing.assert_array_equal(texts[0], texts[2])
+        self.assertFalse(np.allclose(texts[0], texts[1]))
+        np.testing.assert_array_equal(texts[1], get_text_features("a cat", model="stub-512", device="cpu"))
+
+    def test_300_imagedb(self):
+        from src.imagedb import ImageDB
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+            db.add_directory(DATA_PATH / "animals")
+            db.update_embeddings(model="stub-512", device="cpu")
+            self.assertEqual([{"model": "stub-512", "count": 4}], db.status()["embeddings"])
+
+            index = db.sim_index("stub-512")
+            self.assertEqual(4, index.size)
+            result = index.images_by_text("a dog", count=2, device="cpu")
+            self.assertEqual(2, len(result))
+            self.assertEqual(
+                [(entry.id, score) for entry, score in result],
+                [(entry.id, score) for entry, score in index.images_by_text("a dog", count=2, device="cpu")],
+            )
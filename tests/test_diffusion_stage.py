@@ -0,0 +1,155 @@
+import json
+from unittest import mock
+
+import numpy as np
+import torch
+
+from tests.base import *
+
+from src.stage import StageItem
+from src.pipeline import Pipeline
+
+
+def save_tiny_diffusion(path: Path) -> Path:
+    """
+    Store a randomly initialized StableDiffusionPipeline which can be loaded
+    by `from_pretrained(path)`, with a tokenizer of single characters
+    """
+    from clip.simple_tokenizer import bytes_to_unicode
+    from diffusers import StableDiffusionPipeline, UNet2DConditionModel, AutoencoderKL, PNDMScheduler
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+
+    torch.manual_seed(0)
+    unet = UNet2DConditionModel(
+        block_out_channels=(4, 8), layers_per_block=1, norm_num_groups=4, sample_size=8,
+        cross_attention_dim=8, attention_head_dim=2,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+    )
+    vae = AutoencoderKL(
+        block_out_channels=(4,), norm_num_groups=4, latent_channels=4, sample_size=8,
+        down_block_types=("DownEncoderBlock2D",), up_block_types=("UpDecoderBlock2D",),
+    )
+
+    chars = list(bytes_to_unicode().values())
+    tokens = chars + [c + "</w>" for c in chars] + ["<|startoftext|>", "<|endoftext|>"]
+    vocab = {token: i for i, token in enumerate(tokens)}
+    tokenizer_path = path / "tokenizer-files"
+    tokenizer_path.mkdir(parents=True)
+    (tokenizer_path / "vocab.json").write_text(json.dumps(vocab))
+    (tokenizer_path / "merges.txt").write_text("#version: 0.2\n")
+    tokenizer = CLIPTokenizer(
+        str(tokenizer_path / "vocab.json"), str(tokenizer_path / "merges.txt"), model_max_length=16,
+    )
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=len(vocab), hidden_size=8, intermediate_size=16, num_hidden_layers=1,
+        num_attention_heads=2, max_position_embeddings=16, projection_dim=8,
+        bos_token_id=vocab["<|startoftext|>"], eos_token_id=vocab["<|endoftext|>"],
+        pad_token_id=vocab["<|endoftext|>"],
+    ))
+
+    pipeline = StableDiffusionPipeline(
+        unet=unet, vae=vae, text_encoder=text_encoder, tokenizer=tokenizer,
+        scheduler=PNDMScheduler(skip_prk_steps=True, steps_offset=1),
+        safety_checker=None, feature_extractor=None, requires_safety_checker=False,
+    )
+    pipeline.save_pretrained(path / "model")
+    return path / "model"
+
+
+class TestDiffusionStage(TestBase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.model = str(save_tiny_diffusion(Path(cls.tmp_dir.name)))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def tearDown(self):
+        from src.stages.diffusion_stage import DiffusionPipelineCache
+        DiffusionPipelineCache.unload()
+
+    def create_stage(self, **kwargs):
+        from src.stages.diffusion_stage import DiffusionStage
+        kwargs = {
+            "model": self.model, "device": "cpu", "num_inference_steps": 2,
+            "width": 16, "height": 16, **kwargs,
+        }
+        return DiffusionStage(**kwargs)
+
+    def test_100_generate(self):
+        from src.stages.diffusion_stage import DiffusionPipelineCache
+
+        stage = self.create_stage(batch_size=2)
+        pipeline, _ = stage.pipeline()
+        text_encoder = pipeline.text_encoder
+        with mock.patch.object(text_encoder, "forward", wraps=text_encoder.forward) as encode_mock:
+            result = Pipeline([stage]).process(
+                StageItem(image=None, meta={"prompt": prompt, "id": i})
+                for i, prompt in enumerate(["a cat", "a dog", "a cat"])
+            )
+            # repeated prompts are encoded once, together with the negative prompt
+            self.assertEqual(4, encode_mock.call_count)
+            stage.step_batch([StageItem(image="a dog")])
+            self.assertEqual(4, encode_mock.call_count)
+
+        self.assertEqual([0, 1, 2], [item.meta["id"] for item in result])
+        self.assertEqual([0, 1, 2], [item.meta["seed"] for item in result])
+        self.assertEqual([(16, 16)] * 3, [item.image.size for item in result])
+        self.assertEqual(4, stage.num_images)
+        self.assertEqual([2, 1, 1], [s["images"] for s in stage.batch_stats])
+        self.assertIsNone(stage.batch_stats[0]["memory"])
+        self.assertGreater(stage.batch_stats[0]["process_peak_rss"], 0)
+        self.assertGreater(stage.images_per_second, 0)
+
+        # the pipeline is loaded once per model and device
+        self.assertEqual([f"{self.model}/cpu/torch.float32"], DiffusionPipelineCache.loaded())
+        self.assertIs(pipeline, self.create_stage().pipeline()[0])
+
+    def test_200_seeds(self):
+        stage = self.create_stage(batch_size=3)
+        batch = stage.step_batch([
+            StageItem(image=None, meta={"prompt": prompt, "seed": 23})
+            for prompt in ("a", "b", "a")
+        ])
+        single = self.create_stage(low_memory=True).step_batch([
+            StageItem(image=None, meta={"prompt": "a", "seed": 23}),
+        ])
+
+        # an image only depends on prompt and seed, not on the batch or the memory settings
+        np.testing.assert_allclose(np.asarray(batch[0].image), np.asarray(batch[2].image), atol=1)
+        np.testing.assert_allclose(np.asarray(batch[0].image), np.asarray(single[0].image), atol=1)
+
+        with self.assertRaises(ValueError):
+            stage.step_batch([StageItem(image=None)])
+
+    def test_300_old_encode_prompt(self):
+        stage = self.create_stage(negative_prompt="ugly")
+        pipeline, _ = stage.pipeline()
+
+        class _OldPipeline:
+            """Like diffusers < 0.22, without `encode_prompt`"""
+            device = pipeline.device
+
+            def _encode_prompt(self, prompt, do_classifier_free_guidance, **kwargs):
+                embeds, negative_embeds = pipeline.encode_prompt(
+                    prompt, do_classifier_free_guidance=do_classifier_free_guidance, **kwargs,
+                )
+                if do_classifier_free_guidance:
+                    return torch.cat([negative_embeds, embeds])
+                return embeds
+
+        for do_guidance in (True, False):
+            expected = stage._encode_prompt(pipeline, "a cat", do_guidance)
+            stage._prompt_cache.clear()
+            embeds = stage._encode_prompt(_OldPipeline(), "a cat", do_guidance)
+            stage._prompt_cache.clear()
+
+            torch.testing.assert_close(expected[0], embeds[0])
+            if do_guidance:
+                torch.testing.assert_close(expected[1], embeds[1])
+            else:
+                self.assertIsNone(embeds[1])
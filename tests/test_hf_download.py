@@ -0,0 +1,123 @@
+import gc
+import http.server
+import threading
+import time
+
+from tests.base import *
+from tests.fake_gradio import data_uri
+
+from src.hf import ImageResult, AudioResult
+from src.hf.download import fetch, fetch_all, decode_data_uri
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # keep-alive
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        if self.path == "/missing":
+            self.send_error(404)
+            return
+        data = self.path.encode() * 10_000
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/x-wav")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections.add(self.client_address)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FileServer(http.server.ThreadingHTTPServer):
+
+    def __init__(self, delay: float = 0.):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.connections = set()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class TestHfDownload(TestBase):
+
+    def test_100_data_uri(self):
+        result = decode_data_uri(data_uri(b"\x00\x01abc", "image/png"))
+        self.assertEqual(b"\x00\x01abc", result.data)
+        self.assertEqual("image/png", result.mime_type)
+        self.assertEqual(b"a b", decode_data_uri("data:,a%20b").data)
+
+        result = fetch(data_uri(b"123", "image/jpeg"), ImageResult)
+        self.assertIsInstance(result, ImageResult)
+        self.assertEqual("jpg", result.extension)
+
+    def test_200_stream_to_disk(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with FileServer() as server:
+                result = fetch(f"{server.url}/a", AudioResult)
+                with self.assertRaises(Exception):
+                    fetch(f"{server.url}/missing")
+
+            self.assertIsNone(result.data)
+            self.assertEqual("wav", result.extension)
+            self.assertEqual(20_000, result.size)
+            temp_filename = result.filename
+            self.assertTrue(temp_filename.exists())
+
+            # the temporary file is moved
+            result.save(Path(tmp_dir) / "a.wav")
+            self.assertFalse(temp_filename.exists())
+            self.assertEqual(b"/a" * 10_000, (Path(tmp_dir) / "a.wav").read_bytes())
+            result.save(Path(tmp_dir) / "b.wav")
+            self.assertEqual(b"/a" * 10_000, (Path(tmp_dir) / "b.wav").read_bytes())
+
+            # the files get the usual permissions, not the 0600 of temporary files
+            (Path(tmp_dir) / "c.wav").write_bytes(b"")
+            for name in ("a.wav", "b.wav"):
+                self.assertEqual(
+                    (Path(tmp_dir) / "c.wav").stat().st_mode,
+                    (Path(tmp_dir) / name).stat().st_mode,
+                )
+
+            # unsaved results remove their temporary file
+            with FileServer() as server:
+                result = fetch(f"{server.url}/b")
+            temp_filename = result.filename
+            del result
+            gc.collect()
+            self.assertFalse(temp_filename.exists())
+
+    def test_300_concurrent(self):
+        with FileServer(delay=.2) as server:
+            urls = [f"{server.url}/file={i}" for i in range(8)] + [data_uri(b"x")]
+
+            start_time = time.monotonic()
+            results = fetch_all(urls, AudioResult)
+            seconds = time.monotonic() - start_time
+            self.assertLess(seconds, 1.)
+            self.assertEqual(
+                [f"/file={i}".encode() * 10_000 for i in range(8)] + [b"x"],
+                [r.read() for r in results],
+            )
+
+            # the connections are reused
+            num_connections = len(server.connections)
+            fetch_all(urls, AudioResult)
+            self.assertEqual(num_connections, len(server.connections))
@@ -0,0 +1,132 @@
+import asyncio
+import time
+
+from tests.base import *
+from tests.fake_gradio import FakeGradioServer
+
+from src.hf import HuggingfaceSpace, SpacePool, EndpointLimits
+from src.hf.scheduling import PriorityLimiter, TokenBucket
+
+
+class TestHfScheduler(TestBase):
+
+    def test_100_priority_limiter(self):
+        async def _test():
+            limiter = PriorityLimiter(1)
+            order = []
+
+            async def _job(name: str, priority: int):
+                async with limiter.slot(priority):
+                    order.append(name)
+                    await asyncio.sleep(.01)
+
+            tasks = [asyncio.create_task(_job("first", 0))]
+            await asyncio.sleep(0)
+            for name, priority in (("low", -1), ("normal", 0), ("high", 5), ("normal2", 0)):
+                tasks.append(asyncio.create_task(_job(name, priority)))
+            await asyncio.sleep(0)
+            # a cancelled waiter does not block the others
+            tasks[2].cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            self.assertEqual(["first", "high", "normal2", "low"], order)
+            self.assertEqual(0, limiter.active)
+
+        asyncio.run(_test())
+
+    def test_110_token_bucket(self):
+        async def _test():
+            bucket = TokenBucket(rate=20, burst=2)
+            start_time = time.monotonic()
+            for i in range(6):
+                await bucket.acquire()
+            return time.monotonic() - start_time
+
+        # 2 at once, the other 4 at 20 per second
+        self.assertGreater(asyncio.run(_test()), .18)
+
+    def test_200_retry_queue_full(self):
+        with FakeGradioServer(process_time=.1, max_queue=0) as server:
+            with SpacePool(backoff=.05, max_backoff=.2) as pool:
+                jobs = [pool.run(HuggingfaceSpace(server.url, [i])) for i in range(3)]
+                for job in jobs:
+                    job.result(10)
+                metrics = pool.metrics()
+
+            self.assertEqual(["complete"] * 3, [job.space.state for job in jobs])
+            self.assertGreater(server.num_queue_full, 0)
+            self.assertEqual(server.num_queue_full, sum(job.attempts - 1 for job in jobs))
+            self.assertEqual(
+                {"queued": 0, "running": 0, "retry": 0, "completed": 3, "failed": 0, "retries": server.num_queue_full},
+                {k: v for k, v in metrics.items() if k not in ("latency", "wait", "endpoints")},
+            )
+            self.assertGreater(metrics["latency"], .1)
+            self.assertEqual([server.url], list(metrics["endpoints"]))
+
+    def test_210_give_up(self):
+        space = HuggingfaceSpace("ws://127.0.0.1:1/queue/join")
+        with SpacePool(max_retries=2, backoff=.01) as pool:
+            job = pool.run(space)
+            job.result(10)
+            self.assertEqual(1, pool.metrics()["failed"])
+        self.assertEqual("error", space.state)
+        self.assertEqual(3, job.attempts)
+
+    def test_300_timeout_and_cancel(self):
+        with FakeGradioServer(process_time=10) as server:
+            finished = []
+            with SpacePool() as pool:
+                spaces = [HuggingfaceSpace(server.url, [i]) for i in range(3)]
+                for space in spaces:
+                    space.finished = lambda space=space: finished.append(space.state)
+
+                start_time = time.monotonic()
+                timeout_job = pool.run(spaces[0], timeout=.2)
+                waiting_job = pool.run(spaces[1])
+                cancelled_job = pool.run(spaces[2])
+                cancelled_job.cancel()
+                timeout_job.result(5)
+                cancelled_job.result(5)
+                self.assertLess(time.monotonic() - start_time, 2)
+
+                time.sleep(.2)
+                self.assertEqual("processing", spaces[1].state)
+                self.assertEqual(1, pool.metrics()["running"])
+                waiting_job.cancel()
+
+            self.assertEqual(["cancelled", "cancelled", "timeout"], sorted(finished))
+
+    def test_400_priority_and_rate(self):
+        with FakeGradioServer(concurrency=100) as server:
+            with SpacePool(endpoint_limits={server.url: EndpointLimits(concurrency=1, rate=20)}) as pool:
+                start_time = time.monotonic()
+                jobs = [
+                    pool.run(HuggingfaceSpace(server.url, [name]), priority=priority)
+                    for name, priority in (("first", 0), ("low", -1), ("high", 1), ("normal", 0))
+                ]
+                for job in jobs:
+                    job.result(10)
+                seconds = time.monotonic() - start_time
+
+            self.assertEqual([["first"], ["high"], ["normal"], ["low"]], server.requests)
+            # one connection at once, the other three at 20 per second
+            self.assertGreater(seconds, .14)
+
+    def test_410_saturated_endpoint(self):
+        with FakeGradioServer(concurrency=10, process_time=.5) as slow, FakeGradioServer(concurrency=10) as fast:
+            with SpacePool(size=2, max_per_endpoint=1) as pool:
+                start_time = time.monotonic()
+                slow_jobs = [pool.run(HuggingfaceSpace(slow.url, [i])) for i in range(3)]
+                time.sleep(.1)
+                fast_job = pool.run(HuggingfaceSpace(fast.url, ["fast"]))
+
+                fast_job.result(10)
+                # the queued jobs of the slow endpoint do not hold the second global slot
+                self.assertLess(time.monotonic() - start_time, .45)
+                self.assertEqual(1, pool.metrics()["endpoints"][slow.url]["running"])
+
+                for job in slow_jobs:
+                    job.result(10)
+
+            self.assertEqual(1, slow.max_connections)
+            self.assertEqual("complete", fast_job.space.state)
@@ -0,0 +1,80 @@
+import threading
+import time
+
+from tests.base import *
+from tests.fake_gradio import FakeGradioServer
+
+from src.hf import HuggingfaceSpace, SpacePool, StableDiffusionSpace
+
+
+class TestHuggingfaceSpace(TestBase):
+
+    def test_100_run(self):
+        with FakeGradioServer() as server:
+            space = StableDiffusionSpace("a red hat")
+            space.websocket_url = server.url
+            finished = []
+            space.finished = lambda: finished.append(True)
+            space.run()
+
+            self.assertEqual("complete", space.state)
+            self.assertEqual([True], finished)
+            self.assertEqual([["a red hat", None, 9]], server.requests)
+            results = space.result()
+            self.assertEqual(1, len(results))
+            self.assertEqual(b"a red hat", results[0].data)
+            self.assertEqual("fake", results[0].extension)
+
+    def test_200_errors(self):
+        with FakeGradioServer(process_time=.3, max_queue=0) as server:
+            with SpacePool(max_retries=0) as pool:
+                spaces = [HuggingfaceSpace(server.url, [i]) for i in range(2)]
+                jobs = [pool.run(space) for space in spaces]
+                for job in jobs:
+                    job.result(10)
+
+            self.assertEqual(["complete", "queue_full"], sorted(s.state for s in spaces))
+            self.assertEqual(1, server.num_queue_full)
+
+        # the server is gone
+        space = HuggingfaceSpace(server.url)
+        space.run()
+        self.assertEqual("error", space.state)
+        self.assertIn("Error", space.error)
+
+    def test_300_endpoint_limit(self):
+        with FakeGradioServer(concurrency=10, process_time=.05) as server:
+            with FakeGradioServer(concurrency=10, process_time=.05) as other_server:
+                finished = []
+                lock = threading.Lock()
+
+                def _finished():
+                    with lock:
+                        finished.append(True)
+
+                with SpacePool(max_per_endpoint=3, endpoint_limits={other_server.url: 5}) as pool:
+                    for i in range(20):
+                        for url in (server.url, other_server.url):
+                            space = HuggingfaceSpace(url, [i])
+                            space.finished = _finished
+                            pool.run(space)
+
+                self.assertEqual(40, len(finished))
+                self.assertEqual(20, len(server.requests))
+                self.assertEqual(3, server.max_connections)
+                self.assertEqual(5, other_server.max_connections)
+
+    def test_900_benchmark(self):
+        count = 300
+        with FakeGradioServer(concurrency=count, process_time=.5) as server:
+            start_time = time.perf_counter()
+            with SpacePool() as pool:
+                spaces = [HuggingfaceSpace(server.url, [i]) for i in range(count)]
+                for space in spaces:
+                    pool.run(space)
+            seconds = time.perf_counter() - start_time
+
+        print(f"\n{count} concurrent spaces: {seconds:.2f}s, max connections {server.max_connections}")
+        self.assertEqual(["complete"] * count, [s.state for s in spaces])
+        self.assertEqual(count, server.max_connections)
+        self.assertLess(seconds, 5)
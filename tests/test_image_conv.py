@@ -1,3 +1,7 @@
+import time
+
+import torch
+
 from tests.base import *
 
 class TestImageConv(TestBase):
@@ -28,3 +32,77 @@ class TestImageConv(TestBase):
                 except Exception as e:
                     print(f"\nIN {filename}:\n")
                     raise
+
+    def test_200_dtype(self):
+        pil_image = self.load_pil("rgb48x32.png")
+
+        self.assertEqual(np.uint8, image_to_numpy(pil_image).dtype)
+        self.assertEqual(np.float32, image_to_numpy(pil_image, dtype="float32").dtype)
+        self.assertEqual(torch.uint8, image_to_torch(pil_image).dtype)
+        self.assertEqual(torch.float32, image_to_torch(pil_image, dtype=torch.float32).dtype)
+
+        # values above 127 survive the round trip
+        data = np.full((3, 4, 4), 200, dtype=np.uint8)
+        np.testing.assert_equal(data, image_to_numpy(image_to_pil(data)))
+        np.testing.assert_equal(data, image_to_numpy(image_to_pil(data.astype(np.float32))))
+
+    def test_210_shared_memory(self):
+        array = np.zeros((3, 8, 8), dtype=np.uint8)
+        self.assertIs(array, image_to_numpy(array))
+
+        tensor = image_to_torch(array)
+        tensor[0, 0, 0] = 23
+        self.assertEqual(23, array[0, 0, 0])
+
+        self.assertEqual(23, image_to_numpy(tensor)[0, 0, 0])
+
+    def test_300_batches(self):
+        pil_images = [self.load_pil("rgb48x32.png"), self.load_pil("rgb48x32.png")]
+
+        batch = image_to_numpy(pil_images)
+        self.assertEqual((2, 3, 32, 48), batch.shape)
+        self.assertEqual(np.uint8, batch.dtype)
+
+        batch = image_to_torch(pil_images, dtype=torch.float32)
+        self.assertEqual((2, 3, 32, 48), tuple(batch.shape))
+
+        pil_images_2 = batch_to_pil(batch)
+        self.assertEqual(
+            [i.tobytes() for i in pil_images],
+            [i.tobytes() for i in pil_images_2],
+        )
+
+    def test_900_benchmark_large_images(self):
+        def _legacy_image_to_numpy(image: PIL.Image.Image) -> np.ndarray:
+            data = np.array(image.getdata()).reshape(image.height, image.width, -1)
+            return data[::-1, ...].transpose(2, 0, 1)
+
+        def _time(func, *args, **kwargs) -> float:
+            # the fastest of a few runs is less affected by other load on the machine
+            seconds = []
+            for _ in range(3):
+                start_time = time.perf_counter()
+                func(*args, **kwargs)
+                seconds.append(time.perf_counter() - start_time)
+            return min(seconds)
+
+        print()
+        print(f"{'size':>10} {'to_numpy ms':>12} {'to_torch ms':>12} {'to_pil ms':>12} {'legacy ms':>10}")
+        for size in (512, 2048, 4096):
+            pil_image = PIL.Image.fromarray(
+                np.random.randint(0, 256, (size, size, 3), dtype=np.uint8)
+            )
+            array = image_to_numpy(pil_image)
+
+            time_numpy = _time(image_to_numpy, pil_image)
+            time_torch = _time(image_to_torch, pil_image)
+            time_pil = _time(image_to_pil, array)
+            time_legacy = _time(_legacy_image_to_numpy, pil_image) if size <= 512 else None
+
+            print(
+                f"{size:10} {time_numpy * 1000:12.2f} {time_torch * 1000:12.2f} {time_pil * 1000:12.2f}"
+                + (f" {time_legacy * 1000:10.2f}" if time_legacy is not None else "")
+            )
+            if time_legacy is not None:
+                # usually more than 100 times faster, so only a broken fast path fails this
+                self.assertLess(time_numpy, time_legacy)
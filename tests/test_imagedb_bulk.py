@@ -0,0 +1,149 @@
+import time
+
+import numpy as np
+import sqlalchemy as sq
+
+from tests.base import *
+
+from src.imagedb import ImageDB, ImageEntry, Embedding, SimIndex
+
+
+def create_images(db: ImageDB, count: int) -> List[int]:
+    """
+    Add `count` image entries (without files) and return their ids
+    """
+    with db.sql_session() as session:
+        session.execute(sq.insert(ImageEntry), [
+            {"path": "/bulk", "name": f"image-{i}.png"}
+            for i in range(count)
+        ])
+        session.commit()
+        return list(session.execute(sq.select(ImageEntry.id).order_by(ImageEntry.id)).scalars())
+
+
+def random_embeddings(count: int, dims: int = 8, seed: int = 23) -> np.ndarray:
+    embeddings = np.random.default_rng(seed).normal(size=(count, dims)).astype(np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=-1, keepdims=True)
+
+
+def fake_search(index: SimIndex, embedding: np.ndarray, count: int = 1) -> List[int]:
+    _, labels = index._index.search(embedding.reshape(1, -1), count)
+    return [int(l) for l in labels[0]]
+
+
+class TestImageDBBulk(TestBase):
+
+    def test_100_write_embeddings(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+            image_ids = create_images(db, 10)
+            embeddings = random_embeddings(10)
+
+            self.assertEqual(10, db.write_embeddings("fake", image_ids, embeddings, chunk_size=3))
+            self.assertEqual([{"model": "fake", "count": 10}], db.status()["embeddings"])
+            self.assertEqual(8, db.embedding_dimensions("fake"))
+            np.testing.assert_allclose(embeddings[4], db.get_embedding(image_ids[4], "fake").to_numpy())
+
+            # upsert: replaced and new embeddings, the last of duplicates wins
+            new_embeddings = random_embeddings(3, seed=1)
+            self.assertEqual(2, db.write_embeddings(
+                "fake", [image_ids[4], image_ids[5], image_ids[4]], new_embeddings,
+            ))
+            self.assertEqual([{"model": "fake", "count": 10}], db.status()["embeddings"])
+            np.testing.assert_allclose(new_embeddings[2], db.get_embedding(image_ids[4], "fake").to_numpy())
+            np.testing.assert_allclose(new_embeddings[1], db.get_embedding(image_ids[5], "fake").to_numpy())
+            np.testing.assert_allclose(embeddings[6], db.get_embedding(image_ids[6], "fake").to_numpy())
+
+            with self.assertRaises(ValueError):
+                db.write_embeddings("fake", image_ids[:2], random_embeddings(2, dims=4))
+            with self.assertRaises(ValueError):
+                db.write_embeddings("fake", image_ids[:2], random_embeddings(3))
+
+    def test_200_incremental_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+            image_ids = create_images(db, 20)
+            embeddings = random_embeddings(20)
+            db.write_embeddings("fake", image_ids[:10], embeddings[:10])
+
+            index = db.sim_index("fake")
+            self.assertEqual(10, index.size)
+            self.assertTrue(index.filename.exists())
+            self.assertEqual([image_ids[3]], fake_search(index, embeddings[3]))
+
+            # the loaded index is updated by the writer
+            db.write_embeddings("fake", image_ids[10:], embeddings[10:])
+            self.assertEqual(20, index.size)
+            self.assertEqual([image_ids[15]], fake_search(index, embeddings[15]))
+
+            db.write_embeddings("fake", [image_ids[3]], -embeddings[3:4])
+            self.assertEqual(20, index.size)
+            self.assertEqual([image_ids[3]], fake_search(index, -embeddings[3]))
+            self.assertNotEqual([image_ids[3]], fake_search(index, embeddings[3]))
+
+            # another process writes, the persisted index only reads the new embeddings
+            other_db = ImageDB(tmp_dir)
+            other_db.write_embeddings("fake", [image_ids[5]], -embeddings[5:5 + 1])
+            index = SimIndex(db, "fake")
+            self.assertEqual(20, index.size)
+            self.assertEqual([image_ids[5]], fake_search(index, -embeddings[5]))
+            self.assertEqual(0, index.sync())
+
+            # embeddings were deleted, the index is rebuilt
+            with db.sql_session() as session:
+                session.execute(sq.delete(Embedding).where(Embedding.image_id == image_ids[0]))
+                session.commit()
+            db.reload()
+            self.assertEqual(19, db.sim_index("fake").size)
+            self.assertEqual(19, SimIndex(db, "fake").size)
+
+    def test_210_replace_newest_embedding(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+            image_ids = create_images(db, 3)
+            embeddings = np.eye(3, 8, dtype=np.float32)
+            db.write_embeddings("fake", image_ids, embeddings)
+            self.assertEqual(3, db.sim_index("fake").size)
+
+            # another process replaces the embedding with the highest id
+            ImageDB(tmp_dir).write_embeddings("fake", [image_ids[2]], embeddings[:1])
+
+            index = SimIndex(db, "fake")
+            self.assertEqual(3, index.size)
+            self.assertEqual({image_ids[0], image_ids[2]}, set(fake_search(index, embeddings[0], count=2)))
+            self.assertNotEqual([image_ids[2]], fake_search(index, embeddings[2]))
+
+    def test_300_index_not_persisted(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+            image_ids = create_images(db, 3)
+            db.write_embeddings("fake", image_ids, random_embeddings(3))
+
+            index = SimIndex(db, "fake", persist=False)
+            self.assertEqual(3, index.size)
+            self.assertFalse(index.filename.exists())
+
+    def test_900_benchmark(self):
+        count = 2000
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(f"{tmp_dir}/single")
+            image_ids = create_images(db, count)
+            embeddings = random_embeddings(count, dims=512)
+
+            start_time = time.perf_counter()
+            with db.sql_session() as session:
+                for image_id, embedding in zip(image_ids, embeddings):
+                    db.add_embedding(image_id, "fake", embedding, sql_session=session)
+            single_seconds = time.perf_counter() - start_time
+
+            db = ImageDB(f"{tmp_dir}/bulk")
+            image_ids = create_images(db, count)
+            start_time = time.perf_counter()
+            db.write_embeddings("fake", image_ids, embeddings)
+            bulk_seconds = time.perf_counter() - start_time
+
+        print(
+            f"\n{count} embeddings: add_embedding {count / single_seconds:.0f}/s"
+            f", write_embeddings {count / bulk_seconds:.0f}/s"
+        )
+        self.assertLess(bulk_seconds, single_seconds)
@@ -0,0 +1,133 @@
+import threading
+import time
+
+from tests.base import *
+from tests.test_clip_models import save_tiny_clip
+
+from src.imagedb import ImageDB, ImageDBDaemon, DaemonClient, DaemonError
+
+
+class DaemonThread:
+    """
+    Runs an ImageDBDaemon in a background thread
+    """
+    def __init__(self, db: ImageDB, socket_path: Path, **kwargs):
+        self.daemon = ImageDBDaemon(db, socket_path=socket_path, **kwargs)
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+
+    def __enter__(self) -> ImageDBDaemon:
+        self.thread.start()
+        self.daemon.listening.wait(10)
+        return self.daemon
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.daemon.shutdown()
+        self.thread.join()
+
+
+class TestImageDBDaemon(TestBase):
+
+    def test_100_no_daemon(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.assertIsNone(DaemonClient.connect(Path(tmp_dir) / "daemon.sock"))
+
+    def test_200_requests(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model = str(save_tiny_clip(Path(tmp_dir) / "tiny.pt"))
+            socket_path = Path(tmp_dir) / "daemon.sock"
+            db = ImageDB(tmp_dir)
+            db.add_directory(DATA_PATH)
+
+            with DaemonThread(db, socket_path, reload_interval=0):
+                self.assertEqual(0o600, socket_path.stat().st_mode & 0o777)
+                with DaemonClient.connect(socket_path) as client:
+                    self.assertGreater(client.ping()["pid"], 0)
+                    self.assertEqual(3, client.status()["num_images"])
+
+                    client.update_embeddings(model=model, device="cpu")
+                    self.assertEqual([{"model": model, "count": 3}], client.status()["embeddings"])
+
+                    result = client.query("a red hat", count=2, model=model, device="cpu")
+                    self.assertEqual(2, len(result))
+                    self.assertTrue(Path(result[0]["filename"]).exists())
+                    # same as without the daemon
+                    self.assertEqual(
+                        [(e.id, score) for e, score in db.sim_index(model).images_by_text(
+                            "a red hat", count=2, device="cpu",
+                        )],
+                        [(r["id"], r["score"]) for r in result],
+                    )
+
+                    with self.assertRaises(DaemonError):
+                        client.request("fly")
+                    # connection is still usable after an error
+                    self.assertEqual(3, client.status()["num_images"])
+
+                # another process changes the database
+                other_db = ImageDB(tmp_dir)
+                other_db.add_directory(DATA_PATH / "animals")
+                other_db.update_embeddings(model=model, device="cpu")
+
+                with DaemonClient.connect(socket_path) as client:
+                    self.assertEqual(7, client.status()["num_images"])
+                    # the index is rebuilt in the background
+                    for i in range(100):
+                        indices = client.status(detailed=True)["indices"]
+                        if indices[0]["size"] == 7:
+                            break
+                        time.sleep(.05)
+                    self.assertEqual([{"model": model, "size": 7, "missing": 0}], [
+                        {k: v for k, v in i.items() if k != "age"} for i in indices
+                    ])
+
+                    client.shutdown()
+
+            self.assertFalse(socket_path.exists())
+
+    def test_300_idle_timeout(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            socket_path = Path(tmp_dir) / "daemon.sock"
+            with DaemonThread(ImageDB(tmp_dir), socket_path, idle_timeout=.3):
+                with DaemonClient.connect(socket_path) as client:
+                    # an open connection keeps the daemon alive
+                    time.sleep(.6)
+                    client.ping()
+
+                start_time = time.monotonic()
+                while socket_path.exists() and time.monotonic() - start_time < 5:
+                    time.sleep(.05)
+                self.assertFalse(socket_path.exists())
+
+    def test_400_stale_socket(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            socket_path = Path(tmp_dir) / "daemon.sock"
+            db = ImageDB(tmp_dir)
+            socket_path.write_text("")
+
+            with DaemonThread(db, socket_path):
+                with DaemonClient.connect(socket_path) as client:
+                    client.ping()
+
+                with self.assertRaises(RuntimeError):
+                    ImageDBDaemon(db, socket_path=socket_path).serve_forever()
+
+    def test_900_benchmark(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model = str(save_tiny_clip(Path(tmp_dir) / "tiny.pt"))
+            socket_path = Path(tmp_dir) / "daemon.sock"
+            db = ImageDB(tmp_dir)
+            db.add_directory(DATA_PATH, recursive=True)
+            db.update_embeddings(model=model, device="cpu")
+
+            with DaemonThread(db, socket_path):
+                with DaemonClient.connect(socket_path) as client:
+                    client.query("warm up", model=model, device="cpu")
+
+                    start_time = time.perf_counter()
+                    for i in range(50):
+                        client.query(f"query {i}", count=3, model=model, device="cpu")
+                    seconds = (time.perf_counter() - start_time) / 50
+
+            print(f"\ndaemon query: {seconds * 1000:.2f}ms")
+            # a few ms on an idle machine, the generous bound allows for a busy one
+            self.assertLess(seconds, .5)
@@ -0,0 +1,155 @@
+import json
+
+import numpy as np
+import sqlalchemy as sq
+
+from tests.base import *
+
+from src.imagedb import ImageDB, ImageEntry, Embedding, export_embeddings, import_embeddings
+from src.imagedb.export import read_embedding_chunks
+
+
+def create_db(path: str, dims: int = 5) -> ImageDB:
+    db = ImageDB(path)
+    db.add_directory(DATA_PATH, recursive=True)
+    rng = np.random.default_rng(23)
+    with db.sql_session() as session:
+        for image_id in sorted(e.id for e in session.query(ImageEntry)):
+            db.add_embedding(image_id, "fake", rng.uniform(-1, 1, dims).astype(np.float32), sql_session=session)
+    return db
+
+
+def db_embeddings(db: ImageDB, model: str) -> dict:
+    with db.sql_session() as session:
+        return {
+            str(e.images.filename()): e.to_numpy()
+            for e in session.query(Embedding).filter(Embedding.model == model)
+        }
+
+
+class TestImageDBExport(TestBase):
+
+    def test_100_npy(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = create_db(f"{tmp_dir}/a")
+            expected = db_embeddings(db, "fake")
+
+            count = export_embeddings(db, "fake", f"{tmp_dir}/export", chunk_size=3)
+            self.assertEqual(7, count)
+            self.assertEqual(
+                {"format": "npy", "model": "fake", "dimensions": 5, "count": 7},
+                json.loads(Path(f"{tmp_dir}/export/meta.json").read_text()),
+            )
+            embeddings = np.load(f"{tmp_dir}/export/embeddings.npy", mmap_mode="r")
+            self.assertEqual((7, 5), embeddings.shape)
+            self.assertEqual(np.float32, embeddings.dtype)
+            filenames = Path(f"{tmp_dir}/export/filenames.txt").read_text().splitlines()
+            for filename, embedding in zip(filenames, embeddings):
+                np.testing.assert_allclose(expected[filename], embedding)
+
+            # import into another database, images are matched by filename
+            other_db = ImageDB(f"{tmp_dir}/b")
+            self.assertEqual(
+                {"imported": 7, "skipped": 0},
+                import_embeddings(other_db, f"{tmp_dir}/export", chunk_size=2),
+            )
+            self.assertEqual(7, other_db.num_images())
+            self.assertEqual(5, other_db.embedding_dimensions("fake"))
+            actual = db_embeddings(other_db, "fake")
+            self.assertEqual(sorted(expected), sorted(actual))
+            for filename in expected:
+                np.testing.assert_allclose(expected[filename], actual[filename])
+
+            # importing again replaces the embeddings
+            import_embeddings(other_db, f"{tmp_dir}/export", model="fake2")
+            import_embeddings(other_db, f"{tmp_dir}/export", model="fake2")
+            self.assertEqual(
+                [{"model": "fake", "count": 7}, {"model": "fake2", "count": 7}],
+                other_db.status()["embeddings"],
+            )
+
+    def test_200_parquet(self):
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest("pyarrow not installed")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = create_db(f"{tmp_dir}/a")
+            expected = db_embeddings(db, "fake")
+
+            self.assertEqual(7, export_embeddings(db, "fake", f"{tmp_dir}/export.parquet", format="parquet"))
+
+            meta, chunks = read_embedding_chunks(f"{tmp_dir}/export.parquet", chunk_size=4)
+            self.assertEqual("fake", meta["model"])
+            self.assertEqual([4, 3], [len(chunk[0]) for chunk in chunks])
+
+            other_db = ImageDB(f"{tmp_dir}/b")
+            self.assertEqual(
+                {"imported": 7, "skipped": 0},
+                import_embeddings(other_db, f"{tmp_dir}/export.parquet"),
+            )
+            actual = db_embeddings(other_db, "fake")
+            for filename in expected:
+                np.testing.assert_allclose(expected[filename], actual[filename])
+
+    def test_300_import_by_id(self):
+        """
+        Embeddings computed elsewhere, only with image ids
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(f"{tmp_dir}/db")
+            db.add_directory(DATA_PATH)
+            with db.sql_session() as session:
+                image_ids = sorted(e.id for e in session.query(ImageEntry))
+
+            path = Path(tmp_dir) / "external"
+            path.mkdir()
+            embeddings = np.random.default_rng(1).normal(size=(4, 8)).astype(np.float32)
+            np.save(path / "embeddings.npy", embeddings)
+            np.save(path / "image_ids.npy", np.array(image_ids + [1000]))
+
+            with self.assertRaises(ValueError):
+                import_embeddings(db, path)
+
+            self.assertEqual(
+                {"imported": 3, "skipped": 1},
+                import_embeddings(db, path, model="external", add_images=False),
+            )
+            np.testing.assert_allclose(
+                embeddings[1],
+                db.get_embedding(image_ids[1], "external").to_numpy(),
+            )
+
+    def test_400_consistent_export(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = create_db(f"{tmp_dir}/a")
+            with db.sql_session() as session:
+                orphan_id = min(e.id for e in session.query(ImageEntry))
+                # an embedding whose image was removed without it
+                session.execute(sq.delete(ImageEntry).where(ImageEntry.id == orphan_id))
+                session.commit()
+
+            self.assertEqual(6, export_embeddings(db, "fake", f"{tmp_dir}/export", chunk_size=4))
+            image_ids = np.load(f"{tmp_dir}/export/image_ids.npy")
+            self.assertEqual((6, ), image_ids.shape)
+            self.assertNotIn(orphan_id, image_ids)
+            self.assertNotIn(0, image_ids)
+            self.assertEqual((6, 5), np.load(f"{tmp_dir}/export/embeddings.npy").shape)
+
+            # the reader only returns the rows listed in meta.json
+            meta_file = Path(f"{tmp_dir}/export/meta.json")
+            meta_file.write_text(json.dumps({**json.loads(meta_file.read_text()), "count": 5}))
+            meta, chunks = read_embedding_chunks(f"{tmp_dir}/export", chunk_size=4)
+            self.assertEqual([4, 1], [len(chunk[0]) for chunk in chunks])
+
+            # writes of other connections are not visible in the snapshot
+            with db.sql_engine.connect() as connection:
+                db.backend.begin_snapshot(connection)
+                query = sq.select(sq.func.count(Embedding.id))
+                self.assertEqual(7, connection.execute(query).scalar())
+                other_db = ImageDB(f"{tmp_dir}/a")
+                other_db.add_embedding(int(image_ids[0]), "other", [1., 2.])
+                self.assertEqual(7, connection.execute(query).scalar())
+            with db.sql_engine.connect() as connection:
+                self.assertEqual(8, connection.execute(query).scalar())
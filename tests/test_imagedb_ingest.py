@@ -0,0 +1,53 @@
+import shutil
+
+from tests.base import *
+from tests.test_clip_models import save_tiny_clip
+
+from src.imagedb import ImageDB, IngestSink
+
+
+class TestImageDBIngest(TestBase):
+
+    def test_100_ingest(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model = str(save_tiny_clip(Path(tmp_dir) / "tiny.pt"))
+            results_path = Path(tmp_dir) / "results"
+            shutil.copytree(DATA_PATH / "animals", results_path)
+            (results_path / "audio.wav").write_bytes(b"")
+
+            db = ImageDB(Path(tmp_dir) / "db")
+            # the live index is updated, not rebuilt
+            db.add_image(DATA_PATH / "gray48x32.png")
+            db.update_embeddings(model=model, device="cpu")
+            index = db.sim_index(model)
+            self.assertEqual(1, index.size)
+
+            with IngestSink(db, model=model, device="cpu", batch_size=3, max_delay=.1, tags=["generated"]) as sink:
+                for i, filename in enumerate(sorted(results_path.glob("*"))):
+                    sink.put(filename, meta={"parameters": {"prompt": f"prompt {i}"}})
+                sink.flush()
+                self.assertEqual({"queued": 0, "images": 4, "embeddings": 4, "errors": 0}, sink.status())
+
+            self.assertEqual(5, db.num_images())
+            self.assertEqual([{"model": model, "count": 5}], db.status()["embeddings"])
+            self.assertIs(index, db.sim_index(model))
+            self.assertEqual(5, index.size)
+
+            with db.sql_session() as session:
+                entry = db.get_image(path=results_path / "dog-with-a-red-hat.jpg", sql_session=session)
+                self.assertEqual({"parameters": {"prompt": "prompt 2"}}, entry.meta)
+                self.assertEqual(["generated"], [t.name for t in entry.tags])
+                result = index.images_by_text("a dog", count=5, device="cpu", sql_session=session)
+                self.assertIn(entry.id, [e.id for e, score in result])
+
+    def test_200_errors(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+            with IngestSink(db, embed=False, max_delay=0) as sink:
+                sink.put(Path(tmp_dir) / "missing.png")
+                sink.put(DATA_PATH / "rgb48x32.png", meta={"a": 1})
+                sink.flush()
+                self.assertEqual(1, sink.status()["errors"])
+                self.assertEqual(1, sink.status()["images"])
+
+            self.assertEqual({"a": 1}, db.get_image(path=DATA_PATH / "rgb48x32.png").meta)
@@ -0,0 +1,157 @@
+import sqlite3
+from typing import List, Tuple
+
+import sqlalchemy as sq
+
+from tests.base import *
+
+from src.imagedb import *
+from src.imagedb.migrations import SCHEMA_VERSION, get_schema_version
+
+
+# the schema before versioning was introduced
+LEGACY_SCHEMA = """
+CREATE TABLE image (id INTEGER NOT NULL, path VARCHAR, name VARCHAR, PRIMARY KEY (id));
+CREATE INDEX ix_image_path ON image (path);
+CREATE INDEX ix_image_name ON image (name);
+CREATE TABLE tag (id INTEGER NOT NULL, name VARCHAR(32) NOT NULL, PRIMARY KEY (id));
+CREATE UNIQUE INDEX ix_tag_name ON tag (name);
+CREATE TABLE image_tags (
+    image_id INTEGER NOT NULL, tag_id INTEGER NOT NULL, PRIMARY KEY (image_id, tag_id),
+    FOREIGN KEY(image_id) REFERENCES image (id), FOREIGN KEY(tag_id) REFERENCES tag (id)
+);
+CREATE TABLE embedding (
+    id INTEGER NOT NULL, model VARCHAR(16), data VARCHAR, image_id INTEGER, PRIMARY KEY (id),
+    FOREIGN KEY(image_id) REFERENCES image (id) ON DELETE RESTRICT
+);
+CREATE INDEX ix_embedding_model ON embedding (model);
+CREATE INDEX ix_embedding_image_id ON embedding (image_id);
+"""
+
+
+class TestImageDBSchema(TestBase):
+
+    def test_100_upgrade_legacy_database(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conn = sqlite3.connect(Path(tmp_dir) / "db.sqlite")
+            conn.executescript(LEGACY_SCHEMA)
+            conn.executescript(f"""
+                INSERT INTO image (id, path, name) VALUES (1, '{DATA_PATH}', 'gray48x32.png');
+                INSERT INTO image (id, path, name) VALUES (2, '{DATA_PATH}', 'rgb48x32.png');
+                INSERT INTO image (id, path, name) VALUES (3, '{DATA_PATH}', 'gray48x32.png');
+                INSERT INTO tag (id, name) VALUES (1, 'tag1');
+                INSERT INTO tag (id, name) VALUES (2, 'tag2');
+                INSERT INTO image_tags (image_id, tag_id) VALUES (1, 1);
+                INSERT INTO image_tags (image_id, tag_id) VALUES (3, 1);
+                INSERT INTO image_tags (image_id, tag_id) VALUES (3, 2);
+                INSERT INTO embedding (id, model, data, image_id) VALUES (1, 'fake', '1,2', 1);
+                INSERT INTO embedding (id, model, data, image_id) VALUES (2, 'fake', '3,4', 3);
+                INSERT INTO embedding (id, model, data, image_id) VALUES (3, 'fake', '5,6', 2);
+            """)
+            conn.commit()
+            conn.close()
+
+            db = ImageDB(tmp_dir)
+            with db.sql_engine.connect() as conn:
+                self.assertEqual(SCHEMA_VERSION, get_schema_version(conn))
+                index_names = {
+                    index["name"]
+                    for table in ("image", "embedding")
+                    for index in sq.inspect(conn).get_indexes(table)
+                }
+                self.assertIn("ix_image_path_name", index_names)
+                self.assertIn("ix_embedding_model_image_id", index_names)
+                self.assertIn("meta", {c["name"] for c in sq.inspect(conn).get_columns("image")})
+                self.assertIn("AUTOINCREMENT", conn.execute(sq.text(
+                    "SELECT sql FROM sqlite_master WHERE name = 'embedding'"
+                )).scalar())
+
+            self.assertEqual(2, db.num_images())
+            self.assertEqual(
+                {"num_tags": 2, "num_images": 2, "embeddings": [{"model": "fake", "count": 2}]},
+                db.status(),
+            )
+            with db.sql_session() as session:
+                entry = db.get_image(path=DATA_PATH / "gray48x32.png", sql_session=session)
+                self.assertEqual(1, entry.id)
+                self.assertEqual(["tag1", "tag2"], sorted(t.name for t in entry.tags))
+                # the newest embedding of the duplicates is kept
+                self.assertEqual([3, 4], db.get_embedding(entry, "fake").to_list())
+                self.assertEqual(2, db.get_embedding(entry, "fake").dims)
+
+                with self.assertRaises(sq.exc.IntegrityError):
+                    db.add_embedding(entry, "fake", [7, 8], sql_session=session)
+                session.rollback()
+
+                # the copied table still maintains the counters
+                session.execute(sq.delete(Embedding).where(Embedding.image_id == 2))
+                session.commit()
+            self.assertEqual([{"model": "fake", "count": 1}], db.status()["embeddings"])
+
+    def test_200_new_database_version(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+            with db.sql_engine.connect() as conn:
+                self.assertEqual(SCHEMA_VERSION, get_schema_version(conn))
+
+            # open again, nothing to upgrade
+            db = ImageDB(tmp_dir)
+            with db.sql_engine.connect() as conn:
+                self.assertEqual(SCHEMA_VERSION, get_schema_version(conn))
+
+    def test_500_query_plans(self):
+        """
+        Make sure that the hot queries use an index
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+            db.add_directory(DATA_PATH, tags=["tag"])
+            image_path = DATA_PATH / "gray48x32.png"
+            with db.sql_session() as session:
+                db.add_embedding(db.get_image(path=image_path, sql_session=session), "fake", [1, 2])
+
+            def _plans(func) -> List[Tuple[str, str]]:
+                statements = []
+
+                def _capture(conn, cursor, statement, parameters, context, executemany):
+                    if statement.lstrip().upper().startswith("SELECT"):
+                        statements.append((statement, parameters))
+
+                sq.event.listen(db.sql_engine, "before_cursor_execute", _capture)
+                try:
+                    func()
+                finally:
+                    sq.event.remove(db.sql_engine, "before_cursor_execute", _capture)
+
+                self.assertTrue(statements)
+                with db.sql_engine.connect() as conn:
+                    return [
+                        (
+                            statement,
+                            "\n".join(
+                                row[-1]
+                                for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+                            ),
+                        )
+                        for statement, parameters in statements
+                    ]
+
+            def _assert_index(plans: List[Tuple[str, str]], index_name: str):
+                for statement, plan in plans:
+                    if index_name in plan:
+                        return
+                self.fail(f"Index '{index_name}' not used in:\n" + "\n\n".join(
+                    f"{statement}\n{plan}" for statement, plan in plans
+                ))
+
+            _assert_index(_plans(lambda: db.get_image(path=image_path)), "ix_image_path_name")
+            _assert_index(_plans(lambda: db.get_embedding(1, "fake")), "ix_embedding_model_image_id")
+            _assert_index(_plans(lambda: db.get_tags(["tag"])), "ix_tag_name")
+
+            # the query for missing embeddings in update_embeddings
+            with db.sql_session() as session:
+                query = session.query(ImageEntry).filter(~ImageEntry.embeddings.any(model="fake"))
+                _assert_index(_plans(lambda: query.all()), "ix_embedding_model_image_id")
+
+            for statement, plan in _plans(lambda: db.status()):
+                self.assertNotIn("TEMP B-TREE FOR GROUP BY", plan, statement)
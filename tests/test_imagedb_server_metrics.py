@@ -0,0 +1,101 @@
+import json
+import re
+
+import tornado.testing
+
+from tests.base import *
+
+from src.clip import ClipSingleton
+from src.imagedb import ImageDB
+from src.imagedb.server import create_app
+from src.imagedb.server.metrics import Counter, Histogram, Gauge
+
+
+class TestServerMetrics(tornado.testing.AsyncHTTPTestCase, TestBase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.db = ImageDB(self._tmp_dir.name)
+        self.db.add_directory(DATA_PATH / "animals")
+        self.db.update_embeddings(model="stub-512", device="cpu")
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        ClipSingleton.unload()
+        self._tmp_dir.cleanup()
+
+    def get_app(self):
+        return create_app(self.db, debug=False)
+
+    def test_100_metric_types(self):
+        counter = Counter("requests_total", "Requests", ("handler", ))
+        counter.inc(handler="a")
+        counter.inc(2, handler="a")
+        counter.inc(handler='x"y')
+        self.assertEqual(3, counter.value(handler="a"))
+        with self.assertRaises(ValueError):
+            counter.inc(other="a")
+        self.assertEqual(
+            [
+                "# HELP requests_total Requests",
+                "# TYPE requests_total counter",
+                'requests_total{handler="a"} 3',
+                'requests_total{handler="x\\"y"} 1',
+            ],
+            counter.render(),
+        )
+
+        histogram = Histogram("seconds", "Time", buckets=(.1, 1.))
+        for value in (.05, .1, .5, 3.):
+            histogram.observe(value)
+        self.assertEqual(4, histogram.count())
+        self.assertEqual(
+            [
+                'seconds_bucket{le="0.1"} 2',
+                'seconds_bucket{le="1"} 3',
+                'seconds_bucket{le="+Inf"} 4',
+                "seconds_sum 3.65",
+                "seconds_count 4",
+            ],
+            histogram.render()[2:],
+        )
+
+        gauge = Gauge("size", "Size")
+        gauge.set(5)
+        gauge.set(7)
+        self.assertEqual(["size 7"], gauge.render()[2:])
+
+    def test_200_query(self):
+        response = self.fetch(
+            "/query/", method="POST",
+            body=json.dumps({"text": "a dog", "model": "stub-512", "count": 3, "device": "cpu"}),
+        )
+        self.assertEqual(200, response.code)
+        self.assertEqual(3, len(json.loads(response.body)["images"]))
+
+        timing = response.headers["Server-Timing"]
+        self.assertRegex(timing, r"^encode;dur=[0-9.]+, search;dur=[0-9.]+, hydrate;dur=[0-9.]+$")
+
+        self.assertEqual(200, self.fetch("/status/").code)
+        self.assertEqual(404, self.fetch("/image/1000/").code)
+
+        response = self.fetch("/metrics/")
+        self.assertEqual(200, response.code)
+        self.assertTrue(response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+        text = response.body.decode()
+
+        def _value(line_start: str) -> float:
+            match = re.search("^" + re.escape(line_start) + r" (\S+)$", text, re.MULTILINE)
+            self.assertIsNotNone(match, f"'{line_start}' not in\n{text}")
+            return float(match.group(1))
+
+        self.assertEqual(1, _value('imagedb_http_requests_total{handler="QueryHandler",method="POST",status="200"}'))
+        self.assertEqual(1, _value('imagedb_http_requests_total{handler="ImageHandler",method="GET",status="404"}'))
+        self.assertEqual(1, _value('imagedb_http_request_duration_seconds_count{handler="StatusHandler",method="GET"}'))
+        for stage in ("encode", "search", "hydrate"):
+            self.assertEqual(1, _value(f'imagedb_query_stage_duration_seconds_count{{stage="{stage}"}}'))
+        self.assertEqual(4, _value('imagedb_index_size{model="stub-512"}'))
+        self.assertEqual(1, _value("imagedb_clip_models_loaded"))
+        self.assertEqual(ClipSingleton.max_models, _value("imagedb_clip_models_max"))
+        self.assertGreaterEqual(_value('imagedb_sql_pool_connections{state="checked_out"}'), 0)
@@ -0,0 +1,118 @@
+import threading
+import time
+
+import sqlalchemy as sq
+from sqlalchemy.exc import OperationalError
+
+from tests.base import *
+
+from src.imagedb import *
+
+
+class TestImageDBSql(TestBase):
+
+    def test_100_profile_pragmas(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+            with db.sql_engine.connect() as conn:
+                self.assertEqual("wal", conn.execute(sq.text("PRAGMA journal_mode")).scalar())
+                self.assertEqual(10_000, conn.execute(sq.text("PRAGMA busy_timeout")).scalar())
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir, sql_profile=SqliteProfile.legacy())
+            with db.sql_engine.connect() as conn:
+                self.assertEqual("delete", conn.execute(sq.text("PRAGMA journal_mode")).scalar())
+
+    def test_200_read_only(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ImageDB(tmp_dir).add_image(DATA_PATH / "gray48x32.png")
+
+            db = ImageDB(tmp_dir, read_only=True)
+            self.assertEqual(1, db.num_images())
+            with self.assertRaises(OperationalError):
+                db.add_image(DATA_PATH / "rgb48x32.png")
+
+    def test_300_thread_sessions(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+
+            with db.sql_session() as session:
+                with db.sql_session() as session2:
+                    self.assertIs(session, session2)
+
+                other_sessions = []
+                thread = threading.Thread(
+                    target=lambda: other_sessions.append(db.sql_session().__enter__())
+                )
+                thread.start()
+                thread.join()
+                self.assertIsNot(session, other_sessions[0])
+
+            db = ImageDB(tmp_dir, sql_profile=SqliteProfile.legacy())
+            with db.sql_session() as session:
+                with db.sql_session() as session2:
+                    self.assertIsNot(session, session2)
+
+    def test_900_benchmark_read_write_concurrency(self):
+        """
+        One thread writes image entries in small transactions
+        while other threads poll `ImageDB.status()`
+        """
+        duration = 1.
+        num_readers = 4
+
+        print()
+        print(f"{'profile':10} {'writes/s':>10} {'reads/s':>10} {'max read ms':>12} {'errors':>7}")
+
+        for profile_name, profile in (
+                ("legacy", SqliteProfile.legacy()),
+                ("default", SqliteProfile()),
+        ):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                ImageDB(tmp_dir, sql_profile=profile).num_images()
+
+                stop = threading.Event()
+                num_writes = [0]
+                read_times = []
+                errors = []
+
+                def _writer():
+                    db = ImageDB(tmp_dir, sql_profile=profile)
+                    count = 0
+                    while not stop.is_set():
+                        with db.sql_session() as session:
+                            session.add_all([
+                                ImageEntry(path=tmp_dir, name=f"{count + i}.png")
+                                for i in range(10)
+                            ])
+                            session.commit()
+                        count += 10
+                        num_writes[0] += 1
+
+                def _reader():
+                    db = ImageDB(tmp_dir, sql_profile=profile, read_only=True)
+                    while not stop.is_set():
+                        start_time = time.perf_counter()
+                        try:
+                            db.status()
+                            read_times.append(time.perf_counter() - start_time)
+                        except OperationalError as e:
+                            errors.append(e)
+
+                threads = [threading.Thread(target=_writer)] + [
+                    threading.Thread(target=_reader)
+                    for i in range(num_readers)
+                ]
+                for t in threads:
+                    t.start()
+                time.sleep(duration)
+                stop.set()
+                for t in threads:
+                    t.join()
+
+                print(
+                    f"{profile_name:10} {num_writes[0] / duration:10.1f} {len(read_times) / duration:10.1f}"
+                    f" {max(read_times, default=0) * 1000:12.2f} {len(errors):7}"
+                )
+                if profile_name == "default":
+                    self.assertFalse(errors)
@@ -0,0 +1,99 @@
+import sqlalchemy as sq
+
+from tests.base import *
+
+from src.imagedb import *
+
+
+class TestImageDBStatus(TestBase):
+
+    def test_100_counters(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+            self.assertEqual(
+                {"num_tags": 0, "num_images": 0, "embeddings": []},
+                db.status(),
+            )
+
+            db.add_directory(DATA_PATH, tags=["tag1", "tag2"])
+            with db.sql_session() as session:
+                image_ids = [e.id for e in session.query(ImageEntry).order_by(ImageEntry.id)]
+                db.add_embedding(image_ids[0], "fake", [1, 2, 3], sql_session=session)
+                db.backend.bulk_insert(session.connection(), Embedding.__table__, [
+                    {"model": "bulk", "data": "1,2", "image_id": image_id}
+                    for image_id in image_ids
+                ])
+                session.commit()
+
+            self.assertEqual(
+                {
+                    "num_tags": 2,
+                    "num_images": 3,
+                    "embeddings": [
+                        {"model": "bulk", "count": 3},
+                        {"model": "fake", "count": 1},
+                    ],
+                },
+                db.status(),
+            )
+
+            with db.sql_session() as session:
+                session.execute(sq.delete(Embedding).where(Embedding.model == "fake"))
+                session.execute(sq.update(Embedding).where(Embedding.image_id == image_ids[0]).values(model="other"))
+                session.commit()
+
+            self.assertEqual(
+                [
+                    {"model": "bulk", "count": 2},
+                    {"model": "other", "count": 1},
+                ],
+                db.status()["embeddings"],
+            )
+
+    def test_200_detailed(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+            db.add_directory(DATA_PATH)
+            db.add_embedding(db.get_image(path=DATA_PATH / "gray48x32.png"), "fake", [1, 2, 3])
+
+            status = db.status(detailed=True)
+            self.assertEqual([{"model": "fake", "count": 1, "dimensions": 3}], status["embeddings"])
+            self.assertGreater(status["bytes_on_disk"], 0)
+            self.assertEqual([], status["indices"])
+
+    def test_300_ttl(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir, status_ttl=60)
+            self.assertEqual(0, db.status()["num_images"])
+
+            db.add_directory(DATA_PATH)
+            self.assertEqual(0, db.status()["num_images"])
+            self.assertEqual(3, db.status(detailed=True)["num_images"])
+
+            db.status_ttl = 0
+            self.assertEqual(3, db.status()["num_images"])
+
+            # callers get a copy of the snapshot
+            db.status_ttl = 60
+            db.status()["embeddings"].append("changed")
+            self.assertEqual([], db.status()["embeddings"])
+
+    def test_400_cli(self):
+        import contextlib
+        import io
+        from bin.imagedb import command_status
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+            db.add_directory(DATA_PATH)
+            with db.sql_session() as session:
+                image_ids = [e.id for e in session.query(ImageEntry).order_by(ImageEntry.id)]
+            db.write_embeddings("fake", image_ids[:2], [[1, 0, 0]] * 2)
+            db.sim_index("fake")
+            # not yet in the index
+            db.add_embedding(image_ids[2], "fake", [0, 1, 0])
+
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                command_status(db, detailed=True, verbose=False)
+            self.assertRegex(output.getvalue(), r"loaded indices:\n  - fake +2 \(1 missing, synced [0-9.]+s ago\)")
@@ -0,0 +1,144 @@
+import threading
+import time
+
+from tests.base import *
+
+from src.stage import Stage, StageItem, FunctionStage, LoadImageStage
+from src.pipeline import Pipeline, items_from_folder, items_from_imagedb
+
+
+def _double(x):
+    return x * 2
+
+
+class BatchRecorder(Stage):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches = []
+
+    def step_batch(self, items):
+        self.batches.append([item.image for item in items])
+        # drop odd numbers
+        return [item for item in items if item.image % 2 == 0]
+
+
+class Slow(Stage):
+
+    def __init__(self, seconds: float, **kwargs):
+        super().__init__(**kwargs)
+        self.seconds = seconds
+
+    def step(self, image):
+        time.sleep(self.seconds)
+        return image
+
+
+class Failing(Stage):
+
+    def step(self, image):
+        if image == 5:
+            raise ValueError("five")
+        return image
+
+
+class TestPipeline(TestBase):
+
+    def test_100_chain(self):
+        for executor in (None, "thread", "process"):
+            pipeline = Pipeline([
+                FunctionStage(_double, batch_size=3, executor=executor, workers=2),
+                FunctionStage(_double, batch_size=4),
+            ])
+            result = pipeline.process(range(10))
+            self.assertEqual([i * 4 for i in range(10)], [item.image for item in result], executor)
+
+            stats = pipeline.stats()
+            self.assertEqual(["_double", "_double"], [s["name"] for s in stats])
+            self.assertEqual([4, 3], [s["batches"] for s in stats])
+            self.assertEqual([10, 10], [s["items_in"] for s in stats])
+            self.assertEqual([10, 10], [s["items_out"] for s in stats])
+            self.assertGreater(stats[0]["throughput"], 0)
+
+        with self.assertRaises(ValueError):
+            FunctionStage(_double, executor="gpu")
+
+    def test_200_batches(self):
+        recorder = BatchRecorder(batch_size=4)
+        pipeline = Pipeline([FunctionStage(_double, batch_size=3), FunctionStage(_double), recorder])
+        result = pipeline.process(StageItem(image=i, meta={"i": i}) for i in range(5))
+
+        self.assertEqual([[0, 4, 8, 12], [16]], recorder.batches)
+        self.assertEqual([0, 1, 2, 3, 4], [item.meta["i"] for item in result])
+
+        pipeline = Pipeline([FunctionStage(lambda x: x + 1), recorder])
+        self.assertEqual([2, 4], [item.image for item in pipeline.process(range(4))])
+        self.assertEqual({"items_in": 4, "items_out": 2}, {
+            key: pipeline.stats()[1][key] for key in ("items_in", "items_out")
+        })
+
+    def test_210_parallel_throughput(self):
+        pipeline = Pipeline([Slow(.05, executor="thread", workers=4)])
+        pipeline.process(range(8))
+        stats = pipeline.stats()[0]
+
+        # the busy time of the workers adds up, the throughput is per wall-clock second
+        self.assertGreater(stats["busy_seconds"], .35)
+        self.assertLess(stats["active_seconds"], .3)
+        self.assertGreater(stats["throughput"], 2 * 8 / stats["busy_seconds"])
+
+    def test_300_backpressure(self):
+        num_yielded = 0
+
+        def _source():
+            nonlocal num_yielded
+            for i in range(1000):
+                num_yielded += 1
+                yield i
+
+        pipeline = Pipeline([FunctionStage(_double), Slow(.01)], queue_size=2)
+        iterator = pipeline.run(_source())
+        self.assertEqual(0, next(iterator).image)
+        time.sleep(.3)
+        # the source is blocked by the slow stage
+        self.assertLess(num_yielded, 20)
+
+        # closing the iterator stops all threads
+        iterator.close()
+        self.assertLess(num_yielded, 30)
+        self.assertFalse([t for t in threading.enumerate() if t.name.startswith("Pipeline")])
+        self.assertGreater(pipeline.stats()[0]["blocked_seconds"], 0)
+
+    def test_400_errors(self):
+        for executor in (None, "thread"):
+            pipeline = Pipeline([FunctionStage(_double), Failing(executor=executor)])
+            with self.assertRaisesRegex(ValueError, "five"):
+                pipeline.process([1, 2, 3, 2.5, 4])
+            self.assertFalse([t for t in threading.enumerate() if t.name.startswith("Pipeline")])
+
+    def test_500_sources(self):
+        from src.imagedb import ImageDB, ImageEntry
+
+        pipeline = Pipeline([LoadImageStage(batch_size=3), FunctionStage(lambda image: image.size)])
+
+        result = pipeline.process(items_from_folder(DATA_PATH, recursive=True))
+        self.assertEqual(7, len(result))
+        self.assertEqual("dog-with-a-green-hat.jpg", result[0].meta["filename"].name)
+        self.assertEqual((48, 32), result[-1].image)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+            db.add_directory(DATA_PATH / "animals")
+            db.add_image(DATA_PATH / "rgb48x32.png")
+
+            result = pipeline.process(items_from_imagedb(db))
+            self.assertEqual([1, 2, 3, 4, 5], [item.meta["image_id"] for item in result])
+            self.assertEqual((48, 32), result[-1].image)
+
+            result = pipeline.process(items_from_imagedb(
+                db, query=lambda q: q.filter(ImageEntry.name.like("zebra%")),
+            ))
+            self.assertEqual(
+                ["zebra-with-a-green-hat.jpg", "zebra-with-a-red-hat.jpg"],
+                [item.meta["filename"].name for item in result],
+            )
@@ -0,0 +1,129 @@
+import json
+import os
+import pstats
+import subprocess
+import sys
+import threading
+
+from tests.base import *
+from tests.test_startup import PROJECT_PATH
+
+from src import profiling
+from src.clip import ClipSingleton
+
+
+class TestProfiling(TestBase):
+
+    def tearDown(self):
+        profiling.disable()
+        ClipSingleton.unload()
+
+    def test_100_spans(self):
+        # disabled spans are one shared object
+        self.assertIsNone(profiling.recorder())
+        self.assertIs(profiling.span("a"), profiling.span("b"))
+        with profiling.span("a"):
+            pass
+
+        recorder = profiling.enable(trace=True)
+        self.assertIs(recorder, profiling.recorder())
+
+        # both threads are alive at the same time, so their idents differ
+        barrier = threading.Barrier(2)
+
+        def _work():
+            barrier.wait(5)
+            for i in range(3):
+                with profiling.span("outer"):
+                    with profiling.span("inner"):
+                        pass
+
+        threads = [threading.Thread(target=_work) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertIs(recorder, profiling.disable())
+        with profiling.span("after"):
+            pass
+
+        summary = {s["name"]: s for s in recorder.summary()}
+        self.assertEqual({"outer", "inner"}, set(summary))
+        self.assertEqual(6, summary["outer"]["count"])
+        self.assertGreaterEqual(summary["outer"]["seconds"], summary["inner"]["seconds"])
+        self.assertEqual("outer", recorder.summary()[0]["name"])
+
+        table = recorder.format_summary().splitlines()
+        self.assertEqual(3, len(table))
+        self.assertTrue(table[0].startswith("span"))
+
+        self.assertEqual(12, len(recorder.events))
+        self.assertEqual(2, len({e["tid"] for e in recorder.events}))
+
+    def test_200_imagedb(self):
+        from src.imagedb import ImageDB
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = ImageDB(tmp_dir)
+            db.add_directory(DATA_PATH / "animals")
+
+            recorder = profiling.enable()
+            db.update_embeddings(model="stub-512", device="cpu", batch_size=3)
+            db.sim_index("stub-512").images_by_text("a dog", count=2, device="cpu")
+            profiling.disable()
+
+            summary = {s["name"]: s["count"] for s in recorder.summary()}
+            self.assertEqual(4, summary["clip.decode"])
+            for name in ("clip.preprocess", "clip.inference", "imagedb.image_features", "imagedb.commit"):
+                self.assertIn(name, summary)
+            self.assertEqual(2, summary["imagedb.commit"])
+            self.assertEqual(1, summary["simindex.search"])
+            self.assertEqual(2, summary["simindex.hydrate"])
+
+    def test_300_cli(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            env = {
+                **os.environ,
+                "PYTHONPATH": str(PROJECT_PATH),
+                "MP_DATABASE_PATH": str(Path(tmp_dir) / "db"),
+                "MP_DATABASE_URL": "",
+            }
+
+            def _run(*args: str) -> subprocess.CompletedProcess:
+                process = subprocess.run(
+                    [sys.executable, "bin/imagedb.py", *args],
+                    cwd=PROJECT_PATH, env=env, capture_output=True, text=True,
+                )
+                if process.returncode:
+                    raise AssertionError(process.stderr)
+                return process
+
+            _run("add", str(DATA_PATH / "animals"))
+
+            output = Path(tmp_dir) / "update.prof"
+            _run("--profile", "cprofile", "--profile-output", str(output), "update", "-m", "stub-512", "-d", "cpu")
+            stats = pstats.Stats(str(output))
+            self.assertTrue(any(func[2] == "update_embeddings" for func in stats.stats))
+
+            output = Path(tmp_dir) / "query.json"
+            process = _run(
+                "-v", "--profile", "trace", "--profile-output", str(output),
+                "query", "-t", "a dog", "-m", "stub-512", "-d", "cpu",
+            )
+            events = json.loads(output.read_text())["traceEvents"]
+            self.assertIn("simindex.search", {e["name"] for e in events})
+            # the summary table
+            self.assertRegex(process.stderr, r"\nspan +count +total s")
+            self.assertIn("clip.inference", process.stderr)
+
+            # a subcommand right after --profile
+            output = Path(tmp_dir) / "status.json"
+            _run("--profile", "trace", "--profile-output", str(output), "status")
+            self.assertTrue(output.exists())
+            process = subprocess.run(
+                [sys.executable, "bin/imagedb.py", "--profile", "status"],
+                cwd=PROJECT_PATH, env=env, capture_output=True, text=True,
+            )
+            self.assertEqual(2, process.returncode)
+            self.assertIn("invalid choice: 'status'", process.stderr)
@@ -0,0 +1,73 @@
+import os
+import subprocess
+import sys
+from typing import Set, Tuple
+
+from tests.base import *
+
+
+PROJECT_PATH = Path(__file__).resolve().parent.parent
+
+# seconds, for all imports of `bin/imagedb.py status` (~0.4s when this was written),
+# generous because wall-clock time is unreliable on busy machines, 0 to skip the check
+IMPORT_TIME_BUDGET = float(os.environ.get("MP_TEST_IMPORT_BUDGET") or 2.)
+
+# must not be imported by commands that do not use CLIP
+HEAVY_MODULES = ("torch", "torchvision", "clip", "faiss", "numpy", "PIL", "tqdm")
+
+
+def import_times(*args: str, database_path: Path) -> Tuple[float, Set[str]]:
+    """
+    Run a python script with ``-X importtime``
+
+    :return: tuple of (seconds for all imports, names of all imported modules)
+    """
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(PROJECT_PATH),
+        "MP_DATABASE_PATH": str(database_path),
+        "MP_DATABASE_URL": "",
+    }
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        cwd=PROJECT_PATH, env=env, capture_output=True, text=True,
+    )
+    if process.returncode:
+        raise AssertionError(process.stderr)
+
+    seconds, modules = 0., set()
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.add(name.strip())
+        # nested imports are indented and included in the top-level time
+        if not name[1:].startswith(" "):
+            seconds += int(cumulative) / 1_000_000
+    return seconds, modules
+
+
+class TestStartup(TestBase):
+
+    def test_100_imagedb_status(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # first run creates the database
+            import_times("bin/imagedb.py", "status", database_path=Path(tmp_dir))
+            seconds, modules = import_times("bin/imagedb.py", "status", database_path=Path(tmp_dir))
+
+        print(f"\nimagedb status imports: {seconds:.3f}s")
+        for name in HEAVY_MODULES:
+            self.assertNotIn(name, modules)
+        if IMPORT_TIME_BUDGET:
+            self.assertLess(seconds, IMPORT_TIME_BUDGET)
+
+    def test_200_lazy_packages(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            seconds, modules = import_times(
+                "-c", "import src.imagedb, src.image; import src.clip",
+                database_path=Path(tmp_dir),
+            )
+
+        self.assertIn("torch", modules)
+        for name in ("clip", "torchvision", "faiss"):
+            self.assertNotIn(name, modules)